@@ -7,6 +7,120 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY', 'a-super-secret-key-for-local-development')
     TASK_RUNNER_SECRET_KEY = os.environ.get('TASK_RUNNER_SECRET_KEY', 'local-secret-runner-key')
 
+    # How many submissions each pipeline stage works on at the same time.
+    # TASK_CONCURRENCY is the default; I/O-bound stages can be tuned separately,
+    # e.g. TRA fetches against the portal and LLM extraction against provider limits.
+    TASK_CONCURRENCY = int(os.environ.get('TASK_CONCURRENCY', 4))
+    STAGE_CONCURRENCY = {
+        'preprocess': int(os.environ.get('PREPROCESS_CONCURRENCY', 2)),
+        'fetch': int(os.environ.get('FETCH_CONCURRENCY', TASK_CONCURRENCY)),
+        'clean': int(os.environ.get('CLEAN_CONCURRENCY', 2)),
+        'extract': int(os.environ.get('EXTRACT_CONCURRENCY', TASK_CONCURRENCY)),
+        'persist': int(os.environ.get('PERSIST_CONCURRENCY', 1)),
+        'export': int(os.environ.get('EXPORT_CONCURRENCY', 2)),
+    }
+
+    # The in-process queue worker starts processing as soon as a receipt arrives,
+    # and sweeps the queue on this interval as a fallback (retries, rescued jobs).
+    QUEUE_WORKER_ENABLED = os.environ.get('QUEUE_WORKER_ENABLED', 'true').lower() == 'true'
+    QUEUE_SWEEP_INTERVAL_SECONDS = int(os.environ.get('QUEUE_SWEEP_INTERVAL_SECONDS', 60))
+    # Compatibility path: also trigger /tasks/run over HTTP after each intake.
+    TASK_RUNNER_HTTP_TRIGGER = os.environ.get('TASK_RUNNER_HTTP_TRIGGER', 'false').lower() == 'true'
+
+    # Backoff for transient failures (receipts TRA hasn't published yet, LLM providers
+    # that keep throttling us): the delay doubles from the base on every attempt
+    # (with jitter) up to the cap, while other jobs keep flowing.
+    FETCH_RETRY_BASE_SECONDS = int(os.environ.get('FETCH_RETRY_BASE_SECONDS', 30))
+    FETCH_RETRY_MAX_SECONDS = int(os.environ.get('FETCH_RETRY_MAX_SECONDS', 900))
+
+    # LLM HTTP clients are reused across jobs; these bound each client's connection pool.
+    LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', 60))
+    LLM_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('LLM_CONNECT_TIMEOUT_SECONDS', 10))
+    LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', 20))
+    LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 10))
+
+    # Export events (webhook, S3, Google Sheets) go through an outbox and are delivered
+    # in the background. Failed deliveries back off exponentially; after
+    # OUTBOX_MAX_ATTEMPTS an event is dead-lettered and can be retried from the queue page.
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 12))
+    OUTBOX_RETRY_BASE_SECONDS = int(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', 10))
+    OUTBOX_RETRY_MAX_SECONDS = int(os.environ.get('OUTBOX_RETRY_MAX_SECONDS', 3600))
+    OUTBOX_RETENTION_DAYS = int(os.environ.get('OUTBOX_RETENTION_DAYS', 7))
+
+    # /api/changes remembers deleted submissions for this long; clients that last synced
+    # before that start over from scratch.
+    CHANGE_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('CHANGE_TOMBSTONE_RETENTION_DAYS', 30))
+
+    # The instance config and device API keys are cached in each worker; changes made
+    # by another worker show up within this many seconds.
+    CONFIG_CACHE_CHECK_SECONDS = float(os.environ.get('CONFIG_CACHE_CHECK_SECONDS', 1))
+
+    # Google Sheets writes are batched: up to GSHEET_BATCH_SIZE events are flushed
+    # together, after waiting GSHEET_FLUSH_SECONDS for a burst to collect.
+    GSHEET_BATCH_SIZE = int(os.environ.get('GSHEET_BATCH_SIZE', 100))
+    GSHEET_FLUSH_SECONDS = float(os.environ.get('GSHEET_FLUSH_SECONDS', 5))
+
+    # S3 export layout. 'object' writes one JSON object per event; 'archive' writes
+    # gzip NDJSON batches in hourly partitions (archive/YYYY/MM/DD/HH/) with a manifest
+    # per batch, flushed every S3_ARCHIVE_FLUSH_SECONDS or S3_ARCHIVE_MAX_EVENTS events.
+    # S3_ENDPOINT_URL points at an S3-compatible service (e.g. MinIO for local testing).
+    S3_EXPORT_MODE = os.environ.get('S3_EXPORT_MODE', 'object').lower()
+    S3_ARCHIVE_FLUSH_SECONDS = float(os.environ.get('S3_ARCHIVE_FLUSH_SECONDS', 300))
+    S3_ARCHIVE_MAX_EVENTS = int(os.environ.get('S3_ARCHIVE_MAX_EVENTS', 5000))
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+
+    # Webhook delivery. 'single' POSTs every event on its own; 'batch' POSTs a JSON
+    # array of up to WEBHOOK_BATCH_SIZE events collected over WEBHOOK_BATCH_WINDOW_SECONDS,
+    # keeping only the latest event per submission.
+    WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'single').lower()
+    WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 100))
+    WEBHOOK_BATCH_WINDOW_SECONDS = float(os.environ.get('WEBHOOK_BATCH_WINDOW_SECONDS', 2))
+
+    # All TRA portal requests share one keep-alive connection pool. At most
+    # TRA_MAX_CONCURRENCY requests are in flight against the portal at once.
+    TRA_MAX_CONNECTIONS = int(os.environ.get('TRA_MAX_CONNECTIONS', 10))
+    TRA_MAX_CONCURRENCY = int(os.environ.get('TRA_MAX_CONCURRENCY', 4))
+    TRA_TIMEOUT_SECONDS = float(os.environ.get('TRA_TIMEOUT_SECONDS', 15))
+
+    # Photos are straightened, downscaled and recompressed before they go to the vision
+    # model. The Pillow work runs in this many worker processes (0 = inline).
+    IMAGE_PREPROCESS_WORKERS = int(os.environ.get('IMAGE_PREPROCESS_WORKERS', 2))
+    IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 1600))
+    IMAGE_GRAYSCALE = os.environ.get('IMAGE_GRAYSCALE', 'false').lower() == 'true'
+    IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 80))
+
+    # Uploaded photos larger than this are refused while they stream in. The request
+    # limit leaves room for the other form fields.
+    UPLOAD_MAX_MB = int(os.environ.get('UPLOAD_MAX_MB', 15))
+    MAX_CONTENT_LENGTH = (UPLOAD_MAX_MB + 1) * 1024 * 1024
+
+    # LLM results are cached by content hash, so identical receipts skip the LLM call.
+    EXTRACTION_CACHE_MAX_ENTRIES = int(os.environ.get('EXTRACTION_CACHE_MAX_ENTRIES', 5000))
+    EXTRACTION_CACHE_MAX_AGE_DAYS = int(os.environ.get('EXTRACTION_CACHE_MAX_AGE_DAYS', 90))
+
+    # Dashboard stat cards are summed from hourly/daily rollups and cached this long.
+    DASHBOARD_STATS_TTL_SECONDS = float(os.environ.get('DASHBOARD_STATS_TTL_SECONDS', 5))
+
+    # Per-provider LLM rate limits (requests and tokens per minute). Set these to your
+    # account's limits; concurrency adapts between 1 and max_concurrency on 429s.
+    LLM_RATE_LIMITS = {
+        'groq': {
+            'rpm': int(os.environ.get('GROQ_RPM', 30)),
+            'tpm': int(os.environ.get('GROQ_TPM', 12000)),
+            'max_concurrency': int(os.environ.get('GROQ_MAX_CONCURRENCY', 4)),
+        },
+        'openai': {
+            'rpm': int(os.environ.get('OPENAI_RPM', 500)),
+            'tpm': int(os.environ.get('OPENAI_TPM', 30000)),
+            'max_concurrency': int(os.environ.get('OPENAI_MAX_CONCURRENCY', 8)),
+        },
+    }
+
+    # A call queued this long for its provider's limits parks the job for a later retry
+    # instead. Keep it, plus three LLM_TIMEOUT_SECONDS attempts, well under the 10 minute
+    # stuck-job cutoff, or a job still waiting here is rescued and claimed a second time.
+    LLM_MAX_QUEUE_SECONDS = float(os.environ.get('LLM_MAX_QUEUE_SECONDS', 120))
+
     # Session timeout configuration
     PERMANENT_SESSION_LIFETIME = timedelta(days=365)
 
@@ -25,4 +139,41 @@ class Config:
     # Always point the database URI to our conventional path.
     SQLALCHEMY_DATABASE_URI = f"sqlite:///{DB_PATH}"
     
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # SQLite runs in WAL mode so readers and the writer don't block each other. Each
+    # connection waits up to SQLITE_BUSY_TIMEOUT_MS for a lock held by another process,
+    # and gets a page cache of SQLITE_CACHE_SIZE_MB and SQLITE_MMAP_SIZE_MB of memory map.
+    # Dashboard pages, stats, exports and the change feed read through a separate pool
+    # of SQLITE_READ_POOL_SIZE read-only connections.
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_CACHE_SIZE_MB = int(os.environ.get('SQLITE_CACHE_SIZE_MB', 32))
+    SQLITE_MMAP_SIZE_MB = int(os.environ.get('SQLITE_MMAP_SIZE_MB', 256))
+    SQLITE_READ_POOL_SIZE = int(os.environ.get('SQLITE_READ_POOL_SIZE', 8))
+    # The sqlite3 driver never yields to gevent, so those reads, and the writes with their
+    # commits and lock waits, run on native threads (as many again for each) instead of
+    # blocking the worker's event loop (SSE, intake, LLM calls).
+    DB_OFFLOAD_READS = os.environ.get('DB_OFFLOAD_READS', 'true').lower() == 'true'
+    DB_OFFLOAD_WRITES = os.environ.get('DB_OFFLOAD_WRITES', 'true').lower() == 'true'
+    # Per-request event loop and database timings, sent as a Server-Timing header and
+    # kept in /admin/metrics. Requests holding the loop longer than HUB_BLOCKING_LOG_MS are logged.
+    REQUEST_TIMING_ENABLED = os.environ.get('REQUEST_TIMING_ENABLED', 'true').lower() == 'true'
+    HUB_BLOCKING_LOG_MS = int(os.environ.get('HUB_BLOCKING_LOG_MS', 100))
+    # Small writes (job claims, delivery marks, cache hit counters) are committed in
+    # groups: up to WRITE_BATCH_MAX_STATEMENTS per commit, waiting WRITE_BATCH_WINDOW_MS
+    # for concurrent writers to join.
+    WRITE_BATCH_MAX_STATEMENTS = int(os.environ.get('WRITE_BATCH_MAX_STATEMENTS', 100))
+    WRITE_BATCH_WINDOW_MS = float(os.environ.get('WRITE_BATCH_WINDOW_MS', 2))
+
+    # Dashboard live updates (SSE). 'eventlog' shares events between gunicorn workers
+    # through a small SQLite log next to the database; 'memory' only reaches clients
+    # of the worker that produced the event (a single worker setup).
+    SSE_BACKEND = os.environ.get('SSE_BACKEND', 'eventlog')
+    SSE_EVENTS_DB = os.environ.get('SSE_EVENTS_DB', os.path.join(DATA_DIR, 'events.db'))
+    SSE_POLL_INTERVAL_SECONDS = float(os.environ.get('SSE_POLL_INTERVAL_SECONDS', 0.5))
+    SSE_EVENT_RETENTION_SECONDS = int(os.environ.get('SSE_EVENT_RETENTION_SECONDS', 3600))
+    # Recent events kept per worker for clients reconnecting with Last-Event-ID, and how many
+    # submissions a slow client may have waiting before it is told to reload instead.
+    SSE_REPLAY_BUFFER_SIZE = int(os.environ.get('SSE_REPLAY_BUFFER_SIZE', 1000))
+    SSE_CLIENT_MAX_PENDING = int(os.environ.get('SSE_CLIENT_MAX_PENDING', 200))
\ No newline at end of file
@@ -0,0 +1,8 @@
+# gunicorn.conf.py
+# Read by gunicorn from the working directory; the command line sets everything else.
+
+def post_worker_init(worker):
+    # Database setup, the queue worker, outbox delivery and the SSE tailer run in
+    # every worker process, never at import (see main.start_services).
+    from main import start_services
+    start_services()
@@ -1,43 +1,86 @@
 # main.py
 import os, re, time, json, csv, io, pyotp, requests, gevent
 from functools import wraps
-from datetime import datetime, timedelta, date
-from werkzeug.utils import secure_filename
+from datetime import datetime, date
+from werkzeug.exceptions import RequestEntityTooLarge
 from bs4 import BeautifulSoup
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session, current_app, send_from_directory, Response
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session, current_app, send_from_directory, Response, stream_with_context
 
 from config import Config
 from models.user import db, InstanceConfig, Device, Receipt, Submission
+from models.schema import upgrade_schema
 from utils.security import generate_totp_provisioning_uri, generate_qr_code_base64
-from utils.export import dispatch_event, format_currency
-from utils.llm_processor import extract_receipt_details
-from utils.sse_broker import announcer
+from utils.export import dispatch_event, format_currency, enabled_destinations, build_sinks
+from utils.s3_sink import s3_sink
+from utils.outbox import configure_outbox, outbox_worker, outbox_counts, retry_dead_events
+from utils.llm_processor import extract_receipt_details, describe_receipt, configure_llm_clients, reset_llm_clients, select_model
+from utils.extraction_cache import configure_extraction_cache, extraction_cache_key, get_cached_extraction, store_extraction
+from utils.llm_scheduler import llm_scheduler, LLMRateLimited
+from utils.metrics import metrics
+from utils.tra_parser import parse_tra_receipt
+from utils.tra_client import tra_client
+from utils.image_preprocessor import configure_image_preprocessing, preprocess_receipt_image
+from utils.sse_broker import announcer, EventLog
+from utils.sqlite_engine import configure_sqlite, read_session, write_batcher
+from utils.hub_monitor import hub_monitor
+from utils.dashboard_stats import dashboard_stats, backfill_stat_buckets, prune_hourly_buckets
+from utils.receipt_export import EXPORT_FORMATS, FORMAT_WRITERS, export_rows, gzip_chunks
+from utils.submission_queries import parse_submission_filters, fetch_submissions_page
+from utils.change_feed import configure_change_feed, parse_change_params, change_state, changes_etag, fetch_changes
+from utils.config_cache import config_cache
+from utils.upload_store import UploadRequest, configure_uploads, content_hash, store_upload, upload_filename
+from utils.job_queue import (
+    requeue_stuck_submissions, drain_pipeline, park_submission_for_retry, queue_worker,
+    first_stage_for, advance_submission, save_artifact, load_artifact, DONE_STAGE
+)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 
 app = Flask(__name__)
 app.config.from_object(Config)
+# Uploaded photos are hashed and size-checked while they stream to disk
+app.request_class = UploadRequest
 
 app.jinja_env.filters['currency'] = format_currency
 
 # Configure the upload folder
 app.config['UPLOAD_FOLDER'] = os.path.join(Config.DATA_DIR, 'uploads')
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+configure_uploads(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_MAX_MB'] * 1024 * 1024)
 
 db.init_app(app)
 
+llm_scheduler.configure(app.config['LLM_RATE_LIMITS'], app.config['LLM_MAX_QUEUE_SECONDS'])
+configure_extraction_cache(app.config['EXTRACTION_CACHE_MAX_ENTRIES'], app.config['EXTRACTION_CACHE_MAX_AGE_DAYS'])
+configure_outbox(
+    app.config['OUTBOX_MAX_ATTEMPTS'], app.config['OUTBOX_RETRY_BASE_SECONDS'], app.config['OUTBOX_RETRY_MAX_SECONDS'],
+    app.config['OUTBOX_RETENTION_DAYS'], app.config['QUEUE_SWEEP_INTERVAL_SECONDS']
+)
+s3_sink.configure(app.config['S3_EXPORT_MODE'], app.config['S3_ENDPOINT_URL'])
+configure_change_feed(app.config['CHANGE_TOMBSTONE_RETENTION_DAYS'])
+config_cache.configure(app.config['CONFIG_CACHE_CHECK_SECONDS'])
+tra_client.configure(app.config['TRA_MAX_CONNECTIONS'], app.config['TRA_MAX_CONCURRENCY'], app.config['TRA_TIMEOUT_SECONDS'])
+configure_image_preprocessing(
+    app.config['IMAGE_PREPROCESS_WORKERS'], app.config['IMAGE_MAX_DIMENSION'],
+    app.config['IMAGE_GRAYSCALE'], app.config['IMAGE_JPEG_QUALITY']
+)
+configure_llm_clients(
+    timeout=app.config['LLM_TIMEOUT_SECONDS'], connect_timeout=app.config['LLM_CONNECT_TIMEOUT_SECONDS'],
+    max_connections=app.config['LLM_MAX_CONNECTIONS'], max_keepalive_connections=app.config['LLM_MAX_KEEPALIVE_CONNECTIONS']
+)
+
 # This function is correctly defined here, in main.py.
 def get_instance_config():
-    return InstanceConfig.query.first()
+    """A cached, read-only snapshot of the instance config (None before setup)."""
+    return config_cache.instance_config()
 
-# Create database tables and seed with dummy data for demo
-with app.app_context():
-    db.create_all()
+dashboard_stats.configure(app.config['DASHBOARD_STATS_TTL_SECONDS'])
+announcer.configure(app.config['SSE_REPLAY_BUFFER_SIZE'], app.config['SSE_CLIENT_MAX_PENDING'])
 
 # --- JOB PROCESSING LOGIC ---
 
-MAX_RETRIES = 9
-RETRY_DELAY_SECONDS = 60 # 1 minute
+MAX_RETRIES = 9 # Retries are parked with backoff, see FETCH_RETRY_* in config.py
 
 def safe_serialize(obj):
     """Safely serialize SQLAlchemy objects for JSON, handling dates."""
@@ -45,35 +88,34 @@ def safe_serialize(obj):
         return obj.isoformat()
     return str(obj)
 
-def prepare_submissions_for_frontend(submissions):
-    """Converts Submission objects into a JSON-serializable list of dictionaries."""
-    output = []
-    for sub in submissions:
-        receipt_data = {}
-        if sub.receipt:
-            receipt_data = {
-                "vendor_name": sub.receipt.vendor_name, "total_amount": sub.receipt.total_amount,
-                "vat_amount": sub.receipt.vat_amount, "receipt_date": sub.receipt.receipt_date.strftime('%Y-%m-%d') if sub.receipt.receipt_date else None,
-                "raw_llm_response": json.loads(sub.receipt.raw_llm_response) if sub.receipt.raw_llm_response else {}
-            }
-
-        # Transform photo path for frontend consumption
-        frontend_input_data = sub.input_data
-        if sub.input_type == 'photo':
-            # sub.input_data is the full path: /app/data/uploads/file.jpg
-            # We create a public URL: /uploads/file.jpg
-            filename = os.path.basename(sub.input_data)
-            frontend_input_data = url_for('uploaded_file', filename=filename)
-
-        data = {
-            "id": sub.id, "status": sub.status, "received_at": sub.received_at.isoformat(),
-            "input_type": sub.input_type, "input_data": frontend_input_data, # Use the transformed path
-            "description": sub.description, "location": sub.location,
-            "error_message": sub.error_message, "is_duplicate": sub.status == 'duplicate',
-            "receipt": receipt_data, "device_name": sub.device.name if sub.device else 'Unknown Device'
+def public_upload_url(path):
+    """The public URL of a stored photo, from the full path kept in submission.input_data."""
+    return url_for('uploaded_file', filename=upload_filename(path))
+
+def submission_detail(sub):
+    """One submission with its full receipt, for the dashboard's details modal."""
+    receipt_data = {}
+    if sub.receipt:
+        receipt_data = {
+            "vendor_name": sub.receipt.vendor_name, "total_amount": sub.receipt.total_amount,
+            "vat_amount": sub.receipt.vat_amount, "receipt_date": sub.receipt.receipt_date.strftime('%Y-%m-%d') if sub.receipt.receipt_date else None,
+            "raw_llm_response": json.loads(sub.receipt.raw_llm_response) if sub.receipt.raw_llm_response else {}
         }
-        output.append(data)
-    return json.dumps(output)
+
+    # Transform photo path for frontend consumption
+    frontend_input_data = sub.input_data
+    if sub.input_type == 'photo':
+        # sub.input_data is the full path: /app/data/uploads/ab/cd/abcd...jpg
+        # We create a public URL: /uploads/ab/cd/abcd...jpg
+        frontend_input_data = public_upload_url(sub.input_data)
+
+    return {
+        "id": sub.id, "status": sub.status, "received_at": sub.received_at.isoformat(),
+        "input_type": sub.input_type, "input_data": frontend_input_data, # Use the transformed path
+        "description": sub.description, "location": sub.location,
+        "error_message": sub.error_message, "is_duplicate": sub.status == 'duplicate',
+        "receipt": receipt_data, "device_name": sub.device.name if sub.device else 'Unknown Device'
+    }
 
 def clean_html_for_llm(html_content: str) -> str:
     """
@@ -98,7 +140,9 @@ def clean_html_for_llm(html_content: str) -> str:
 
 def fetch_receipt_html_from_tra(submission):
     """
-    Fetches receipt data, and now cleans the HTML before returning it.
+    Makes one attempt to fetch the receipt from TRA and returns the raw HTML.
+    If the receipt isn't available yet, the submission is parked for a later retry
+    (with exponential backoff) and None is returned, so the runner can move on.
     """
     url = submission.input_data
     match = re.search(r'_(\d{2})(\d{2})(\d{2})$', url)
@@ -109,45 +153,32 @@ def fetch_receipt_html_from_tra(submission):
     verify_url_base = 'https://verify.tra.go.tz'
     verify_url_with_secret = f"{verify_url_base}/Verify/Verified?Secret={secret_time}"
 
-    session = requests.Session()
-    session.headers.update({'User-Agent': 'Mozilla/5.0 TaxConsultAI/1.0'})
-
-    for i in range(submission.retry_count, MAX_RETRIES + 1):
-        try:
-            print(f"[Fetch] Attempt {i+1}/{MAX_RETRIES+1} for {url}")
-            initial_response = session.get(url, timeout=15)
-            initial_response.raise_for_status()
-            
-            html_response = session.get(verify_url_with_secret, timeout=15)
-            html_response.raise_for_status()
+    # Own cookies for this submission, shared keep-alive connections underneath.
+    session = tra_client.new_session()
 
-            if "Receipt not found" in html_response.text or html_response.status_code != 200:
-                 raise ValueError("Receipt not yet available on TRA portal.")
-
-            raw_html = html_response.text
-            print(f"[FetchSuccess] Successfully retrieved HTML (length: {len(raw_html)}).")
+    attempt = (submission.retry_count or 0) + 1
+    try:
+        print(f"[Fetch] Attempt {attempt}/{MAX_RETRIES+1} for {url}")
+        initial_response = tra_client.get(session, url)
+        initial_response.raise_for_status()
+        
+        html_response = tra_client.get(session, verify_url_with_secret)
+        html_response.raise_for_status()
 
-            # ---- NEW CLEANING STEP ----
-            cleaned_text = clean_html_for_llm(raw_html)
-            print(f"[Clean] HTML cleaned. New length: {len(cleaned_text)}.")
-            print(f"[Clean] Sample of cleaned text being sent to LLM:\n---\n{cleaned_text[:500]}...\n---")
+        if "Receipt not found" in html_response.text or html_response.status_code != 200:
+             raise ValueError("Receipt not yet available on TRA portal.")
 
-            return cleaned_text
+        raw_html = html_response.text
+        print(f"[FetchSuccess] Successfully retrieved HTML (length: {len(raw_html)}).")
+        return raw_html
 
-        except (requests.exceptions.RequestException, ValueError) as e:
-            # ... (error handling remains the same) ...
-            print(f"[FetchAttemptFailed] Attempt {i+1} failed: {e}")
-            submission.retry_count = i + 1
-            db.session.commit()
-            if i < MAX_RETRIES:
-                print(f"[FetchRetry] Waiting {RETRY_DELAY_SECONDS}s before next retry...")
-                time.sleep(RETRY_DELAY_SECONDS)
-            else:
-                print(f"[FetchFailed] Max retries reached for submission {submission.id}.")
-                submission.status = 'failed'
-                submission.error_message = f"Failed after {MAX_RETRIES+1} attempts: {e}"
-                db.session.commit()
-                return None
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[FetchAttemptFailed] Attempt {attempt} failed: {e}")
+        park_submission_for_retry(
+            submission, e, MAX_RETRIES,
+            current_app.config['FETCH_RETRY_BASE_SECONDS'], current_app.config['FETCH_RETRY_MAX_SECONDS']
+        )
+        return None
 
 def trigger_url_in_background(url_to_trigger):
     """
@@ -165,111 +196,264 @@ def trigger_url_in_background(url_to_trigger):
         print(f"[Trigger Error] Could not trigger task runner internally: {e}")
 
 def calculate_dashboard_stats():
-    """Calculates and returns the dashboard stats dictionary."""
-    now = datetime.utcnow()
-    periods = {
-        '24h': now - timedelta(hours=24), '7d': now - timedelta(days=7),
-        '4w': now - timedelta(weeks=4), '1y': now - timedelta(days=365)
-    }
-    stats = {
-        name: db.session.query(db.func.count(Receipt.id), db.func.sum(Receipt.total_amount))
-                        .filter(Receipt.processed_at >= start_time).one()
-        for name, start_time in periods.items()
-    }
-    return {key: {'count': value[0] or 0, 'total': value[1] or 0.0} for key, value in stats.items()}
+    """Returns the dashboard stats dictionary, from the rollup buckets (cached for a few seconds)."""
+    return dashboard_stats.get()
+
+def fail_submission(submission_id, error):
+    """Marks a submission as permanently failed and dispatches the failed event."""
+    db.session.rollback()  # IMPORTANT: Rollback the failed transaction to clean the session
+    
+    # We need to re-fetch the submission object as the session was rolled back
+    submission_to_update = db.session.get(Submission, submission_id)
+    if submission_to_update:
+        submission_to_update.status = 'failed'
+        submission_to_update.error_message = str(error)
+        advance_submission(submission_to_update, DONE_STAGE)
+        
+        # Dispatch failed event
+        payload = {"submission_id": submission_id, "status": "failed", "error_message": submission_to_update.error_message}
+        dispatch_event('submission.failed', payload, get_instance_config())
 
-def process_submission(submission):
+def pipeline_stage(stage_fn):
     """
-    Processes a single submission with deduplication logic and updates description from LLM.
+    Wraps a pipeline stage so an unexpected error fails that one submission
+    instead of killing the worker that runs it.
+    """
+    @wraps(stage_fn)
+    def run_stage(submission):
+        submission_id = submission.id
+        print(f"[Stage:{submission.stage}] Processing submission {submission_id} (Type: {submission.input_type})")
+        try:
+            stage_fn(submission)
+        except Exception as e:
+            print(f"[TaskError] Unhandled exception in stage '{stage_fn.__name__}' for submission {submission_id}: {e}")
+            fail_submission(submission_id, e)
+    return run_stage
+
+@pipeline_stage
+def preprocess_stage(submission):
+    """
+    Prepares an uploaded photo for the vision model: upright, downscaled and recompressed.
+    If the image can't be processed, the original is sent as it is.
     """
-    print(f"[TaskStart] Processing submission {submission.id} (Type: {submission.input_type})")
     try:
-        config = get_instance_config()
-        if not config or not config.is_configured():
-            raise ValueError("Instance is not configured with LLM provider and API key.")
-
-        content_for_llm, is_image = (None, False)
-        if submission.input_type == 'url':
-            content_for_llm = fetch_receipt_html_from_tra(submission)
-        elif submission.input_type == 'photo':
-            content_for_llm = submission.input_data
-            is_image = True
-        
-        if content_for_llm is None: return
+        processed_path = preprocess_receipt_image(submission.input_data)
+        print(f"[Preprocess] Photo reduced from {os.path.getsize(submission.input_data)} to {os.path.getsize(processed_path)} bytes.")
+        save_artifact(submission, 'processed_image', processed_path)
+    except Exception as e:
+        print(f"[Preprocess] Could not process photo for submission {submission.id}, using the original: {e}")
+    advance_submission(submission, 'extract')
+
+@pipeline_stage
+def fetch_stage(submission):
+    """Downloads the receipt page from TRA. Unpublished receipts are parked here for a retry."""
+    raw_html = fetch_receipt_html_from_tra(submission)
+    if raw_html is None: return
+
+    save_artifact(submission, 'tra_html', raw_html)
+    advance_submission(submission, 'clean')
+
+@pipeline_stage
+def clean_stage(submission):
+    """
+    Reduces the TRA page to plain receipt text and reads the structured fields from it.
+    Pages the parser doesn't recognise are left to the LLM.
+    """
+    cleaned_text = clean_html_for_llm(load_artifact(submission, 'tra_html'))
+    print(f"[Clean] HTML cleaned. New length: {len(cleaned_text)}.")
+    print(f"[Clean] Sample of cleaned text being sent to LLM:\n---\n{cleaned_text[:500]}...\n---")
+    save_artifact(submission, 'tra_text', cleaned_text)
+
+    parsed = parse_tra_receipt(cleaned_text, submission.input_data)
+    if parsed:
+        metrics.incr('tra_parser.parsed')
+        save_artifact(submission, 'tra_fields', json.dumps(parsed))
+    else:
+        metrics.incr('tra_parser.unrecognised')
+        print(f"[Clean] TRA page for submission {submission.id} not recognised; the LLM will extract it.")
+    advance_submission(submission, 'extract')
+
+def describe_parsed_receipt(parsed, config):
+    """
+    Completes locally parsed TRA fields with the LLM's description and tax analysis.
+    Returns None if that call fails, so the caller can fall back to a full extraction.
+    """
+    try:
+        analysis = describe_receipt(parsed['fields'], parsed['items'], config)
+    except LLMRateLimited:
+        raise
+    except Exception as e:
+        print(f"[Extract] Analysis call failed ({e}); falling back to full extraction.")
+        return None
+    metrics.incr('tra_parser.narrative_only')
+    return {**parsed['fields'], **analysis}
+
+@pipeline_stage
+def extract_stage(submission):
+    """
+    Calls the LLM on the cleaned text or the uploaded photo, unless the same content was seen before.
+    TRA pages the parser understood only need the LLM for the description and tax analysis.
+    """
+    config = get_instance_config()
+    if not config or not config.is_configured():
+        raise ValueError("Instance is not configured with LLM provider and API key.")
 
+    if submission.input_type == 'photo':
+        content_for_llm = load_artifact(submission, 'processed_image', required=False) or submission.input_data
+        is_image, parsed = True, None
+    else:
+        content_for_llm, is_image = load_artifact(submission, 'tra_text'), False
+        parsed_fields = load_artifact(submission, 'tra_fields', required=False)
+        parsed = json.loads(parsed_fields) if parsed_fields else None
+
+    # A receipt we already have only needs its code for persist to mark it a duplicate.
+    if parsed and Receipt.query.filter_by(receipt_verification_code=parsed['fields']['receipt_verification_code']).first():
+        print(f"[Extract] Receipt {parsed['fields']['receipt_verification_code']} already stored; skipping the LLM.")
+        save_artifact(submission, 'extracted_data', json.dumps(parsed['fields']))
+        advance_submission(submission, 'persist')
+        return
+
+    # Re-sent photos, re-scanned QR codes and reprocessing reuse an earlier extraction.
+    model = select_model(config.llm_provider, is_image)
+    cache_key = extraction_cache_key(content_for_llm, is_image, config.llm_provider, model)
+    extracted_data = get_cached_extraction(cache_key)
+
+    if extracted_data is None:
         # --- Call LLM Processor ---
-        extracted_data = extract_receipt_details(content_for_llm, is_image, config)
-        
-        # --- Deduplication Logic ---
-        verification_code = extracted_data.get('receipt_verification_code')
-        # Only check for duplicates if the code is a meaningful, non-empty string.
-        if verification_code and verification_code.strip():
-            existing_receipt = Receipt.query.filter_by(receipt_verification_code=verification_code).first()
-            if existing_receipt:
-                print(f"[TaskSkip] Duplicate receipt found with code {verification_code}. Original sub ID: {existing_receipt.submission_id}")
-                submission.status = 'duplicate'
-                submission.error_message = f"Duplicate of submission ID {existing_receipt.submission_id}"
-                db.session.commit()
-                # Dispatch duplicate event and exit cleanly
-                payload = {"submission_id": submission.id, "status": "duplicate", "error_message": submission.error_message}
-                dispatch_event('submission.duplicate', payload, config)
-                return
-        
-       # --- Update Description, Parse Date, etc. ---
-        llm_desc = extracted_data.get('llm_extracted_description')
-        if llm_desc:
-            submission.description = llm_desc
-        
-        receipt_date_obj = None
-        if extracted_data.get('receipt_date'):
-            try:
-                receipt_date_obj = date.fromisoformat(extracted_data['receipt_date'])
-            except (ValueError, TypeError):
-                print(f"Warning: Could not parse date '{extracted_data.get('receipt_date')}'")
-
-        # Convert empty verification code string to None to avoid UNIQUE constraint violation on ""
-        db_verification_code = verification_code if (verification_code and verification_code.strip()) else None
-
-        new_receipt = Receipt(
-            vendor_name=extracted_data.get('vendor_name'), vendor_tin=extracted_data.get('vendor_tin'),
-            vendor_phone=extracted_data.get('vendor_phone'), vrn=extracted_data.get('vrn'),
-            receipt_verification_code=db_verification_code, receipt_number=extracted_data.get('receipt_number'),
-            uin=extracted_data.get('uin'), customer_name=extracted_data.get('customer_name'),
-            customer_id_type=extracted_data.get('customer_id_type'), customer_id=extracted_data.get('customer_id'),
-            total_amount=extracted_data.get('total_amount'), vat_amount=extracted_data.get('vat_amount'),
-            receipt_date=receipt_date_obj, raw_llm_response=json.dumps(extracted_data),
-            device_id=submission.device_id, submission_id=submission.id
-        )
-        db.session.add(new_receipt)
-        submission.status = 'completed'
-        db.session.commit()
+        try:
+            if parsed:
+                extracted_data = describe_parsed_receipt(parsed, config)
+            if extracted_data is None:
+                extracted_data = extract_receipt_details(content_for_llm, is_image, config)
+        except LLMRateLimited as e:
+            # The provider is throttling us: try this job again later rather than failing it.
+            park_submission_for_retry(
+                submission, e, MAX_RETRIES,
+                current_app.config['FETCH_RETRY_BASE_SECONDS'], current_app.config['FETCH_RETRY_MAX_SECONDS'],
+                min_delay_seconds=e.retry_after
+            )
+            return
+        store_extraction(cache_key, model, extracted_data)
+
+    save_artifact(submission, 'extracted_data', json.dumps(extracted_data))
+    advance_submission(submission, 'persist')
+
+@pipeline_stage
+def persist_stage(submission):
+    """
+    Saves the extracted receipt, with deduplication logic, and updates the description from the LLM.
+    """
+    extracted_data = json.loads(load_artifact(submission, 'extracted_data'))
+
+    # --- Deduplication Logic ---
+    verification_code = extracted_data.get('receipt_verification_code')
+    # Only check for duplicates if the code is a meaningful, non-empty string.
+    if verification_code and verification_code.strip():
+        existing_receipt = Receipt.query.filter_by(receipt_verification_code=verification_code).first()
+        if existing_receipt:
+            print(f"[TaskSkip] Duplicate receipt found with code {verification_code}. Original sub ID: {existing_receipt.submission_id}")
+            submission.status = 'duplicate'
+            submission.error_message = f"Duplicate of submission ID {existing_receipt.submission_id}"
+            advance_submission(submission, 'export')
+            return
+    
+   # --- Update Description, Parse Date, etc. ---
+    llm_desc = extracted_data.get('llm_extracted_description')
+    if llm_desc:
+        submission.description = llm_desc
+    
+    receipt_date_obj = None
+    if extracted_data.get('receipt_date'):
+        try:
+            receipt_date_obj = date.fromisoformat(extracted_data['receipt_date'])
+        except (ValueError, TypeError):
+            print(f"Warning: Could not parse date '{extracted_data.get('receipt_date')}'")
+
+    # Convert empty verification code string to None to avoid UNIQUE constraint violation on ""
+    db_verification_code = verification_code if (verification_code and verification_code.strip()) else None
+
+    new_receipt = Receipt(
+        vendor_name=extracted_data.get('vendor_name'), vendor_tin=extracted_data.get('vendor_tin'),
+        vendor_phone=extracted_data.get('vendor_phone'), vrn=extracted_data.get('vrn'),
+        receipt_verification_code=db_verification_code, receipt_number=extracted_data.get('receipt_number'),
+        uin=extracted_data.get('uin'), customer_name=extracted_data.get('customer_name'),
+        customer_id_type=extracted_data.get('customer_id_type'), customer_id=extracted_data.get('customer_id'),
+        total_amount=extracted_data.get('total_amount'), vat_amount=extracted_data.get('vat_amount'),
+        receipt_date=receipt_date_obj, raw_llm_response=json.dumps(extracted_data),
+        device_id=submission.device_id, submission_id=submission.id
+    )
+    db.session.add(new_receipt)
+    submission.status = 'completed'
+    advance_submission(submission, 'export')
+
+@pipeline_stage
+def export_stage(submission):
+    """Dispatches the outcome of a submission to the dashboard and export destinations."""
+    config = get_instance_config()
+
+    if submission.status == 'duplicate':
+        payload = {"submission_id": submission.id, "status": "duplicate", "error_message": submission.error_message}
+        dispatch_event('submission.duplicate', payload, config)
+    else:
         # --- Dispatch COMPLETED event ---
+        receipt = submission.receipt
         updated_stats = calculate_dashboard_stats()
         payload = {
             "submission_id": submission.id, "status": submission.status, 
-            "processed_at": new_receipt.processed_at.isoformat(), "data": extracted_data,
+            "processed_at": receipt.processed_at.isoformat(), "data": json.loads(receipt.raw_llm_response),
             "stats": updated_stats
         }
         dispatch_event('submission.processed', payload, config)
 
-        print(f"[TaskSuccess] Submission {submission.id} completed.")
+    advance_submission(submission, DONE_STAGE)
+    print(f"[TaskSuccess] Submission {submission.id} {submission.status}.")
 
-    except Exception as e:
-        # --- FIX #2: Resilient Error Handling ---
-        # This block ensures a single failed job doesn't kill the whole queue runner.
-        print(f"[TaskError] Unhandled exception in process_submission {submission.id}: {e}")
-        db.session.rollback()  # IMPORTANT: Rollback the failed transaction to clean the session
-        
-        # We need to re-fetch the submission object as the session was rolled back
-        submission_to_update = Submission.query.get(submission.id)
-        if submission_to_update:
-            submission_to_update.status = 'failed'
-            submission_to_update.error_message = str(e)
-            db.session.commit()
-            
-            # Dispatch failed event
-            payload = {"submission_id": submission.id, "status": "failed", "error_message": submission_to_update.error_message}
-            dispatch_event('submission.failed', payload, get_instance_config())
+PIPELINE_HANDLERS = {
+    'preprocess': preprocess_stage, 'fetch': fetch_stage, 'clean': clean_stage, 'extract': extract_stage,
+    'persist': persist_stage, 'export': export_stage
+}
+# Housekeeping run with every queue sweep (and /tasks/run), never on a dashboard read.
+MAINTENANCE_TASKS = (prune_hourly_buckets,)
+
+_services = {'started': False}
+
+def start_services():
+    """
+    Prepares the database and starts this process's background work (queue worker,
+    outbox delivery, SSE tailer). Called once by each serving process: gunicorn's
+    post_worker_init hook (gunicorn.conf.py), or wsgi.py when run directly. Importing
+    main does none of this, so the image preprocessing pool's spawned children, which
+    re-import the parent's __main__, don't boot a second copy of the app.
+    """
+    if _services['started']:
+        return
+    _services['started'] = True
+
+    # Create database tables and seed with dummy data for demo
+    with app.app_context():
+        read_engine = configure_sqlite(
+            app, app.config['SQLITE_BUSY_TIMEOUT_MS'], app.config['SQLITE_SYNCHRONOUS'], app.config['SQLITE_CACHE_SIZE_MB'],
+            app.config['SQLITE_MMAP_SIZE_MB'], app.config['SQLITE_READ_POOL_SIZE'],
+            app.config['DB_OFFLOAD_READS'], app.config['DB_OFFLOAD_WRITES']
+        )
+        if app.config['REQUEST_TIMING_ENABLED']:
+            hub_monitor.install(app, [db.engine, read_engine], app.config['HUB_BLOCKING_LOG_MS'])
+        write_batcher.start(db.engine, app.config['WRITE_BATCH_MAX_STATEMENTS'], app.config['WRITE_BATCH_WINDOW_MS'] / 1000)
+        db.create_all()
+        upgrade_schema(db)
+        backfill_stat_buckets()
+
+    # Start the resident queue worker. Intake wakes it up directly; /tasks/run stays
+    # available for external cron jobs and the optional HTTP trigger.
+    if app.config['QUEUE_WORKER_ENABLED']:
+        queue_worker.start(app, PIPELINE_HANDLERS, app.config['STAGE_CONCURRENCY'], app.config['QUEUE_SWEEP_INTERVAL_SECONDS'],
+                           maintenance=MAINTENANCE_TASKS)
+
+    # Export destinations are fed from the outbox by their own delivery workers.
+    outbox_worker.start(app, build_sinks(app.config), get_instance_config, enabled_destinations)
+    if app.config['SSE_BACKEND'] == 'eventlog':
+        announcer.use_event_log(EventLog(app.config['SSE_EVENTS_DB'], app.config['SSE_EVENT_RETENTION_SECONDS']),
+                                poll_interval=app.config['SSE_POLL_INTERVAL_SECONDS'])
 
 # --- WEB ROUTES & AUTH ---
 
@@ -282,6 +466,19 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def login_or_device_required(f):
+    """For the sync API: a logged-in dashboard, or an app/poller sending a device API key as a Bearer token."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('admin_logged_in'):
+            auth_header = request.headers.get('Authorization')
+            if not auth_header or not auth_header.startswith('Bearer '):
+                return jsonify({'error': 'Log in, or send a device API key in the Authorization header'}), 401
+            if not config_cache.device_for_key(auth_header.split(' ')[1]):
+                return jsonify({'error': 'Invalid device API key'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 @app.route('/')
 @login_required
 def index():
@@ -294,13 +491,12 @@ def index():
 
     stats = calculate_dashboard_stats()
     
-    # Alpine.js handles all filtering.
-    submissions = Submission.query.order_by(Submission.received_at.desc()).all()
-    submissions_json = prepare_submissions_for_frontend(submissions)
+    # The table itself is paged in by the dashboard from /api/submissions.
+    has_submissions = db.session.query(Submission.id).first() is not None
     
     return render_template('index.html', 
                            stats=stats, 
-                           submissions_json=submissions_json,
+                           has_submissions=has_submissions,
                            # Pass URL params to the template for initialization
                            search_query=search_query,
                            start_date=start_date_str,
@@ -345,6 +541,7 @@ def setup_verify():
             new_config = InstanceConfig(admin_email=email, totp_secret=totp_secret)
             db.session.add(new_config)
             db.session.commit()
+            config_cache.invalidate()
             
             session.pop('setup_email', None)
             session.pop('setup_totp_secret', None)
@@ -409,7 +606,8 @@ def admin_logout():
 @app.route('/admin/configure', methods=['GET', 'POST'])
 @login_required
 def configure_instance():
-    config = get_instance_config()
+    # The live row, not the cached snapshot: this page edits it.
+    config = InstanceConfig.query.first()
     
     if request.method == 'POST':
         # Get the active tab from a hidden input in the form
@@ -427,6 +625,10 @@ def configure_instance():
         config.s3_region = request.form.get('s3_region')
         
         db.session.commit()
+        config_cache.invalidate()
+        outbox_worker.wake()  # Resume destinations that were paused while not configured
+        # Drop pooled LLM clients so the next job picks up a changed provider or key.
+        reset_llm_clients()
         flash('Configuration saved successfully!', 'success')
         
         # Redirect back to the configuration page, passing the active tab as a URL parameter
@@ -449,6 +651,7 @@ def add_device():
     new_device = Device(name=device_name)
     db.session.add(new_device)
     db.session.commit()
+    config_cache.invalidate()
     flash(f'Device "{device_name}" added successfully.', 'success')
     return redirect(url_for('configure_instance'))
 
@@ -459,10 +662,41 @@ def add_device():
 @login_required
 def queue_status():
     """Displays pending jobs and provides a manual trigger."""
-    pending_jobs = Submission.query.filter_by(status='queued').order_by(Submission.received_at.asc()).all()
+    pending_jobs = Submission.query.filter(Submission.stage != DONE_STAGE).order_by(Submission.received_at.asc()).all()
     # Pass the secret key to the template so the button URL can be built securely
     runner_secret = current_app.config['TASK_RUNNER_SECRET_KEY']
-    return render_template('admin/queue.html', jobs=pending_jobs, runner_secret=runner_secret)
+    return render_template('admin/queue.html', jobs=pending_jobs, runner_secret=runner_secret, outbox=outbox_counts())
+
+@app.route('/admin/outbox/retry', methods=['POST'])
+@login_required
+def retry_outbox():
+    """Puts dead-lettered export events back in line for delivery."""
+    revived = retry_dead_events()
+    flash(f'Re-queued {revived} failed export event(s).', 'success')
+    return redirect(url_for('queue_status'))
+
+@app.route('/admin/archive/<int:submission_id>')
+@login_required
+def archived_submission_events(submission_id):
+    """
+    A submission's exported events from the S3 archive (S3_EXPORT_MODE=archive), as JSON.
+    Only the archives of one day are searched: ?day=YYYY-MM-DD, today (UTC) by default.
+    """
+    config = get_instance_config()
+    if not config or 's3' not in enabled_destinations(config):
+        return jsonify({'error': 'S3 export is not configured'}), 400
+    try:
+        day = date.fromisoformat(request.args['day']) if request.args.get('day') else datetime.utcnow().date()
+    except ValueError:
+        return jsonify({'error': 'day must be YYYY-MM-DD'}), 400
+    return jsonify({'submission_id': submission_id, 'day': day.isoformat(),
+                    'events': s3_sink.find_archived_events(config, submission_id, day)})
+
+@app.route('/admin/metrics')
+@login_required
+def metrics_snapshot():
+    """Process-local counters for the queue, LLM scheduler and caches, as JSON."""
+    return jsonify(metrics.snapshot())
 
 @app.route('/receipt', methods=['POST'])
 def receipt_endpoint():
@@ -476,11 +710,14 @@ def receipt_endpoint():
         return jsonify({'error': 'Authorization header is missing or invalid'}), 401
     
     device_key = auth_header.split(' ')[1]
-    device = Device.query.filter_by(api_key=device_key).first()
+    device = config_cache.device_for_key(device_key)
     if not device:
         return jsonify({'error': 'Invalid device API key'}), 403
 
-    receipt_photo = request.files.get('receiptphoto')
+    try:
+        receipt_photo = request.files.get('receiptphoto')
+    except RequestEntityTooLarge as e:
+        return jsonify({'error': e.description}), 413
     receipt_url = request.form.get('receipturl')
     if not receipt_photo and not receipt_url:
         return jsonify({'error': '`receiptphoto` (file) or `receipturl` (form field) is required'}), 400
@@ -494,17 +731,22 @@ def receipt_endpoint():
     # This will be the path sent to the frontend via SSE.
     frontend_input_data = ''
 
+    photo_hash = None
     if receipt_photo:
         input_type = 'photo'
-        filename = secure_filename(f"{datetime.utcnow().timestamp()}_{receipt_photo.filename}")
-        
-        # The full, absolute path for backend processing.
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        receipt_photo.save(filepath)
+        photo_hash = content_hash(receipt_photo)
+        # The same photo sent again (a retrying app, a double tap) joins the submission
+        # that already has it instead of being stored and extracted a second time.
+        existing = live_submission_for_photo(photo_hash)
+        if existing:
+            return duplicate_photo_response(existing)
+
+        # The full, absolute path for backend processing, named after the content.
+        filepath = store_upload(receipt_photo, photo_hash)
         
         # Set the two different paths for their specific purposes.
         db_input_data = filepath
-        frontend_input_data = url_for('uploaded_file', filename=filename)
+        frontend_input_data = public_upload_url(filepath)
 
     elif receipt_url:
         input_type = 'url'
@@ -513,12 +755,22 @@ def receipt_endpoint():
         frontend_input_data = receipt_url
 
     new_submission = Submission(
-        device_id=device.id, input_type=input_type,
+        device_id=device.id, input_type=input_type, stage=first_stage_for(input_type),
         input_data=db_input_data, # Save the full filesystem path to the DB
+        content_hash=photo_hash,
         description=description, location=location
     )
     db.session.add(new_submission)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same photo arrived twice at once and the other request inserted first
+        # (see uq_submission_content_hash_live).
+        db.session.rollback()
+        existing = live_submission_for_photo(photo_hash) if photo_hash else None
+        if existing is None:
+            raise
+        return duplicate_photo_response(existing)
     
     config = get_instance_config()
     payload = {
@@ -530,64 +782,101 @@ def receipt_endpoint():
     }
     dispatch_event('submission.queued', payload, config)
     
-    runner_secret = current_app.config['TASK_RUNNER_SECRET_KEY']
-    runner_url = url_for('run_tasks', secret=runner_secret, _external=True)
-    gevent.spawn(trigger_url_in_background, runner_url)
+    # Wake the in-process worker so processing starts immediately.
+    queue_worker.wake()
+
+    if current_app.config['TASK_RUNNER_HTTP_TRIGGER']:
+        runner_secret = current_app.config['TASK_RUNNER_SECRET_KEY']
+        runner_url = url_for('run_tasks', secret=runner_secret, _external=True)
+        gevent.spawn(trigger_url_in_background, runner_url)
     
     return jsonify({ "message": "Receipt accepted and queued for processing.", "submission_id": new_submission.id }), 202
 
+def live_submission_for_photo(photo_hash):
+    """The submission that holds this photo, unless it failed (then the photo may be sent again)."""
+    return Submission.query.filter(
+        Submission.content_hash == photo_hash, Submission.status != 'failed'
+    ).order_by(Submission.id.asc()).first()
+
+def duplicate_photo_response(existing):
+    metrics.incr('uploads.duplicate_submissions')
+    return jsonify({
+        "message": "This photo was already received.", "submission_id": existing.id, "duplicate": True
+    }), 200
+
 @app.route('/tasks/run', methods=['GET'])
 def run_tasks():
     secret = request.args.get('secret')
     if secret != app.config['TASK_RUNNER_SECRET_KEY']:
         return jsonify({"error": "Unauthorized"}), 403
 
-    # --- NEW: Self-healing logic for stuck jobs ---
-    # Find jobs stuck in 'processing' for more than 10 minutes and requeue them.
-    ten_minutes_ago = datetime.utcnow() - timedelta(minutes=10)
-    stuck_jobs = Submission.query.filter(
-        Submission.status == 'processing',
-        Submission.received_at < ten_minutes_ago # Using received_at as a proxy for start time
-    ).all()
-
-    for job in stuck_jobs:
-        print(f"[Heal] Found stuck job {job.id}. Re-queueing.")
-        job.status = 'queued'
-        job.error_message = "Rescued from stuck 'processing' state."
-    
-    if stuck_jobs:
-        db.session.commit()
+    # --- Self-healing logic for stuck jobs ---
+    # Jobs left in 'processing' by a runner that died are put back in the queue.
+    rescued_count = requeue_stuck_submissions()
+    for task in MAINTENANCE_TASKS:
+        task()
 
-    processed_jobs = []
-    # Process all queued jobs
-    while True:
-        # Find one pending job (this will now include any rescued jobs)
-        job = Submission.query.filter_by(status='queued').order_by(Submission.received_at.asc()).first()
-        if not job:
-            break
-
-        job.status = 'processing'
-        # Clear any previous error messages before processing
-        job.error_message = None 
-        db.session.commit()
-        
-        process_submission(job)
-        
-        final_status = Submission.query.get(job.id)
-        processed_jobs.append({
-            "id": job.id,
-            "final_status": final_status.status,
-            "error_message": final_status.error_message
-        })
-
-    if not processed_jobs and not stuck_jobs:
+    # Run every pipeline stage (including rescued jobs), each with its own concurrency.
+    # Jobs are claimed atomically, so overlapping runs never process the same row.
+    stage_runs = drain_pipeline(app, PIPELINE_HANDLERS, app.config['STAGE_CONCURRENCY'])
+
+    if not stage_runs and not rescued_count:
         return jsonify({"message": "No pending or stuck jobs to process."}), 200
     
     return jsonify({
-        "message": f"Processed {len(processed_jobs)} job(s). Rescued {len(stuck_jobs)} stuck job(s).",
-        "processed_details": processed_jobs
+        "message": f"Ran {len(stage_runs)} pipeline stage(s). Rescued {rescued_count} stuck job(s).",
+        "processed_details": stage_runs
     }), 200
 
+@app.route('/api/submissions')
+@login_required
+def api_submissions():
+    """
+    One page of the dashboard table. Filters (tab, search, start_date, end_date) and
+    sorting (sort, direction) are applied in SQL; pass the returned next_cursor back
+    as `cursor` for the following page. The first page also carries the insights totals
+    and the stat cards.
+    """
+    try:
+        filters = parse_submission_filters(request.args)
+        page = fetch_submissions_page(filters, public_upload_url)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not filters['cursor']:
+        page['stats'] = calculate_dashboard_stats()
+    return jsonify(page)
+
+@app.route('/api/submissions/<int:submission_id>')
+@login_required
+def api_submission_detail(submission_id):
+    sub = read_session.get(Submission, submission_id, options=[joinedload(Submission.receipt), joinedload(Submission.device)])
+    if not sub:
+        return jsonify({'error': 'Submission not found'}), 404
+    return jsonify(submission_detail(sub))
+
+@app.route('/api/changes')
+@login_or_device_required
+def api_changes():
+    """
+    Delta sync: submissions changed since `cursor` (with their receipt) and the ids of
+    deleted ones, up to `limit` per call. Start without a cursor, then keep passing
+    back the returned one, right away while has_more is true and on a timer after.
+    An unchanged state answers If-None-Match with 304 before any query runs.
+    """
+    try:
+        cursor, limit = parse_change_params(request.args)
+        state = change_state()
+        etag = changes_etag(state, cursor, limit)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(fetch_changes(cursor, limit, state, public_upload_url))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/uploads/<path:filename>')
 @login_required
 def uploaded_file(filename):
@@ -598,83 +887,45 @@ def uploaded_file(filename):
         as_attachment=False # Display in browser instead of downloading
     )
 
-@app.route('/export/csv')
+@app.route('/export/<any(csv, ndjson, xlsx):export_format>')
 @login_required
-def export_csv():
-    search_query = request.args.get('search', '').lower()
-    start_date_str = request.args.get('start_date', '')
-    end_date_str = request.args.get('end_date', '')
-
-    query = Receipt.query.join(Submission).filter(Submission.status == 'completed')
-
+def export_receipts(export_format):
+    """
+    Streams completed receipts as CSV, NDJSON or XLSX. Filters and search run in SQL
+    and rows are read in batches, so a full-year export starts right away and uses
+    little memory. CSV and NDJSON are gzipped for clients that accept it.
+    """
+    search_query = request.args.get('search', '').strip()
     try:
-        if start_date_str:
-            start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-            query = query.filter(Receipt.receipt_date >= start_date)
-        if end_date_str:
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-            query = query.filter(Receipt.receipt_date <= end_date)
+        start_date = date.fromisoformat(request.args['start_date']) if request.args.get('start_date') else None
+        end_date = date.fromisoformat(request.args['end_date']) if request.args.get('end_date') else None
     except ValueError:
         flash('Invalid date format provided for export.', 'danger')
         return redirect(url_for('index'))
-    
-    # --- MODIFIED: Added .options() for eager loading of the 'submission' relationship ---
-    query = query.options(joinedload(Receipt.submission))
 
-    receipts = query.order_by(Receipt.receipt_date.desc()).all()
-    
-    if search_query:
-        filtered_receipts = []
-        for receipt in receipts:
-            vendor_match = receipt.vendor_name and search_query in receipt.vendor_name.lower()
-            desc_match = receipt.submission.description and search_query in receipt.submission.description.lower()
-            if vendor_match or desc_match:
-                filtered_receipts.append(receipt)
-        receipts = filtered_receipts
-
-    def generate():
-        data = io.StringIO()
-        writer = csv.writer(data)
-        header = [
-            'ID', 'Status', 'Received At', 'Processed At', 'Vendor', 'Vendor TIN', 'VRN',
-            'Receipt No', 'Verification Code', 'Receipt Date', 'Total Amount', 'VAT Amount', 
-            'LLM Description', 'Tax Analysis', 'Customer Name', 'Customer ID'
-        ]
-        writer.writerow(header)
-        yield data.getvalue()
-        data.seek(0)
-        data.truncate(0)
-
-        # This will now work because receipt.submission was pre-loaded.
-        for receipt in receipts:
-            raw_response = json.loads(receipt.raw_llm_response or '{}')
-            row = [
-                receipt.submission_id, 'completed', receipt.submission.received_at.strftime('%Y-%m-%d %H:%M:%S'),
-                receipt.processed_at.strftime('%Y-%m-%d %H:%M:%S'), receipt.vendor_name, receipt.vendor_tin,
-                receipt.vrn, receipt.receipt_number, receipt.receipt_verification_code, receipt.receipt_date,
-                receipt.total_amount, receipt.vat_amount, receipt.submission.description,
-                raw_response.get('llm_tax_analysis', ''), receipt.customer_name, receipt.customer_id
-            ]
-            writer.writerow(row)
-            yield data.getvalue()
-            data.seek(0)
-            data.truncate(0)
-
-    response = Response(generate(), mimetype='text/csv')
+    chunks = FORMAT_WRITERS[export_format](export_rows(search_query, start_date, end_date))
+    headers = {}
+    if export_format != 'xlsx':  # XLSX is a zip already
+        headers['Vary'] = 'Accept-Encoding'
+        if 'gzip' in request.accept_encodings:
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    response.headers["Content-Disposition"] = f'attachment; filename="receipts_export_{timestamp}.csv"'
-    
-    return response
+    headers["Content-Disposition"] = f'attachment; filename="receipts_export_{timestamp}.{export_format}"'
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format], headers=headers)
 
 @app.route('/stream')
 @login_required
 def stream():
-    """This endpoint holds open a connection and streams updates."""
-    def event_stream():
-        # Listen to the announcer and yield messages
-        messages = announcer.listen()
-        while True:
-            msg = next(messages)
-            yield msg
-    
-    return app.response_class(event_stream(), mimetype='text/event-stream')
\ No newline at end of file
+    """
+    This endpoint holds open a connection and streams updates. Browsers reconnect
+    with a Last-Event-ID header and are sent the events they missed.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    # Listen to the announcer and yield messages
+    return app.response_class(announcer.listen(last_event_id), mimetype='text/event-stream')
\ No newline at end of file
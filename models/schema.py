@@ -0,0 +1,206 @@
+# models/schema.py
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+def upgrade_schema(db):
+    """
+    Brings an existing database up to date with the models.
+    `db.create_all()` only creates missing tables, so columns and indexes added
+    to a model after its table was first created are added here instead.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                print(f"[Schema] Added column {table.name}.{column.name}")
+            except OperationalError as e:
+                # Another worker process may have added it a moment ago.
+                print(f"[Schema] Skipped column {table.name}.{column.name}: {e}")
+
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except IntegrityError as e:
+                # A unique index over rows that already repeat; the app still checks in code.
+                print(f"[Schema] Skipped index {index.name}, existing rows conflict: {e.orig}")
+
+    backfill_submission_stages(engine)
+    install_receipt_stat_triggers(engine)
+    install_search_index(engine)
+    install_change_tracking(engine)
+    install_config_versioning(engine)
+
+def backfill_submission_stages(engine):
+    """
+    Gives submissions created before the staged pipeline a stage to resume from.
+    Unfinished jobs restart from their first stage; everything else is done.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("""
+            UPDATE submission
+               SET stage = CASE WHEN status IN ('queued', 'processing')
+                                THEN (CASE input_type WHEN 'photo' THEN 'extract' ELSE 'fetch' END)
+                                ELSE 'done' END,
+                   status = CASE WHEN status = 'processing' THEN 'queued' ELSE status END,
+                   claimed_at = NULL
+             WHERE stage IS NULL
+        """))
+
+# strftime formats matching how SQLAlchemy stores DateTime values in SQLite
+STAT_BUCKET_FORMATS = {'hour': '%Y-%m-%d %H:00:00.000000', 'day': '%Y-%m-%d 00:00:00.000000'}
+
+def _bump_stat_buckets(row, sign):
+    """Trigger statements adding (sign=+1) or removing (sign=-1) a receipt row from its buckets."""
+    return ''.join(f"""
+        INSERT INTO receipt_stat_bucket (granularity, bucket_start, receipt_count, total_amount)
+        VALUES ('{granularity}', strftime('{fmt}', {row}.processed_at), {sign}, {sign} * coalesce({row}.total_amount, 0))
+        ON CONFLICT (granularity, bucket_start) DO UPDATE
+           SET receipt_count = receipt_count + excluded.receipt_count,
+               total_amount = total_amount + excluded.total_amount;""" for granularity, fmt in STAT_BUCKET_FORMATS.items())
+
+def install_receipt_stat_triggers(engine):
+    """
+    (Re)creates the triggers that keep receipt_stat_bucket in step with the receipt
+    table. Replaced in one transaction, so no insert slips through in between.
+    """
+    triggers = {
+        'receipt_stats_insert': f"AFTER INSERT ON receipt BEGIN {_bump_stat_buckets('NEW', 1)} END",
+        'receipt_stats_delete': f"AFTER DELETE ON receipt BEGIN {_bump_stat_buckets('OLD', -1)} END",
+        'receipt_stats_update': f"AFTER UPDATE OF processed_at, total_amount ON receipt BEGIN "
+                                f"{_bump_stat_buckets('OLD', -1)} {_bump_stat_buckets('NEW', 1)} END",
+    }
+    with engine.begin() as conn:
+        for name, body in triggers.items():
+            conn.execute(text(f'DROP TRIGGER IF EXISTS "{name}"'))
+            conn.execute(text(f'CREATE TRIGGER "{name}" {body}'))
+
+SEARCH_TABLE = 'submission_search'
+SEARCH_COLUMNS = ('vendor_name', 'vendor_ids', 'receipt_number', 'description', 'llm_description', 'tax_analysis')
+
+def _search_row_select(where):
+    """The searchable text of submissions matching `where`, as rows for the search table (rowid = submission id)."""
+    return f"""
+        SELECT s.id, r.vendor_name, trim(coalesce(r.vendor_tin, '') || ' ' || coalesce(r.vrn, '')), r.receipt_number, s.description,
+               CASE WHEN json_valid(r.raw_llm_response) THEN json_extract(r.raw_llm_response, '$.llm_extracted_description') END,
+               CASE WHEN json_valid(r.raw_llm_response) THEN json_extract(r.raw_llm_response, '$.llm_tax_analysis') END
+          FROM submission s LEFT JOIN receipt r ON r.submission_id = s.id
+         WHERE {where}"""
+
+def _refresh_search_row(submission_id):
+    return f"""
+        DELETE FROM {SEARCH_TABLE} WHERE rowid = {submission_id};
+        INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(SEARCH_COLUMNS)}) {_search_row_select(f's.id = {submission_id}')};"""
+
+def install_search_index(engine):
+    """
+    Creates the FTS5 index over submissions and their receipts, with triggers that
+    keep it in step with both tables, and fills it for rows that predate it.
+    Returns False if this SQLite build has no FTS5 (search then falls back to LIKE).
+    """
+    triggers = {
+        'submission_search_insert': f"AFTER INSERT ON submission BEGIN {_refresh_search_row('NEW.id')} END",
+        'submission_search_update': f"AFTER UPDATE OF description ON submission BEGIN {_refresh_search_row('NEW.id')} END",
+        'submission_search_delete': f"AFTER DELETE ON submission BEGIN DELETE FROM {SEARCH_TABLE} WHERE rowid = OLD.id; END",
+        'receipt_search_insert': f"AFTER INSERT ON receipt BEGIN {_refresh_search_row('NEW.submission_id')} END",
+        'receipt_search_update': f"AFTER UPDATE ON receipt BEGIN {_refresh_search_row('OLD.submission_id')} {_refresh_search_row('NEW.submission_id')} END",
+        'receipt_search_delete': f"AFTER DELETE ON receipt BEGIN {_refresh_search_row('OLD.submission_id')} END",
+    }
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+                f"{', '.join(SEARCH_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            ))
+            for name, body in triggers.items():
+                conn.execute(text(f'DROP TRIGGER IF EXISTS "{name}"'))
+                conn.execute(text(f'CREATE TRIGGER "{name}" {body}'))
+            # Backfill submissions from before the index existed (a no-op once it is populated)
+            missing = conn.execute(text(
+                f"SELECT count(*) FROM submission WHERE id NOT IN (SELECT rowid FROM {SEARCH_TABLE})"
+            )).scalar()
+            if missing:
+                conn.execute(text(
+                    f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(SEARCH_COLUMNS)}) "
+                    f"{_search_row_select(f's.id NOT IN (SELECT rowid FROM {SEARCH_TABLE})')}"
+                ))
+                print(f"[Schema] Indexed {missing} submission(s) for search.")
+    except OperationalError as e:
+        print(f"[Schema] Full-text search unavailable, falling back to LIKE: {e}")
+        return False
+    return True
+
+# Submission columns whose changes clients syncing through /api/changes need to see
+# (not the pipeline's bookkeeping: stage, claimed_at, retries).
+TRACKED_SUBMISSION_COLUMNS = ('received_at', 'status', 'input_type', 'input_data', 'description', 'location', 'error_message', 'device_id')
+
+def _next_change_seq():
+    return "UPDATE change_sequence SET value = value + 1 WHERE id = 1;"
+
+def _stamp_change(submission_id):
+    return f"""{_next_change_seq()}
+        UPDATE submission SET change_seq = (SELECT value FROM change_sequence WHERE id = 1) WHERE id = {submission_id};"""
+
+def install_change_tracking(engine):
+    """
+    Keeps submission.change_seq current: any change to a submission or its receipt
+    takes the next number from change_sequence, and a deleted submission leaves a
+    tombstone with one. SQLite has a single writer, so numbers become visible in
+    order and a reader that has seen up to N never later finds a new change below N.
+    """
+    columns = ', '.join(TRACKED_SUBMISSION_COLUMNS)
+    # UPDATE OF fires on any SET of those columns, even to the same value (a stage
+    # claim rewrites status and error_message), so only count real changes.
+    changed = ' OR '.join(f"OLD.{column} IS NOT NEW.{column}" for column in TRACKED_SUBMISSION_COLUMNS)
+    triggers = {
+        'submission_change_insert': f"AFTER INSERT ON submission BEGIN "
+                                    f"DELETE FROM submission_tombstone WHERE submission_id = NEW.id; {_stamp_change('NEW.id')} END",
+        'submission_change_update': f"AFTER UPDATE OF {columns} ON submission WHEN {changed} BEGIN {_stamp_change('NEW.id')} END",
+        'submission_change_delete': f"""AFTER DELETE ON submission BEGIN {_next_change_seq()}
+            INSERT INTO submission_tombstone (submission_id, change_seq, deleted_at)
+            VALUES (OLD.id, (SELECT value FROM change_sequence WHERE id = 1), strftime('%Y-%m-%d %H:%M:%S', 'now'))
+            ON CONFLICT (submission_id) DO UPDATE SET change_seq = excluded.change_seq, deleted_at = excluded.deleted_at; END""",
+        'receipt_change_insert': f"AFTER INSERT ON receipt BEGIN {_stamp_change('NEW.submission_id')} END",
+        'receipt_change_update': f"AFTER UPDATE ON receipt BEGIN {_stamp_change('NEW.submission_id')} END",
+        'receipt_change_delete': f"AFTER DELETE ON receipt BEGIN {_stamp_change('OLD.submission_id')} END",
+    }
+    with engine.begin() as conn:
+        conn.execute(text("INSERT OR IGNORE INTO change_sequence (id, value, tombstones_pruned_through) VALUES (1, 0, 0)"))
+        for name, body in triggers.items():
+            conn.execute(text(f'DROP TRIGGER IF EXISTS "{name}"'))
+            conn.execute(text(f'CREATE TRIGGER "{name}" {body}'))
+        # Number submissions from before change tracking, after anything already numbered
+        stamped = conn.execute(text("""
+            UPDATE submission SET change_seq = id + (SELECT value FROM change_sequence WHERE id = 1)
+             WHERE change_seq IS NULL
+        """)).rowcount
+        if stamped:
+            conn.execute(text("""
+                UPDATE change_sequence SET value = (SELECT max(change_seq) FROM submission)
+                 WHERE id = 1 AND value < (SELECT max(change_seq) FROM submission)
+            """))
+            print(f"[Schema] Numbered {stamped} submission(s) for change tracking.")
+
+def install_config_versioning(engine):
+    """
+    Bumps config_version on any write to instance_config or device, whoever makes it,
+    so every worker's cached config and device keys (utils/config_cache.py) notice.
+    """
+    bump = "BEGIN UPDATE config_version SET value = value + 1 WHERE id = 1; END"
+    with engine.begin() as conn:
+        conn.execute(text("INSERT OR IGNORE INTO config_version (id, value) VALUES (1, 0)"))
+        for table in ('instance_config', 'device'):
+            for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                name = f"{table}_version_{operation.lower()}"
+                conn.execute(text(f'DROP TRIGGER IF EXISTS "{name}"'))
+                conn.execute(text(f'CREATE TRIGGER "{name}" AFTER {operation} ON {table} {bump}'))
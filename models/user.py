@@ -30,8 +30,15 @@ class Device(db.Model):
     api_key = db.Column(db.String(100), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
 
 class Submission(db.Model):
+    __table_args__ = (
+        # Dashboard pages are read newest first, per status tab (see utils/submission_queries.py)
+        db.Index('ix_submission_status_received_at', 'status', 'received_at'),
+        # A photo is held by at most one live submission; a resend that loses the race to insert gets the winner's
+        db.Index('uq_submission_content_hash_live', 'content_hash', unique=True, sqlite_where=db.text("status != 'failed'")),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    received_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    received_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     status = db.Column(db.String(20), nullable=False, default='queued', index=True)
     input_type = db.Column(db.String(10), nullable=False)
     input_data = db.Column(db.String(1024), nullable=False)
@@ -39,9 +46,24 @@ class Submission(db.Model):
     location = db.Column(db.String(255), nullable=True)
     error_message = db.Column(db.Text, nullable=True)
     retry_count = db.Column(db.Integer, default=0)
+    claimed_at = db.Column(db.DateTime, nullable=True)  # When a runner last claimed this job
+    next_attempt_at = db.Column(db.DateTime, nullable=True, index=True)  # Parked until this time after a failed fetch
+    stage = db.Column(db.String(20), nullable=True, index=True)  # Next pipeline stage to run, 'done' when finished
+    change_seq = db.Column(db.Integer, nullable=True, index=True)  # Bumped by triggers on every visible change, see /api/changes
+    content_hash = db.Column(db.String(64), nullable=True)  # SHA-256 of an uploaded photo, to spot resends
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
     device = db.relationship('Device', backref=db.backref('submissions', lazy=True))
 
+class SubmissionArtifact(db.Model):
+    """Intermediate output of a pipeline stage (TRA HTML, cleaned text, extracted data)."""
+    __table_args__ = (db.UniqueConstraint('submission_id', 'kind'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    submission_id = db.Column(db.Integer, db.ForeignKey('submission.id'), nullable=False, index=True)
+    kind = db.Column(db.String(30), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 class Receipt(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     
@@ -61,7 +83,7 @@ class Receipt(db.Model):
     
     total_amount = db.Column(db.Float, nullable=True)
     vat_amount = db.Column(db.Float, nullable=True)
-    receipt_date = db.Column(db.Date, nullable=True)
+    receipt_date = db.Column(db.Date, nullable=True, index=True)
     
     # --- System & Audit Fields ---
     processed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
@@ -69,4 +91,69 @@ class Receipt(db.Model):
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
     device = db.relationship('Device', backref=db.backref('receipts', lazy=True))
     submission_id = db.Column(db.Integer, db.ForeignKey('submission.id'), unique=True, nullable=False)
-    submission = db.relationship('Submission', backref=db.backref('receipt', uselist=False, lazy=True))
\ No newline at end of file
+    submission = db.relationship('Submission', backref=db.backref('receipt', uselist=False, lazy=True))
+
+class ReceiptStatBucket(db.Model):
+    """
+    Receipt count and total per hour and per day of processed_at, kept current by
+    triggers on the receipt table (see models/schema.py). Dashboard stats add these
+    up instead of scanning receipts.
+    """
+    __table_args__ = (db.UniqueConstraint('granularity', 'bucket_start', name='uq_receipt_stat_bucket'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(10), nullable=False)  # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    receipt_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+
+class ChangeSequence(db.Model):
+    """
+    A single row counting changes to submissions and their receipts. Triggers bump it
+    and stamp the changed submission's change_seq (see models/schema.py).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    tombstones_pruned_through = db.Column(db.Integer, nullable=False, default=0)  # Deletions up to here are forgotten
+
+class ConfigVersion(db.Model):
+    """
+    A single row bumped by triggers whenever the instance config or a device changes
+    (see models/schema.py). Workers compare it to decide when to reload their cached copies.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class SubmissionTombstone(db.Model):
+    """A deleted submission, kept for a while so /api/changes can tell syncing clients to drop it."""
+    submission_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    change_seq = db.Column(db.Integer, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class ExtractionCache(db.Model):
+    """LLM extraction results keyed by a hash of the receipt content, model and prompt version."""
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    model = db.Column(db.String(100), nullable=False)
+    extracted_data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    last_hit_at = db.Column(db.DateTime, nullable=True)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+
+class OutboxEvent(db.Model):
+    """An event waiting to be delivered to one export destination (webhook, S3, Google Sheets)."""
+    __table_args__ = (db.Index('ix_outbox_event_destination_status', 'destination', 'status', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    destination = db.Column(db.String(20), nullable=False)
+    event_type = db.Column(db.String(50), nullable=False)
+    submission_id = db.Column(db.Integer, nullable=True, index=True)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, delivered or dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # Backing off until this time after a failed delivery
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    claim_token = db.Column(db.String(32), nullable=True)  # Identifies the worker that claimed the batch
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime, nullable=True)
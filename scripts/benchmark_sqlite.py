@@ -0,0 +1,161 @@
+# scripts/benchmark_sqlite.py
+"""
+Mixed read/write throughput of the app's SQLite setup, before and after WAL mode,
+the in-process writer lock and group commit (utils/sqlite_engine.py).
+
+Each mode runs in its own process against a fresh database in a temp directory:
+claimers flip small status fields like the job queue does, stage writers keep a
+write open across a simulated network call like a pipeline stage, and readers page
+the dashboard. Run from the repository root:
+
+    python scripts/benchmark_sqlite.py [--seconds 10] [--rows 20000]
+"""
+from gevent import monkey; monkey.patch_all()
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gevent
+from flask import Flask
+from sqlalchemy import update, insert
+from sqlalchemy.exc import OperationalError
+from models.user import db, Submission, Receipt, Device
+from models.schema import upgrade_schema
+from utils.sqlite_engine import configure_sqlite, read_session, write_batcher
+from utils.metrics import metrics
+from utils.submission_queries import parse_submission_filters, fetch_submissions_page
+
+CLAIMERS, STAGE_WRITERS, READERS = 8, 4, 4
+READER_PAUSE_SECONDS = 0.5  # Dashboards page now and then, they don't hammer
+
+def build_app(path, mode):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    db.init_app(app)
+    with app.app_context():
+        if mode == 'after':
+            configure_sqlite(app, busy_timeout_ms=5000, synchronous='NORMAL', cache_size_mb=32, mmap_size_mb=256, read_pool_size=8)
+            write_batcher.start(db.engine, max_batch=100, window_seconds=0.002)
+        else:
+            # What the app did before: default journal, one pool for everything, a commit per write.
+            read_session.configure(bind=db.engine)
+            app.teardown_appcontext(lambda exc: read_session.remove())
+        db.create_all()
+        upgrade_schema(db)
+    return app
+
+def seed(app, rows):
+    with app.app_context():
+        db.session.add(Device(id=1, name='bench'))
+        db.session.commit()
+        start = datetime.utcnow() - timedelta(days=365)
+        for offset in range(0, rows, 5000):
+            ids = range(offset + 1, min(rows, offset + 5000) + 1)
+            db.session.execute(insert(Submission), [{
+                'id': i, 'received_at': start + timedelta(minutes=i), 'status': 'completed', 'stage': 'done',
+                'input_type': 'url', 'input_data': f'https://verify.tra.go.tz/B{i}', 'description': f'bench {i}', 'device_id': 1
+            } for i in ids])
+            db.session.execute(insert(Receipt), [{
+                'submission_id': i, 'device_id': 1, 'vendor_name': random.choice(['Alpha Stores', 'Beta Petrol', 'Gamma Cafe']),
+                'total_amount': float(i % 500), 'vat_amount': float(i % 90), 'processed_at': start + timedelta(minutes=i),
+                'receipt_verification_code': f'B{i}'
+            } for i in ids])
+            db.session.commit()
+
+def run(mode, seconds, rows):
+    path = os.path.join(tempfile.mkdtemp(prefix=f'bench-{mode}-'), 'bench.db')
+    app = build_app(path, mode)
+    seed(app, rows)
+    stats = {kind: {'ops': 0, 'errors': 0, 'latencies': []} for kind in ('claim', 'stage', 'read')}
+    deadline = time.monotonic() + seconds
+
+    def timed(kind, fn):
+        started = time.monotonic()
+        try:
+            fn()
+            stats[kind]['ops'] += 1
+            stats[kind]['latencies'].append(time.monotonic() - started)
+        except OperationalError:
+            stats[kind]['errors'] += 1
+
+    def claimer():
+        def claim():
+            submission_id = random.randint(1, rows)
+            write_batcher.execute(update(Submission).where(Submission.id == submission_id).values(claimed_at=datetime.utcnow()))
+            write_batcher.execute(update(Submission).where(Submission.id == submission_id).values(claimed_at=None))
+        while time.monotonic() < deadline:
+            with app.app_context():
+                timed('claim', claim)
+            gevent.sleep(0.001)
+
+    def stage_writer():
+        def stage():
+            submission = db.session.get(Submission, random.randint(1, rows))
+            submission.location = f'stage {time.monotonic()}'
+            db.session.flush()
+            gevent.sleep(0.005)  # A TRA/LLM call while the stage's writes are still uncommitted
+            db.session.commit()
+        while time.monotonic() < deadline:
+            with app.app_context():
+                try:
+                    timed('stage', stage)
+                finally:
+                    db.session.rollback()
+            gevent.sleep(0.001)
+
+    def reader():
+        filters = parse_submission_filters({'tab': 'processed', 'limit': '50'})
+        while time.monotonic() < deadline:
+            with app.app_context():
+                timed('read', lambda: fetch_submissions_page(filters, lambda filename: filename))
+            gevent.sleep(READER_PAUSE_SECONDS)
+
+    greenlets = [gevent.spawn(claimer) for _ in range(CLAIMERS)] + \
+                [gevent.spawn(stage_writer) for _ in range(STAGE_WRITERS)] + \
+                [gevent.spawn(reader) for _ in range(READERS)]
+    gevent.joinall(greenlets)
+
+    report = {}
+    for kind, data in stats.items():
+        latencies = sorted(data['latencies']) or [0.0]
+        report[kind] = {
+            'ops_per_s': round(data['ops'] / seconds, 1), 'errors': data['errors'],
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+            'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+        }
+    commits = metrics.count('write_batcher.commits')
+    report['batched'] = {'statements_per_commit': round(metrics.count('write_batcher.statements') / commits, 1) if commits else None}
+    print(json.dumps(report))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--mode', choices=('before', 'after'))
+    args = parser.parse_args()
+    if args.mode:
+        return run(args.mode, args.seconds, args.rows)
+
+    results = {}
+    for mode in ('before', 'after'):
+        output = subprocess.run([sys.executable, __file__, '--mode', mode, '--seconds', str(args.seconds), '--rows', str(args.rows)],
+                                capture_output=True, text=True, check=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+    print(f"{'':8}{'workload':8}{'ops/s':>10}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}")
+    for mode, report in results.items():
+        batched = report.pop('batched')['statements_per_commit']
+        for kind, row in report.items():
+            print(f"{mode:8}{kind:8}{row['ops_per_s']:>10}{row['errors']:>8}{row['p50_ms']:>9}{row['p95_ms']:>9}")
+        if batched:
+            print(f"{mode:8}group commit: {batched} statements per commit")
+
+if __name__ == '__main__':
+    main()
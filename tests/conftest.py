@@ -0,0 +1,33 @@
+import pytest
+from flask import Flask
+from sqlalchemy import text
+from models.user import db, Device
+from models.schema import upgrade_schema
+from utils.sqlite_engine import configure_sqlite, write_batcher
+
+# Rows the tests create, children first; everything else (devices, triggers) is set up once.
+TEST_TABLES = ('outbox_event', 'receipt', 'submission_artifact', 'submission', 'submission_tombstone')
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """The app's SQLite setup (WAL, writer lock, group commit, read engine) on a temp database."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path_factory.mktemp('db') / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        configure_sqlite(app, busy_timeout_ms=5000, synchronous='NORMAL', cache_size_mb=8, mmap_size_mb=0, read_pool_size=4)
+        write_batcher.start(db.engine, max_batch=100, window_seconds=0.002)
+        db.create_all()
+        upgrade_schema(db)
+        db.session.add(Device(id=1, name='test device'))
+        db.session.commit()
+    return app
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+        db.session.rollback()
+        for table in TEST_TABLES:
+            db.session.execute(text(f"DELETE FROM {table}"))
+        db.session.commit()
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+import gevent
+from models.user import db, Submission
+from utils.job_queue import claim_next_submission
+
+def add_submissions(count, stage='fetch'):
+    start = datetime.utcnow() - timedelta(hours=1)
+    submissions = [
+        Submission(device_id=1, input_type='url', input_data=f'https://verify.tra.go.tz/Q{i}', stage=stage,
+                   received_at=start + timedelta(seconds=i))
+        for i in range(count)
+    ]
+    db.session.add_all(submissions)
+    db.session.commit()
+    return [submission.id for submission in submissions]
+
+def test_concurrent_claims_never_hand_out_a_job_twice(app, app_context):
+    ids = add_submissions(30)
+    claims = []
+
+    def runner():
+        # Each runner has its own session, like the worker's stage greenlets.
+        with app.app_context():
+            while True:
+                submission_id = claim_next_submission('fetch')
+                if submission_id is None:
+                    return
+                claims.append(submission_id)
+
+    gevent.joinall([gevent.spawn(runner) for _ in range(8)], raise_error=True)
+    assert sorted(claims) == sorted(ids)
+    db.session.expire_all()
+    assert {s.status for s in Submission.query.filter(Submission.id.in_(ids))} == {'processing'}
+
+def test_claims_skip_parked_and_claimed_jobs(app_context):
+    parked, claimed, due = add_submissions(3)
+    db.session.get(Submission, parked).next_attempt_at = datetime.utcnow() + timedelta(minutes=5)
+    db.session.get(Submission, claimed).claimed_at = datetime.utcnow()
+    db.session.commit()
+    assert claim_next_submission('fetch') == due
+    assert claim_next_submission('fetch') is None
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from models.user import db, OutboxEvent
+from utils.outbox import claim_outbox_batch, enqueue_event, mark_delivered, mark_failed
+
+def enqueue(*submission_ids):
+    for submission_id in submission_ids:
+        enqueue_event(['webhook'], 'submission.queued', {'id': submission_id})
+
+def claimed_ids(limit):
+    return [event.submission_id for event in claim_outbox_batch('webhook', limit)]
+
+def make_due():
+    OutboxEvent.query.update({'next_attempt_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+def test_events_are_claimed_in_order_one_batch_at_a_time(app_context):
+    enqueue(1, 2, 3)
+    batch = claim_outbox_batch('webhook', 2)
+    assert [event.submission_id for event in batch] == [1, 2]
+    # Another worker gets nothing while that batch is out, so 3 can't overtake it.
+    assert claimed_ids(10) == []
+    mark_delivered(batch)
+    assert claimed_ids(10) == [3]
+
+def test_failed_batch_is_retried_as_claimed_before_later_events(app_context):
+    enqueue(1, 2, 3)
+    batch = claim_outbox_batch('webhook', 2)
+    assert mark_failed(batch, 'receiver down') > 0
+    enqueue(4)
+
+    # Backing off: nothing for this destination goes out before the retry.
+    assert claimed_ids(10) == []
+    make_due()
+    retry = claim_outbox_batch('webhook', 10)
+    assert [event.submission_id for event in retry] == [1, 2]
+    assert {event.attempts for event in retry} == {1}
+    mark_delivered(retry)
+    assert claimed_ids(10) == [3, 4]
+
+def test_dead_lettered_events_let_the_rest_through(app_context):
+    enqueue(1, 2)
+    batch = claim_outbox_batch('webhook', 1)
+    for event in batch:
+        event.attempts = 100
+    assert mark_failed(batch, 'gone') == 0
+    assert OutboxEvent.query.filter_by(submission_id=1).one().status == 'dead'
+    assert claimed_ids(10) == [2]
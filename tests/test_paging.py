@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+from models.user import db, Submission, Receipt
+from utils.change_feed import change_state, fetch_changes
+from utils.submission_queries import parse_submission_filters, fetch_submissions_page
+
+VENDORS = ['Alpha Stores', 'beta petrol', None, 'Gamma Cafe']
+
+def add_receipts(count, start=None):
+    """Submissions with receipts; received_at repeats every 3, so the id has to break ties."""
+    start = start or datetime.utcnow() - timedelta(days=1)
+    for i in range(count):
+        submission = Submission(device_id=1, input_type='url', input_data=f'https://verify.tra.go.tz/P{i}',
+                                status='completed', stage='done', received_at=start + timedelta(minutes=i // 3))
+        db.session.add(submission)
+        db.session.flush()
+        db.session.add(Receipt(submission_id=submission.id, device_id=1, vendor_name=VENDORS[i % len(VENDORS)],
+                               total_amount=float(i % 5) if i % 7 else None))
+    db.session.commit()
+
+def page_through(**args):
+    ids, cursor = [], None
+    while True:
+        filters = parse_submission_filters({'limit': '4', **args, **({'cursor': cursor} if cursor else {})})
+        page = fetch_submissions_page(filters, upload_url=lambda path: path)
+        ids.extend(item['id'] for item in page['items'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return ids
+
+def expected_order(key, descending):
+    rows = db.session.query(Submission, Receipt).join(Receipt, Receipt.submission_id == Submission.id).all()
+    ordered = sorted(rows, key=lambda row: (key(*row), row[0].id), reverse=descending)
+    return [submission.id for submission, _ in ordered]
+
+def test_keyset_pages_cover_every_row_once(app_context):
+    add_receipts(23)
+    assert page_through(sort='received_at') == expected_order(lambda s, r: s.received_at, True)
+    assert page_through(sort='received_at', direction='asc') == expected_order(lambda s, r: s.received_at, False)
+    # Missing values sort as their stand-ins: no vendor after every name, no amount before every amount.
+    assert page_through(sort='vendor_name', direction='asc') == \
+        expected_order(lambda s, r: (r.vendor_name or '~').lower(), False)
+    assert page_through(sort='total_amount') == \
+        expected_order(lambda s, r: r.total_amount if r.total_amount is not None else -1.0, True)
+
+def test_rows_added_while_paging_do_not_shift_later_pages(app_context):
+    add_receipts(12)
+    first = fetch_submissions_page(parse_submission_filters({'limit': '5'}), upload_url=lambda path: path)
+    add_receipts(3, start=datetime.utcnow())  # Newer than everything on the first page
+    rest = page_through(limit='5', cursor=first['next_cursor'])
+    seen = [item['id'] for item in first['items']] + rest
+    assert len(seen) == len(set(seen)) == 12
+
+def sync(cursor=None, limit=5):
+    """Follows the change feed to its end; returns (changed ids, deleted ids, final cursor, resets)."""
+    changed, deleted, resets = [], [], 0
+    while True:
+        page = fetch_changes(cursor, limit, change_state(), upload_url=lambda path: path)
+        changed.extend(item['id'] for item in page['changed'])
+        deleted.extend(page['deleted'])
+        resets += page['reset']
+        cursor = page['cursor']
+        if not page['has_more']:
+            return changed, deleted, cursor, resets
+
+def test_change_feed_cursor_resumes_after_the_last_change(app_context):
+    add_receipts(12)
+    ids = [submission.id for submission in Submission.query.order_by(Submission.id)]
+    changed, deleted, cursor, resets = sync()
+    assert sorted(changed) == ids and deleted == [] and resets == 0
+
+    # Caught up: nothing new until something is written.
+    assert sync(cursor)[:2] == ([], [])
+
+    edited, removed = db.session.get(Submission, ids[3]), db.session.get(Submission, ids[7])
+    edited.description = 'edited'
+    db.session.delete(removed.receipt)
+    db.session.delete(removed)
+    db.session.commit()
+    changed, deleted, cursor, resets = sync(cursor)
+    assert changed == [ids[3]] and deleted == [ids[7]] and resets == 0
+
+def test_change_feed_ignores_pipeline_bookkeeping(app_context):
+    add_receipts(3)
+    _, _, cursor, _ = sync()
+    for submission in Submission.query:
+        submission.claimed_at = datetime.utcnow()
+        submission.retry_count = 2
+    db.session.commit()
+    assert sync(cursor)[:2] == ([], [])
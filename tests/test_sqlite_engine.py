@@ -0,0 +1,33 @@
+import gevent
+import pytest
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from models.user import db, Submission
+from utils.metrics import metrics
+from utils.sqlite_engine import write_batcher
+
+def test_write_batcher_commits_a_burst_together(app_context):
+    write_batcher.execute(insert(Submission).values(device_id=1, input_type='url', input_data='https://verify.tra.go.tz/W1'))
+    before = metrics.snapshot()['counters'].get('write_batcher.commits', 0)
+    greenlets = [gevent.spawn(write_batcher.execute, update(Submission).values(description=f'burst {i}')) for i in range(10)]
+    gevent.joinall(greenlets, raise_error=True)
+    assert [greenlet.value for greenlet in greenlets] == [1] * 10
+    assert metrics.snapshot()['counters']['write_batcher.commits'] - before < 10
+
+def test_write_batcher_falls_back_when_one_statement_fails(app_context):
+    def add(name):
+        return insert(Submission).values(device_id=1, input_type='url', input_data=name)
+
+    # A submission without input_data breaks NOT NULL; it must not take the others down with it.
+    statements = [add('first'), insert(Submission).values(device_id=1, input_type='url'), add('second')]
+    greenlets = [gevent.spawn(write_batcher.execute, statement) for statement in statements]
+    gevent.joinall(greenlets)
+
+    assert greenlets[0].value == 1 and greenlets[2].value == 1
+    assert isinstance(greenlets[1].exception, IntegrityError)
+    assert sorted(s.input_data for s in Submission.query.all()) == ['first', 'second']
+
+def test_write_batcher_error_reaches_the_caller(app_context):
+    with pytest.raises(IntegrityError):
+        write_batcher.execute(insert(Submission).values(device_id=1, input_type='url'))
+    assert Submission.query.count() == 0
@@ -0,0 +1,66 @@
+import json
+import sqlite3
+import gevent
+from utils.sse_broker import MessageAnnouncer, EventLog
+
+def message(submission_id, event_type='submission.queued'):
+    return json.dumps({'event_type': event_type, 'data': {'submission_id': submission_id}})
+
+def parse(chunk):
+    fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n') if ': ' in line)
+    return fields.get('id'), fields.get('event', 'message'), fields.get('data')
+
+def consume(announcer, last_event_id=None):
+    received = []
+    def run():
+        for chunk in announcer.listen(last_event_id):
+            received.append(parse(chunk))
+    greenlet = gevent.spawn(run)
+    gevent.sleep(0.01)
+    return received, greenlet
+
+def test_reconnecting_client_gets_missed_events():
+    announcer = MessageAnnouncer(replay_size=10)
+    for submission_id in range(1, 4):
+        announcer.announce(message(submission_id))
+    received, greenlet = consume(announcer, last_event_id=1)
+    gevent.sleep(0.01)
+    greenlet.kill()
+    assert [event_id for event_id, _, _ in received] == ['2', '3']
+
+def test_event_log_failure_is_delivered_without_an_id(tmp_path):
+    announcer = MessageAnnouncer(replay_size=10)
+    announcer.use_event_log(EventLog(str(tmp_path / 'events.db')), poll_interval=0.01)
+    announcer.announce(message(1))
+    gevent.sleep(0.05)
+    received, greenlet = consume(announcer, last_event_id=1)
+
+    def broken_append(msg):
+        raise sqlite3.OperationalError('disk I/O error')
+    logged_append, announcer.event_log.append = announcer.event_log.append, broken_append
+    announcer.announce(message(2, 'submission.failed'))
+    gevent.sleep(0.01)
+    announcer.event_log.append = logged_append
+    announcer.announce(message(3))
+    gevent.sleep(0.05)
+    greenlet.kill()
+
+    assert [(event_id, json.loads(data)['data']['submission_id']) for event_id, _, data in received] == [(None, 2), ('2', 3)]
+    # Not replayable, and the logged event after it keeps its own id
+    assert [event_id for event_id, _, _ in announcer.ring] == [1, 2]
+
+def test_client_ahead_of_this_workers_tailer_is_not_reset(tmp_path):
+    path = str(tmp_path / 'events.db')
+    announcer = MessageAnnouncer(replay_size=10)
+    announcer.use_event_log(EventLog(path), poll_interval=10)
+    gevent.sleep(0.01)
+    other_worker = EventLog(path)
+    for submission_id in range(1, 4):
+        other_worker.append(message(submission_id))
+
+    received, greenlet = consume(announcer, last_event_id=3)
+    other_worker.append(message(4))
+    announcer._wakeup.set()
+    gevent.sleep(0.05)
+    greenlet.kill()
+    assert [(event_id, kind) for event_id, kind, _ in received] == [('4', 'message')]
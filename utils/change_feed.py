@@ -0,0 +1,126 @@
+# utils/change_feed.py
+import base64
+import json
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, func
+from models.user import db, Submission, ChangeSequence, SubmissionTombstone
+from .submission_queries import submission_columns, join_receipt_and_device, submission_row_to_dict
+from .metrics import metrics
+from .sqlite_engine import read_session
+
+DEFAULT_CHANGES_LIMIT = 500
+MAX_CHANGES_LIMIT = 1000
+PRUNE_INTERVAL_SECONDS = 3600
+
+_settings = {'tombstone_retention': timedelta(days=30), 'pruned_at': 0.0}
+
+def configure_change_feed(tombstone_retention_days):
+    _settings['tombstone_retention'] = timedelta(days=tombstone_retention_days)
+
+# A cursor is [position, sync start]: everything up to `position` has been sent, in a
+# sync that began at `sync start` (0 for a first sync). Deletions are checked against
+# the start, so the pages of a long first sync never trip a reset.
+def encode_change_cursor(position, sync_start):
+    return base64.urlsafe_b64encode(json.dumps([position, sync_start]).encode('utf-8')).decode('ascii')
+
+def decode_change_cursor(cursor):
+    """Returns (position, sync start), (0, 0) without a cursor, or raises ValueError if it is malformed."""
+    if not cursor:
+        return 0, 0
+    try:
+        position, sync_start = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(position), int(sync_start)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def parse_change_params(args):
+    """Reads `cursor` and `limit` from a request's query string."""
+    try:
+        limit = min(MAX_CHANGES_LIMIT, max(1, int(args.get('limit', DEFAULT_CHANGES_LIMIT))))
+    except ValueError:
+        raise ValueError("limit must be a number.")
+    return args.get('cursor') or None, limit
+
+def change_state():
+    """
+    (latest change number, deletions forgotten up to) — a single row, cheap enough to
+    read on every poll. Old tombstones are pruned first, so the state never promises
+    a deletion that is already gone.
+    """
+    _prune_tombstones()
+    row = read_session.execute(
+        select(ChangeSequence.value, ChangeSequence.tombstones_pruned_through).where(ChangeSequence.id == 1)
+    ).first()
+    return (row.value, row.tombstones_pruned_through) if row else (0, 0)
+
+def changes_etag(state, cursor, limit):
+    """Same state, same request, same answer: the ETag changes only when something was written."""
+    return f"{state[0]}.{state[1]}.{limit}.{cursor or ''}"
+
+def fetch_changes(cursor, limit, state, upload_url):
+    """
+    Submissions changed after the cursor, with their receipt, and the ids of deleted
+    ones, oldest change first. Only changes up to state[0] are read, so a write
+    landing mid-request is left for the next call rather than skipped. A client
+    whose sync started before forgotten deletions gets `reset` and a sync from
+    scratch, and should drop what it holds first.
+    """
+    latest, pruned_through = state
+    position, sync_start = decode_change_cursor(cursor)
+    # Also reset a cursor from the future, e.g. one issued before the database was restored from a backup
+    reset = 0 < sync_start < pruned_through or position > latest
+    if reset:
+        position = sync_start = 0
+        metrics.incr('changes.resets')
+
+    in_range = lambda column: (column > position, column <= latest)
+    changed = read_session.execute(
+        join_receipt_and_device(select(*submission_columns(), Submission.change_seq).select_from(Submission))
+        .where(*in_range(Submission.change_seq)).order_by(Submission.change_seq).limit(limit + 1)
+    ).all()
+    deleted = read_session.execute(
+        select(SubmissionTombstone.submission_id, SubmissionTombstone.change_seq)
+        .where(*in_range(SubmissionTombstone.change_seq)).order_by(SubmissionTombstone.change_seq).limit(limit + 1)
+    ).all()
+
+    # Merge the two by change number and cut the page there
+    entries = sorted([(row.change_seq, row) for row in changed] + [(row.change_seq, None, row.submission_id) for row in deleted],
+                     key=lambda entry: entry[0])
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    items, deleted_ids = [], []
+    for entry in entries:
+        if entry[1] is None:
+            deleted_ids.append(entry[2])
+        else:
+            item = submission_row_to_dict(entry[1], upload_url)
+            item['change_seq'] = entry[0]
+            items.append(item)
+    metrics.incr('changes.rows', len(entries))
+    return {
+        "cursor": encode_change_cursor(entries[-1][0], sync_start) if has_more else encode_change_cursor(latest, latest),
+        "has_more": has_more,
+        "reset": reset,
+        "changed": items,
+        "deleted": deleted_ids,
+    }
+
+def _prune_tombstones():
+    """Forgets deletions past the retention period. Runs at most once per PRUNE_INTERVAL_SECONDS."""
+    if time.monotonic() - _settings['pruned_at'] < PRUNE_INTERVAL_SECONDS:
+        return
+    _settings['pruned_at'] = time.monotonic()
+    cutoff = datetime.utcnow() - _settings['tombstone_retention']
+    through = db.session.execute(
+        select(func.max(SubmissionTombstone.change_seq)).where(SubmissionTombstone.deleted_at < cutoff)
+    ).scalar()
+    if through is None:
+        return
+    db.session.execute(SubmissionTombstone.__table__.delete().where(SubmissionTombstone.change_seq <= through))
+    db.session.execute(
+        ChangeSequence.__table__.update().where(ChangeSequence.id == 1, ChangeSequence.tombstones_pruned_through < through)
+        .values(tombstones_pruned_through=through)
+    )
+    db.session.commit()
+    print(f"[Changes] Forgot deletions up to change {through}.")
@@ -0,0 +1,72 @@
+# utils/config_cache.py
+import time
+from sqlalchemy import select
+from models.user import db, InstanceConfig, Device, ConfigVersion
+from .metrics import metrics
+
+class ConfigCache:
+    """
+    Process-local copies of the instance config and the device API keys, read on
+    every job stage and every intake. They are reloaded when config_version (bumped
+    by triggers on any write, from any worker) has moved, which is checked at most
+    once every `check_seconds`; routes that change them here call `invalidate()`
+    to reload right away.
+
+    Callers get transient snapshots, not session objects: read them freely, but
+    load a fresh row to change anything.
+    """
+    def __init__(self):
+        self._check_seconds = 1.0
+        self._checked_at = None
+        self._version = None
+        self._instance_config = None
+        self._devices_by_key = None
+
+    def configure(self, check_seconds):
+        self._check_seconds = check_seconds
+
+    def invalidate(self):
+        self._checked_at = None
+        self._version = None
+        metrics.incr('config_cache.invalidations')
+
+    def instance_config(self):
+        """The instance config, or None before setup."""
+        self._load_if_stale()
+        return self._instance_config
+
+    def device_for_key(self, api_key):
+        """The device holding `api_key`, or None if no device does."""
+        self._load_if_stale()
+        return self._devices_by_key.get(api_key)
+
+    def _load_if_stale(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self._check_seconds:
+            metrics.incr('config_cache.hit')
+            return
+        # One connection for the version and the rows, so the snapshot matches the version it is stored under
+        with db.engine.connect() as conn:
+            version = conn.execute(select(ConfigVersion.value).where(ConfigVersion.id == 1)).scalar()
+            self._checked_at = now
+            if version is not None and version == self._version:
+                metrics.incr('config_cache.hit')
+                return
+            metrics.incr('config_cache.miss')
+            row = conn.execute(select(InstanceConfig).order_by(InstanceConfig.id).limit(1)).mappings().first()
+            self._instance_config = InstanceConfig(**row) if row else None
+            self._devices_by_key = {
+                device['api_key']: Device(**device) for device in conn.execute(select(Device)).mappings()
+            }
+            self._version = version
+
+def cache_stats():
+    hits, misses = metrics.count('config_cache.hit'), metrics.count('config_cache.miss')
+    return {
+        'hits': hits, 'misses': misses, 'invalidations': metrics.count('config_cache.invalidations'),
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None
+    }
+
+# A single cache per app process
+config_cache = ConfigCache()
+metrics.register('config_cache', cache_stats)
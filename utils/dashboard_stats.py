@@ -0,0 +1,113 @@
+# utils/dashboard_stats.py
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, union_all, text
+from models.user import db, Receipt, ReceiptStatBucket
+from models.schema import STAT_BUCKET_FORMATS
+from .metrics import metrics
+from .sqlite_engine import read_session
+
+# The dashboard's stat cards: name -> how far back the window reaches
+STAT_WINDOWS = {
+    '24h': timedelta(hours=24), '7d': timedelta(days=7),
+    '4w': timedelta(weeks=4), '1y': timedelta(days=365),
+}
+# Hourly buckets are only read at the start of a window, so older ones can go.
+HOURLY_RETENTION = max(STAT_WINDOWS.values()) + timedelta(days=2)
+PRUNE_INTERVAL_SECONDS = 3600
+
+_settings = {'pruned_at': 0.0}
+
+def _ceil(moment, unit):
+    floor = moment.replace(minute=0, second=0, microsecond=0)
+    if unit == 'day':
+        floor = floor.replace(hour=0)
+    if floor == moment:
+        return floor
+    return floor + (timedelta(days=1) if unit == 'day' else timedelta(hours=1))
+
+def window_query(start):
+    """
+    Count and total of receipts processed since `start`, exactly, in three parts:
+    the raw receipts up to the first whole hour, hourly buckets up to the first
+    whole day, then daily buckets up to now.
+    """
+    first_hour = _ceil(start, 'hour')
+    first_day = _ceil(first_hour, 'day')
+    head = select(func.count(Receipt.id), func.coalesce(func.sum(Receipt.total_amount), 0.0)) \
+        .where(Receipt.processed_at >= start, Receipt.processed_at < first_hour)
+    hours = select(func.coalesce(func.sum(ReceiptStatBucket.receipt_count), 0), func.coalesce(func.sum(ReceiptStatBucket.total_amount), 0.0)) \
+        .where(ReceiptStatBucket.granularity == 'hour', ReceiptStatBucket.bucket_start >= first_hour, ReceiptStatBucket.bucket_start < first_day)
+    days = select(func.coalesce(func.sum(ReceiptStatBucket.receipt_count), 0), func.coalesce(func.sum(ReceiptStatBucket.total_amount), 0.0)) \
+        .where(ReceiptStatBucket.granularity == 'day', ReceiptStatBucket.bucket_start >= first_day)
+    return union_all(head, hours, days)
+
+def rebuild_stat_buckets():
+    """Recomputes every bucket from the receipt table in one transaction. Safe to repeat."""
+    cutoff = datetime.utcnow() - HOURLY_RETENTION
+    db.session.execute(text("DELETE FROM receipt_stat_bucket"))
+    for granularity, fmt in STAT_BUCKET_FORMATS.items():
+        db.session.execute(text(f"""
+            INSERT INTO receipt_stat_bucket (granularity, bucket_start, receipt_count, total_amount)
+            SELECT :granularity, strftime('{fmt}', processed_at), count(id), coalesce(sum(total_amount), 0)
+              FROM receipt
+             WHERE :granularity = 'day' OR processed_at >= :cutoff
+             GROUP BY 2
+        """), {'granularity': granularity, 'cutoff': cutoff})
+    db.session.commit()
+
+def backfill_stat_buckets():
+    """Fills the buckets for receipts that predate them (e.g. right after upgrading)."""
+    has_buckets = db.session.query(ReceiptStatBucket.id).first() is not None
+    has_receipts = db.session.query(Receipt.id).first() is not None
+    if has_receipts and not has_buckets:
+        rebuild_stat_buckets()
+        print("[Stats] Built dashboard stat buckets from existing receipts.")
+
+def prune_hourly_buckets():
+    """
+    Drops hourly buckets no window reaches any more. Runs at most once per
+    PRUNE_INTERVAL_SECONDS, from the queue worker's sweep (not the dashboard's reads).
+    """
+    if time.monotonic() - _settings['pruned_at'] < PRUNE_INTERVAL_SECONDS:
+        return
+    _settings['pruned_at'] = time.monotonic()
+    ReceiptStatBucket.query.filter(
+        ReceiptStatBucket.granularity == 'hour', ReceiptStatBucket.bucket_start < datetime.utcnow() - HOURLY_RETENTION
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+class DashboardStats:
+    """
+    The dashboard's stat cards, computed from the rollup buckets and cached for a
+    few seconds so a burst of processed receipts shares one computation.
+    """
+    def __init__(self):
+        self.ttl = 5
+        self._stats = None
+        self._computed_at = 0.0
+
+    def configure(self, ttl_seconds):
+        self.ttl = ttl_seconds
+        self.invalidate()
+
+    def invalidate(self):
+        self._stats = None
+
+    def get(self):
+        if self._stats is not None and time.monotonic() - self._computed_at < self.ttl:
+            metrics.incr('dashboard_stats.hit')
+            return self._stats
+        metrics.incr('dashboard_stats.miss')
+        started = time.monotonic()
+        now = datetime.utcnow()
+        stats = {}
+        for name, period in STAT_WINDOWS.items():
+            parts = read_session.execute(window_query(now - period)).all()
+            stats[name] = {'count': sum(part[0] or 0 for part in parts), 'total': sum(part[1] or 0.0 for part in parts)}
+        self._stats, self._computed_at = stats, time.monotonic()
+        metrics.observe('dashboard_stats.compute', time.monotonic() - started)
+        return stats
+
+# A single stats cache per app process
+dashboard_stats = DashboardStats()
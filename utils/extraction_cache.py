@@ -0,0 +1,93 @@
+# utils/extraction_cache.py
+import hashlib
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from models.user import db, ExtractionCache
+from .llm_processor import SYSTEM_PROMPT, TOOLS, ANALYSIS_TOOLS
+from .tra_parser import PARSER_VERSION
+from .metrics import metrics
+from .sqlite_engine import write_batcher
+
+# Changes whenever the prompt, tool schemas or TRA parser change, so older results stop matching.
+PROMPT_VERSION = hashlib.sha256(
+    (SYSTEM_PROMPT + json.dumps([TOOLS, ANALYSIS_TOOLS], sort_keys=True) + PARSER_VERSION).encode('utf-8')
+).hexdigest()[:16]
+
+# Eviction runs on every Nth store rather than on every write.
+EVICT_EVERY_N_STORES = 100
+
+_settings = {'max_entries': 5000, 'max_age': timedelta(days=90)}
+_store_count = 0
+
+def configure_extraction_cache(max_entries, max_age_days):
+    _settings['max_entries'] = max_entries
+    _settings['max_age'] = timedelta(days=max_age_days)
+
+def extraction_cache_key(content, is_image, provider, model):
+    """
+    Hashes what the LLM would see: the image bytes for photos, the cleaned TRA
+    text for URLs, plus the provider, model and prompt version.
+    """
+    if is_image:
+        with open(content, 'rb') as image_file:
+            content_bytes = image_file.read()
+    else:
+        content_bytes = content.encode('utf-8')
+
+    digest = hashlib.sha256()
+    for part in (PROMPT_VERSION, provider or '', model, 'image' if is_image else 'text'):
+        digest.update(part.encode('utf-8') + b'\0')
+    digest.update(content_bytes)
+    return digest.hexdigest()
+
+def get_cached_extraction(cache_key):
+    """Returns the stored extracted data for `cache_key`, or None on a miss."""
+    entry = ExtractionCache.query.filter_by(cache_key=cache_key).first()
+    if entry is None or entry.created_at < datetime.utcnow() - _settings['max_age']:
+        metrics.incr('extraction_cache.miss')
+        return None
+
+    write_batcher.execute(update(ExtractionCache).where(ExtractionCache.id == entry.id).values(
+        hit_count=db.func.coalesce(ExtractionCache.hit_count, 0) + 1, last_hit_at=datetime.utcnow()
+    ))
+    metrics.incr('extraction_cache.hit')
+    print(f"[Cache] Reusing extraction {cache_key[:12]} (hit {(entry.hit_count or 0) + 1}).")
+    return json.loads(entry.extracted_data)
+
+def store_extraction(cache_key, model, extracted_data):
+    global _store_count
+    db.session.add(ExtractionCache(cache_key=cache_key, model=model, extracted_data=json.dumps(extracted_data)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same content was extracted concurrently and stored first; keep that one.
+        db.session.rollback()
+
+    _store_count += 1
+    if _store_count % EVICT_EVERY_N_STORES == 1:
+        evict_extractions()
+
+def evict_extractions():
+    """Drops entries past the maximum age, then the least recently used beyond the size cap."""
+    expired = ExtractionCache.query.filter(
+        ExtractionCache.created_at < datetime.utcnow() - _settings['max_age']
+    ).delete(synchronize_session=False)
+
+    overflow = ExtractionCache.query.count() - _settings['max_entries']
+    evicted = 0
+    if overflow > 0:
+        last_used = db.func.coalesce(ExtractionCache.last_hit_at, ExtractionCache.created_at)
+        oldest_ids = db.session.query(ExtractionCache.id).order_by(last_used.asc()).limit(overflow).subquery()
+        evicted = ExtractionCache.query.filter(ExtractionCache.id.in_(db.select(oldest_ids.c.id))) \
+                                       .delete(synchronize_session=False)
+    db.session.commit()
+    if expired or evicted:
+        print(f"[Cache] Evicted {expired} expired and {evicted} least recently used extraction(s).")
+
+def cache_stats():
+    hits, misses = metrics.count('extraction_cache.hit'), metrics.count('extraction_cache.miss')
+    return {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None}
+
+metrics.register('extraction_cache', cache_stats)
@@ -0,0 +1,165 @@
+# utils/gsheet_sink.py
+import hashlib
+import json
+import re
+import threading
+import time
+from datetime import datetime
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+from .metrics import metrics
+
+# Expanded headers for comprehensive logging
+SHEET_HEADERS = [
+    "Submission ID", "Status", "Received At", "Processed At", "Device", "Input Type",
+    "User Description", "LLM Description", "Location", "Vendor Name", "Vendor TIN", "Vendor Phone",
+    "VRN", "Receipt No.", "UIN", "Receipt Date", "Verification Code", "Total Amount",
+    "VAT Amount", "Customer Name", "Customer ID Type", "Customer ID", "Tax Analysis", "Error"
+]
+# Columns filled when a submission is queued (A..I); the processed update keeps them.
+QUEUED_COLUMNS = 9
+
+# The sheet can also be edited by hand, so the local row index is re-read this often.
+INDEX_MAX_AGE_SECONDS = 15 * 60
+
+def queued_row(payload):
+    return [
+        payload.get('id'), payload.get('status'), payload.get('received_at'),
+        None, payload.get('device_name'), payload.get('input_type'),
+        payload.get('description'), None, payload.get('location')
+    ]
+
+def processed_row(payload, queued_values):
+    """The full row for a processed submission, keeping what was logged when it was queued."""
+    data = payload.get('data', {})
+    queued_values = (list(queued_values) + [None] * QUEUED_COLUMNS)[:QUEUED_COLUMNS]
+    return [
+        payload.get('submission_id'), payload.get('status'), queued_values[2], # Keep original received_at
+        payload.get('processed_at'), queued_values[4], queued_values[5],
+        queued_values[6], data.get('llm_extracted_description'), queued_values[8],
+        data.get('vendor_name'), data.get('vendor_tin'), data.get('vendor_phone'),
+        data.get('vrn'), data.get('receipt_number'), data.get('uin'),
+        data.get('receipt_date'), data.get('receipt_verification_code'), data.get('total_amount'),
+        data.get('vat_amount'), data.get('customer_name'), data.get('customer_id_type'),
+        data.get('customer_id'), data.get('llm_tax_analysis'), None # No error
+    ]
+
+class MonthSheet:
+    """A cached worksheet handle plus a local index of submission id -> (row number, queued columns)."""
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.rows = None
+        self.loaded_at = 0.0
+
+    def load_index(self):
+        """Reads the queued columns once, instead of a find() scan per event."""
+        if self.rows is None or time.monotonic() - self.loaded_at > INDEX_MAX_AGE_SECONDS:
+            self.rows = {}
+            self.loaded_at = time.monotonic()
+            values = self.worksheet.get(f"A:{gspread.utils.rowcol_to_a1(1, QUEUED_COLUMNS).rstrip('1')}")
+            for row_number, row in enumerate(values, start=1):
+                if row and row[0] and row_number > 1:
+                    self.rows[str(row[0])] = (row_number, row)
+            metrics.incr('gsheet.index_loads')
+        return self.rows
+
+class SheetsSink:
+    """
+    Writes outbox batches to Google Sheets with as few API calls as possible: the
+    authorized client and worksheet handles are cached, rows are found through a
+    local index, and each batch becomes at most one batch_update plus one append_rows.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._client_key = None
+        self._sheets = {}
+
+    def _get_client(self, service_account_json):
+        key = hashlib.sha256(service_account_json.encode('utf-8')).hexdigest()
+        if self._client is None or self._client_key != key:
+            creds_dict = json.loads(service_account_json)
+            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+            self._client = gspread.authorize(creds)
+            self._client_key = key
+            self._sheets = {}
+            print("[GSheet] Authorized Google Sheets client.")
+        return self._client
+
+    def _get_month_sheet(self, config, sheet_name):
+        cache_key = (config.google_sheet_id, sheet_name)
+        if cache_key not in self._sheets:
+            spreadsheet = self._get_client(config.google_service_account_json).open_by_key(config.google_sheet_id)
+            try:
+                worksheet = spreadsheet.worksheet(sheet_name)
+            except gspread.exceptions.WorksheetNotFound:
+                print(f"[GSheet] Worksheet '{sheet_name}' not found. Creating it.")
+                worksheet = spreadsheet.add_worksheet(title=sheet_name, rows="1000", cols="30")
+                worksheet.append_row(SHEET_HEADERS)
+                worksheet.format(f'A1:{gspread.utils.rowcol_to_a1(1, len(SHEET_HEADERS))}', {'textFormat': {'bold': True}})
+            self._sheets[cache_key] = MonthSheet(worksheet)
+        return self._sheets[cache_key]
+
+    def deliver(self, events, config):
+        with self._lock:
+            try:
+                self._write_batch(events, config)
+            except Exception as e:
+                # Our view of the sheet may be stale now; rebuild it on the retry.
+                print(f"[GSheet Error] Failed to write to Google Sheet: {e}")
+                self._sheets = {}
+                raise
+
+    def _write_batch(self, events, config):
+        sheet = self._get_month_sheet(config, datetime.utcnow().strftime('%B-%Y'))
+        index = sheet.load_index()
+
+        # New rows in arrival order; a submission queued and processed within the
+        # same batch is appended once, already complete.
+        appends, updates = {}, {}
+        for event in events:
+            payload = event['payload']
+            if event['event_type'] == 'submission.queued':
+                submission_id = str(payload.get('id'))
+                if submission_id not in index:
+                    appends[submission_id] = queued_row(payload)
+            elif event['event_type'] == 'submission.processed':
+                submission_id = str(payload.get('submission_id'))
+                if submission_id in appends:
+                    appends[submission_id] = processed_row(payload, appends[submission_id])
+                elif submission_id in index:
+                    row_number, queued_values = index[submission_id]
+                    updates[row_number] = processed_row(payload, queued_values)
+                else:
+                    # Queued in an earlier month's sheet (or never logged): nothing to update, as before.
+                    metrics.incr('gsheet.processed_without_row')
+
+        # Updates are idempotent, so they go first: if the append fails, the retry repeats both safely.
+        if updates:
+            sheet.worksheet.batch_update([
+                {'range': f'A{row_number}:{gspread.utils.rowcol_to_a1(row_number, len(row))}', 'values': [row]}
+                for row_number, row in updates.items()
+            ])
+            metrics.incr('gsheet.api_calls')
+            print(f"[GSheet] Updated {len(updates)} row(s) with 'processed' data.")
+
+        if appends:
+            response = sheet.worksheet.append_rows(list(appends.values()))
+            metrics.incr('gsheet.api_calls')
+            first_row = self._first_appended_row(response)
+            for offset, (submission_id, row) in enumerate(appends.items()):
+                if first_row is None:
+                    sheet.rows = None  # Unknown position; re-read the index next time.
+                    break
+                index[submission_id] = (first_row + offset, row[:QUEUED_COLUMNS])
+            print(f"[GSheet] Appended {len(appends)} row(s).")
+
+    @staticmethod
+    def _first_appended_row(response):
+        updated_range = (response or {}).get('updates', {}).get('updatedRange', '')
+        match = re.search(r'![A-Z]+(\d+)', updated_range)
+        return int(match.group(1)) if match else None
+
+# Create a single global sink for the process
+sheets_sink = SheetsSink()
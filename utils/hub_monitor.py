@@ -0,0 +1,129 @@
+# utils/hub_monitor.py
+import time
+from weakref import WeakKeyDictionary
+import greenlet
+from flask import request
+from sqlalchemy import event
+from .metrics import metrics
+
+class _RequestTiming:
+    __slots__ = ('started', 'ran_since', 'blocked', 'longest', 'db', 'queries')
+
+    def __init__(self, now):
+        self.started = self.ran_since = now
+        self.blocked = self.longest = self.db = 0.0
+        self.queries = 0
+
+    def stop_running(self, now):
+        if self.ran_since is not None:
+            stretch = now - self.ran_since
+            self.blocked += stretch
+            self.longest = max(self.longest, stretch)
+            self.ran_since = None
+
+class HubMonitor:
+    """
+    Measures how long each request kept the gevent hub to itself: the time its
+    greenlet ran between switches, when no other greenlet (SSE streams, intake,
+    LLM callbacks) could run. A greenlet trace function does the accounting and
+    engine events add up the request's database time. Both go out in a
+    Server-Timing header and into /admin/metrics per endpoint; for streamed
+    responses the header covers the time until it is sent and the metrics
+    the whole body. Requests that hold
+    the hub longer than the threshold at a stretch are logged.
+    """
+    def __init__(self):
+        self._watched = WeakKeyDictionary()  # request greenlet -> _RequestTiming
+        self._previous_tracer = None
+        self._log_threshold = 0.1
+        self._installed = False
+
+    def install(self, app, engines, log_threshold_ms):
+        if self._installed:
+            return
+        self._installed = True
+        self._log_threshold = log_threshold_ms / 1000
+        self._previous_tracer = greenlet.settrace(self._trace)
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before_query)
+            event.listen(engine, 'after_cursor_execute', self._after_query)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _trace(self, event_name, args):
+        if event_name in ('switch', 'throw'):
+            origin, target = args
+            now = time.perf_counter()
+            timing = self._watched.get(origin)
+            if timing is not None:
+                timing.stop_running(now)
+            timing = self._watched.get(target)
+            if timing is not None:
+                timing.ran_since = now
+        if self._previous_tracer is not None:
+            self._previous_tracer(event_name, args)
+
+    # The start time lives on the statement's execution context, which is dropped
+    # with it when a statement fails and after_cursor_execute never fires.
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'query_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        timing = self._watched.get(greenlet.getcurrent())
+        if timing is not None:
+            timing.db += elapsed
+            timing.queries += 1
+
+    def _start_request(self):
+        self._watched[greenlet.getcurrent()] = _RequestTiming(time.perf_counter())
+
+    def _finish_request(self, response):
+        current = greenlet.getcurrent()
+        timing = self._watched.get(current)
+        if timing is None:
+            return response
+        now = time.perf_counter()
+        label = (request.endpoint or 'unknown', f"{request.method} {request.path}")
+        if response.is_streamed:
+            # The body (exports, SSE) is produced after this hook, in the same greenlet. The
+            # header can only cover the time until it is sent; the metrics wait for the end.
+            running = now - timing.ran_since if timing.ran_since is not None else 0.0
+            response.headers.add('Server-Timing', self._server_timing(
+                timing, timing.blocked + running, max(timing.longest, running), now))
+            response.call_on_close(lambda: self._finish_body(current, *label))
+            return response
+        del self._watched[current]
+        timing.stop_running(now)
+        response.headers.add('Server-Timing', self._server_timing(timing, timing.blocked, timing.longest, now))
+        self._record(timing, *label)
+        return response
+
+    def _finish_body(self, current, endpoint, label):
+        timing = self._watched.pop(current, None)
+        if timing is not None:
+            timing.stop_running(time.perf_counter())
+            self._record(timing, endpoint, label)
+
+    def _server_timing(self, timing, blocked, longest, now):
+        return ', '.join([
+            f'hub;dur={blocked * 1000:.1f};desc="Event loop held"',
+            f'hub-max;dur={longest * 1000:.1f};desc="Longest stretch"',
+            f'db;dur={timing.db * 1000:.1f};desc="{timing.queries} queries"',
+            f'total;dur={(now - timing.started) * 1000:.1f}',
+        ])
+
+    def _record(self, timing, endpoint, label):
+        metrics.observe(f'hub_blocked.{endpoint}', timing.blocked)
+        metrics.observe(f'db.{endpoint}', timing.db)
+        if timing.longest > self._log_threshold:
+            metrics.incr('hub_blocked.slow_requests')
+            print(f"[Hub] {label} held the event loop for {timing.longest * 1000:.0f} ms at a stretch "
+                  f"({timing.blocked * 1000:.0f} ms in total, {timing.queries} queries in {timing.db * 1000:.0f} ms).")
+
+# A single monitor per app process
+hub_monitor = HubMonitor()
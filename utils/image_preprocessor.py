@@ -0,0 +1,73 @@
+# utils/image_preprocessor.py
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps
+
+PROCESSED_SUFFIX = '.processed'
+
+_settings = {'workers': 2, 'max_dimension': 1600, 'grayscale': False, 'quality': 80, 'timeout': 60}
+_executor = None
+
+def configure_image_preprocessing(workers, max_dimension, grayscale, quality, timeout=60):
+    """Applies the IMAGE_* settings. `workers=0` processes images inline instead of in a process pool."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    _settings.update(workers=workers, max_dimension=max_dimension, grayscale=grayscale, quality=quality, timeout=timeout)
+
+def processed_image_path(original_path, max_dimension, grayscale, quality):
+    """
+    The processed copy lives next to the upload. The settings are part of the name,
+    so changing them produces a new copy instead of reusing a stale one.
+    """
+    variant = f"{max_dimension}{'g' if grayscale else 'c'}q{quality}"
+    return f"{original_path}{PROCESSED_SUFFIX}-{variant}.jpg"
+
+def _process_image(original_path, output_path, max_dimension, grayscale, quality):
+    """
+    Runs in a worker process: fixes the EXIF orientation, downscales to `max_dimension`,
+    optionally converts to grayscale and recompresses as JPEG.
+    """
+    with Image.open(original_path) as image:
+        # For JPEGs, let the decoder downscale while reading instead of decoding full size.
+        image.draft('RGB', (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        image = image.convert('L' if grayscale else 'RGB')
+
+        # Write to a temporary name first so a half-written file is never mistaken for a cached one.
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        image.save(temp_path, 'JPEG', quality=quality, optimize=True)
+    os.replace(temp_path, output_path)
+    return output_path
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # 'spawn' keeps the gevent hub and open database connections out of the workers.
+        _executor = ProcessPoolExecutor(_settings['workers'], mp_context=multiprocessing.get_context('spawn'))
+        print(f"[Image] Started {_settings['workers']} image preprocessing worker(s).")
+    return _executor
+
+def preprocess_receipt_image(original_path):
+    """
+    Returns the path of a smaller, upright copy of an uploaded photo, creating it if needed.
+    Pillow work is CPU-bound, so it runs in the process pool; waiting on it only blocks this greenlet.
+    """
+    global _executor
+    args = (original_path, processed_image_path(original_path, _settings['max_dimension'], _settings['grayscale'], _settings['quality']),
+            _settings['max_dimension'], _settings['grayscale'], _settings['quality'])
+    if os.path.exists(args[1]):
+        print(f"[Image] Reusing processed copy of {os.path.basename(original_path)}.")
+        return args[1]
+
+    if _settings['workers'] > 0:
+        try:
+            return _get_executor().submit(_process_image, *args).result(timeout=_settings['timeout'])
+        except BrokenProcessPool:
+            print("[Image] Process pool broke down; processing this image inline.")
+            _executor = None
+    return _process_image(*args)
@@ -0,0 +1,233 @@
+# utils/job_queue.py
+import random
+from datetime import datetime, timedelta
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+from sqlalchemy import or_, case, update
+from models.user import db, Submission, SubmissionArtifact
+from .sqlite_engine import write_batcher
+
+# Every job moves through these stages in order; `stage` holds the next one to run.
+# Photo submissions enter at 'preprocess' and skip to 'extract', URL submissions enter at 'fetch'.
+PIPELINE_STAGES = ('preprocess', 'fetch', 'clean', 'extract', 'persist', 'export')
+DONE_STAGE = 'done'
+
+# Artifacts that are only needed while a job is in flight and are dropped once it is done.
+TRANSIENT_ARTIFACTS = ('tra_html',)
+
+# Jobs claimed longer than this are assumed to belong to a dead runner. No stage may
+# run this long: LLM calls give up queueing after LLM_MAX_QUEUE_SECONDS and park the job.
+STUCK_JOB_TIMEOUT = timedelta(minutes=10)
+
+def first_stage_for(input_type):
+    return 'preprocess' if input_type == 'photo' else 'fetch'
+
+def requeue_stuck_submissions():
+    """
+    Releases stage claims held for too long, so the stage runs again, and returns how many were rescued.
+    """
+    cutoff = datetime.utcnow() - STUCK_JOB_TIMEOUT
+    stuck_jobs = Submission.query.filter(
+        Submission.stage != DONE_STAGE,
+        Submission.claimed_at < cutoff
+    ).all()
+
+    for job in stuck_jobs:
+        print(f"[Heal] Found stuck job {job.id} in stage '{job.stage}'. Re-queueing.")
+        job.claimed_at = None
+        if job.status == 'processing':
+            job.error_message = "Rescued from stuck 'processing' state."
+
+    if stuck_jobs:
+        db.session.commit()
+    return len(stuck_jobs)
+
+def save_artifact(submission, kind, content):
+    """Stores (or replaces) the intermediate output of a stage. Committed with the next stage change."""
+    artifact = SubmissionArtifact.query.filter_by(submission_id=submission.id, kind=kind).first()
+    if artifact:
+        artifact.content = content
+        artifact.created_at = datetime.utcnow()
+    else:
+        db.session.add(SubmissionArtifact(submission_id=submission.id, kind=kind, content=content))
+
+def load_artifact(submission, kind, required=True):
+    """Returns a stage's stored output. Missing optional outputs (`required=False`) come back as None."""
+    artifact = SubmissionArtifact.query.filter_by(submission_id=submission.id, kind=kind).first()
+    if artifact is None:
+        if not required:
+            return None
+        raise ValueError(f"Missing '{kind}' output for submission {submission.id}.")
+    return artifact.content
+
+def advance_submission(submission, next_stage):
+    """Hands a submission on to its next stage and releases the current claim."""
+    submission.stage = next_stage
+    submission.claimed_at = None
+    submission.next_attempt_at = None
+    if next_stage == DONE_STAGE:
+        SubmissionArtifact.query.filter(
+            SubmissionArtifact.submission_id == submission.id,
+            SubmissionArtifact.kind.in_(TRANSIENT_ARTIFACTS)
+        ).delete(synchronize_session=False)
+    db.session.commit()
+
+def retry_delay_seconds(attempt, base_seconds, max_seconds):
+    """
+    Exponential backoff with jitter: the ceiling doubles with every attempt and the
+    actual delay is drawn from its upper half, so parked jobs don't retry in lockstep.
+    """
+    ceiling = min(max_seconds, base_seconds * (2 ** max(0, attempt - 1)))
+    return random.uniform(ceiling / 2, ceiling)
+
+def park_submission_for_retry(submission, error, max_retries, base_seconds, max_seconds, min_delay_seconds=0):
+    """
+    Leaves a submission in its current stage to be retried later instead of waiting in-process.
+    `min_delay_seconds` lets callers honour a delay the remote side asked for (Retry-After).
+    Returns False (and marks the job failed) once it has used up all its retries.
+    """
+    submission.retry_count = (submission.retry_count or 0) + 1
+    submission.claimed_at = None
+
+    if submission.retry_count > max_retries:
+        print(f"[RetryExhausted] Max retries reached for submission {submission.id}.")
+        submission.status = 'failed'
+        submission.stage = DONE_STAGE
+        submission.next_attempt_at = None
+        submission.error_message = f"Failed after {submission.retry_count} attempts: {error}"
+        db.session.commit()
+        return False
+
+    delay = max(min_delay_seconds or 0, retry_delay_seconds(submission.retry_count, base_seconds, max_seconds))
+    submission.status = 'queued'
+    submission.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+    submission.error_message = f"Attempt {submission.retry_count} failed, retrying in {int(delay)}s: {error}"
+    db.session.commit()
+    print(f"[RetryScheduled] Submission {submission.id} parked in stage '{submission.stage}' until {submission.next_attempt_at.isoformat()}.")
+    return True
+
+def claim_next_submission(stage):
+    """
+    Atomically claims the oldest due submission waiting for `stage` and returns its id, or None.
+    The conditional UPDATE is a compare-and-set on the claim, so two runners
+    (the resident worker, the cron fallback, or parallel pools) can never both
+    win the same row. Jobs parked for a later retry are skipped. Claims from
+    concurrent runners are committed together by the write batcher.
+    """
+    while True:
+        now = datetime.utcnow()
+        candidate = db.session.query(Submission.id).filter(
+            Submission.stage == stage,
+            Submission.claimed_at.is_(None),
+            or_(Submission.next_attempt_at.is_(None), Submission.next_attempt_at <= now)
+        ).order_by(Submission.received_at.asc()).first()
+        if not candidate:
+            return None
+
+        # Only a job that is still waiting flips to 'processing'; later stages keep the
+        # outcome (completed/duplicate) and message that an earlier stage recorded.
+        is_waiting = Submission.status == 'queued'
+        claimed = write_batcher.execute(update(Submission).where(
+            Submission.id == candidate.id, Submission.stage == stage, Submission.claimed_at.is_(None)
+        ).values(
+            claimed_at=now,
+            status=case((is_waiting, 'processing'), else_=Submission.status),
+            error_message=case((is_waiting, None), else_=Submission.error_message)
+        ))
+        if claimed == 1:
+            return candidate.id
+        # Another runner got there first; try the next one.
+
+def drain_pipeline(app, stage_handlers, stage_concurrency):
+    """
+    Runs every stage of the pipeline until no due work is left. Each stage has its
+    own pool, so a slow stage (e.g. TRA fetches) never takes slots from another
+    (e.g. LLM extraction). Returns a summary of every stage run.
+    """
+    pools = {stage: Pool(max(1, stage_concurrency.get(stage, 1))) for stage in stage_handlers}
+    stage_runs = []
+
+    def run_stage(stage, submission_id):
+        # Each greenlet gets its own app context and therefore its own DB session.
+        with app.app_context():
+            submission = db.session.get(Submission, submission_id)
+            stage_handlers[stage](submission)
+
+            db.session.expire_all()
+            final = db.session.get(Submission, submission_id)
+            stage_runs.append({
+                "id": submission_id,
+                "stage": stage,
+                "final_status": final.status,
+                "error_message": final.error_message
+            })
+
+    while True:
+        for stage, pool in pools.items():
+            while pool.free_count() > 0:
+                job_id = claim_next_submission(stage)
+                if job_id is None:
+                    break
+                pool.spawn(run_stage, stage, job_id)
+
+        running = [greenlet for pool in pools.values() for greenlet in pool]
+        if not running:
+            break
+        # Wait for any job to finish; that frees a slot or feeds the next stage.
+        gevent.wait(running, count=1)
+
+    return stage_runs
+
+def seconds_until_next_due(default_seconds):
+    """
+    Returns how long until the earliest parked job becomes due, capped at `default_seconds`.
+    """
+    next_due = db.session.query(db.func.min(Submission.next_attempt_at)) \
+                         .filter(Submission.stage != DONE_STAGE, Submission.claimed_at.is_(None)).scalar()
+    if next_due is None:
+        return default_seconds
+    return min(default_seconds, max(1.0, (next_due - datetime.utcnow()).total_seconds()))
+
+class QueueWorker:
+    """
+    A long-lived greenlet that drains the pipeline inside the app process.
+    Intake calls `wake()` so new jobs start immediately; otherwise the worker sleeps
+    until the next parked retry is due, or at most `sweep_interval` seconds, as a fallback
+    for rescued jobs and anything another process queued. Each pass also runs the
+    `maintenance` callables (housekeeping that must stay off request paths).
+    """
+    def __init__(self):
+        self._wakeup = Event()
+        self._greenlet = None
+
+    def start(self, app, stage_handlers, stage_concurrency, sweep_interval, maintenance=()):
+        if self._greenlet is not None:
+            return
+        self._greenlet = gevent.spawn(self._run, app, stage_handlers, stage_concurrency, sweep_interval, maintenance)
+        print(f"[Worker] Queue worker started (concurrency={stage_concurrency}, sweep={sweep_interval}s).")
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self, app, stage_handlers, stage_concurrency, sweep_interval, maintenance):
+        while True:
+            # Clear before draining, so a wake-up that arrives mid-drain triggers another pass.
+            self._wakeup.clear()
+            try:
+                with app.app_context():
+                    requeue_stuck_submissions()
+                    for task in maintenance:
+                        task()
+                    stage_runs = drain_pipeline(app, stage_handlers, stage_concurrency)
+                    if stage_runs:
+                        print(f"[Worker] Ran {len(stage_runs)} pipeline stage(s).")
+                    timeout = seconds_until_next_due(sweep_interval)
+            except Exception as e:
+                # Never let one bad pass kill the worker; try again on the next sweep.
+                print(f"[Worker Error] Queue pass failed: {e}")
+                timeout = sweep_interval
+            self._wakeup.wait(timeout=timeout)
+
+# A single worker per app process
+queue_worker = QueueWorker()
@@ -1,7 +1,14 @@
 # utils/llm_processor.py
 import openai
 import base64
+import hashlib
 import json
+import mimetypes
+import threading
+import time
+from contextlib import contextmanager
+from .llm_scheduler import llm_scheduler, LLMRateLimited, parse_retry_after, parse_remaining
+from .metrics import metrics
 
 SYSTEM_PROMPT = """
 You are an expert in Tanzanian tax compliance (Income Tax/VAT Acts). Analyze receipts using `save_extracted_receipt_data` and provide tax analysis meeting TRA audit standards.
@@ -69,19 +76,197 @@ TOOLS = [
     }
 ]
 
+# Used when the TRA page was parsed locally: the model only writes the narrative fields.
+ANALYSIS_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "save_receipt_analysis",
+            "description": "Saves the purchase summary and tax analysis for an already extracted receipt.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "llm_extracted_description": TOOLS[0]["function"]["parameters"]["properties"]["llm_extracted_description"],
+                    "llm_tax_analysis": TOOLS[0]["function"]["parameters"]["properties"]["llm_tax_analysis"]
+                },
+                "required": ["llm_extracted_description", "llm_tax_analysis"]
+            },
+        },
+    }
+]
+
+# Each job retries throttled or transiently failing calls this many times before it is
+# parked for a later attempt. The SDK's own retries are disabled so that every 429
+# reaches the scheduler.
+MAX_CALL_ATTEMPTS = 3
+TRANSIENT_ERROR_DELAY_SECONDS = 2
+
+# Rough token accounting used to reserve budget before a call is made.
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 1500
+COMPLETION_TOKEN_ESTIMATE = 600
+
+def estimate_tokens(messages, is_image, tools=TOOLS):
+    text_chars = len(SYSTEM_PROMPT) + len(json.dumps(tools))
+    for message in messages[1:]:
+        if isinstance(message['content'], str):
+            text_chars += len(message['content'])
+        else:
+            text_chars += sum(len(part.get('text', '')) for part in message['content'])
+    return text_chars // CHARS_PER_TOKEN + (IMAGE_TOKEN_ESTIMATE if is_image else 0) + COMPLETION_TOKEN_ESTIMATE
+
+def call_llm_scheduled(client, provider, estimated_tokens, **request):
+    """
+    Makes a chat completion call through the provider's rate limiter.
+    429s shrink the provider's concurrency and pause it for Retry-After; if the
+    provider is still throttling after MAX_CALL_ATTEMPTS, LLMRateLimited is raised
+    so the caller can park the job instead of failing it. So is a call that would
+    queue longer than the scheduler's max wait in total.
+    """
+    limiter = llm_scheduler.limiter(provider)
+    max_wait = llm_scheduler.max_wait_seconds
+    deadline = time.monotonic() + max_wait if max_wait else None
+    for attempt in range(1, MAX_CALL_ATTEMPTS + 1):
+        limiter.acquire(estimated_tokens, deadline)
+        started = time.monotonic()
+        try:
+            raw_response = client.chat.completions.with_raw_response.create(**request)
+        except openai.RateLimitError as e:
+            retry_after = parse_retry_after(e.response.headers if e.response is not None else None)
+            limiter.release(estimated_tokens, 'throttled', retry_after=retry_after)
+            metrics.incr(f'llm.{provider}.throttled')
+            print(f"[LLM] {provider} throttled us (attempt {attempt}/{MAX_CALL_ATTEMPTS}), retry after {retry_after}s.")
+            if attempt == MAX_CALL_ATTEMPTS:
+                raise LLMRateLimited(f"{provider} is rate limiting requests: {e}", retry_after=retry_after)
+            continue
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            limiter.release(estimated_tokens, 'error')
+            metrics.incr(f'llm.{provider}.transient_errors')
+            print(f"[LLM] Transient error from {provider} (attempt {attempt}/{MAX_CALL_ATTEMPTS}): {e}")
+            if attempt == MAX_CALL_ATTEMPTS:
+                raise LLMRateLimited(f"{provider} is unavailable: {e}")
+            time.sleep(TRANSIENT_ERROR_DELAY_SECONDS * attempt)
+            continue
+        except Exception:
+            limiter.release(estimated_tokens, 'error')
+            raise
+
+        response = raw_response.parse()
+        used_tokens = response.usage.total_tokens if getattr(response, 'usage', None) else estimated_tokens
+        limiter.release(estimated_tokens, 'success', used_tokens=used_tokens, remaining=parse_remaining(raw_response.headers))
+        metrics.observe(f'llm.{provider}.call', time.monotonic() - started)
+        metrics.incr(f'llm.{provider}.tokens', used_tokens)
+        return response
+
+def select_model(provider, is_image):
+    """Picks the model for a provider, using a vision model for photos."""
+    if is_image:
+        return "meta-llama/llama-4-scout-17b-16e-instruct" if provider == 'groq' else "gpt-4o"
+    return "llama-3.3-70b-versatile" if provider == 'groq' else "gpt-4o"
+
 def encode_image_to_base64(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
-def get_llm_client(config):
-    if config.llm_provider == 'groq' and config.llm_api_key:
-        print("[LLM] Initializing Groq client.")
-        return openai.OpenAI(
-            api_key=config.llm_api_key,
-            base_url="https://api.groq.com/openai/v1"
+def image_data_url(image_path):
+    """Builds a data: URL with the MIME type that matches the file (preprocessed photos are JPEGs)."""
+    mime_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+    return f"data:{mime_type};base64,{encode_image_to_base64(image_path)}"
+
+PROVIDER_BASE_URLS = {
+    'groq': "https://api.groq.com/openai/v1",
+}
+
+# Long-lived clients, keyed by provider, base URL and a hash of the API key, so every
+# job reuses the same keep-alive connection pool instead of a fresh TLS handshake.
+_clients = {}
+_clients_lock = threading.Lock()
+_leases = {}  # client -> calls using it right now, see llm_client
+_retired = set()  # Clients dropped by reset_llm_clients, closed once their last call is done
+_client_settings = {
+    'timeout': 60.0, 'connect_timeout': 10.0,
+    'max_connections': 20, 'max_keepalive_connections': 10, 'keepalive_expiry': 60.0,
+}
+
+def configure_llm_clients(**settings):
+    """Sets timeouts and connection limits for clients created from now on."""
+    _client_settings.update({key: value for key, value in settings.items() if value is not None})
+    reset_llm_clients()
+
+def reset_llm_clients():
+    """
+    Forgets every cached client, e.g. after the API key or provider changes, and
+    closes their connection pools: idle clients now, those with calls in flight
+    when the last of those calls is done.
+    """
+    with _clients_lock:
+        idle = [client for client in _clients.values() if client not in _leases]
+        _retired.update(client for client in _clients.values() if client in _leases)
+        _clients.clear()
+    for client in idle:
+        _close_llm_client(client)
+
+def _close_llm_client(client):
+    try:
+        client.close()
+        metrics.incr('llm.clients.closed')
+    except Exception as e:
+        print(f"[LLM] Could not close a retired client: {e}")
+
+def _build_llm_client(api_key, base_url):
+    import httpx  # Installed as a dependency of openai
+
+    http_client = openai.DefaultHttpxClient(
+        timeout=httpx.Timeout(_client_settings['timeout'], connect=_client_settings['connect_timeout']),
+        limits=httpx.Limits(
+            max_connections=_client_settings['max_connections'],
+            max_keepalive_connections=_client_settings['max_keepalive_connections'],
+            keepalive_expiry=_client_settings['keepalive_expiry']
         )
+    )
+    return openai.OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=http_client,
+        max_retries=0 # Retries go through the rate-limit scheduler
+    )
+
+def _get_llm_client(config):
+    """The cached client for this provider and key, created on first use. Call with _clients_lock held."""
+    base_url = PROVIDER_BASE_URLS.get(config.llm_provider)
+    key_hash = hashlib.sha256((config.llm_api_key or '').encode('utf-8')).hexdigest()
+    cache_key = (config.llm_provider, base_url, key_hash)
+
+    client = _clients.get(cache_key)
+    if client is not None:
+        metrics.incr('llm.clients.reused')
+        return client
+
     print(f"[LLM] Initializing {config.llm_provider} client.")
-    return openai.OpenAI(api_key=config.llm_api_key)
+    client = _build_llm_client(config.llm_api_key, base_url)
+    _clients[cache_key] = client
+    metrics.incr('llm.clients.created')
+    return client
+
+@contextmanager
+def llm_client(config):
+    """Lends out the client for `config` for one call; reset_llm_clients won't close it meanwhile."""
+    with _clients_lock:
+        client = _get_llm_client(config)
+        _leases[client] = _leases.get(client, 0) + 1
+    try:
+        yield client
+    finally:
+        with _clients_lock:
+            _leases[client] -= 1
+            done = _leases[client] == 0
+            if done:
+                del _leases[client]
+            close = done and client in _retired
+            if close:
+                _retired.discard(client)
+        if close:
+            _close_llm_client(client)
 
 def extract_receipt_details(content, is_image, config):
     """
@@ -91,36 +276,34 @@ def extract_receipt_details(content, is_image, config):
     if not config.llm_api_key:
         raise ValueError("LLM API key is not configured.")
 
-    client = get_llm_client(config)
-    
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
 
     if is_image:
-        base64_image = encode_image_to_base64(content)
         messages.append({
             "role": "user",
             "content": [
                 {"type": "text", "text": "Please analyze this receipt image, extract its data, and provide a tax analysis."},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                {"type": "image_url", "image_url": {"url": image_data_url(content)}}
             ]
         })
-        # Select the correct vision model for the provider.
-        model = "meta-llama/llama-4-scout-17b-16e-instruct" if config.llm_provider == 'groq' else "gpt-4o"
+        model = select_model(config.llm_provider, is_image)
     else:
         messages.append({
             "role": "user",
             "content": f"Please analyze this receipt text, extract its data, and provide a tax analysis:\n\n{content}"
         })
-        model = "llama-3.3-70b-versatile" if config.llm_provider == 'groq' else "gpt-4o"
+        model = select_model(config.llm_provider, is_image)
 
     try:
         print(f"[LLM] Calling model '{model}' with tool-calling enabled...")
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto"
-        )
+        with llm_client(config) as client:
+            response = call_llm_scheduled(
+                client, config.llm_provider, estimate_tokens(messages, is_image),
+                model=model,
+                messages=messages,
+                tools=TOOLS,
+                tool_choice="auto"
+            )
         response_message = response.choices[0].message
         tool_calls = response_message.tool_calls
         if not tool_calls:
@@ -135,3 +318,39 @@ def extract_receipt_details(content, is_image, config):
     except Exception as e:
         print(f"[LLM Error] An error occurred during LLM call: {e}")
         raise
+
+def describe_receipt(fields, items, config):
+    """
+    Asks the LLM only for the description and tax analysis of a receipt whose
+    fields were already parsed from the TRA page. Returns the two narrative fields.
+    """
+    if not config.llm_api_key:
+        raise ValueError("LLM API key is not configured.")
+
+    model = select_model(config.llm_provider, False)
+    receipt_summary = json.dumps(fields, ensure_ascii=False)
+    item_lines = "\n".join(items) or "(no item lines)"
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": f"These receipt fields were read from the TRA verification page:\n{receipt_summary}\n\n"
+                       f"Items (description, quantity, amount):\n{item_lines}\n\n"
+                       "Call `save_receipt_analysis` with a summary of the purchase and your tax analysis."
+        }
+    ]
+
+    print(f"[LLM] Calling model '{model}' for the receipt analysis only...")
+    with llm_client(config) as client:
+        response = call_llm_scheduled(
+            client, config.llm_provider, estimate_tokens(messages, False, ANALYSIS_TOOLS),
+            model=model,
+            messages=messages,
+            tools=ANALYSIS_TOOLS,
+            tool_choice="auto"
+        )
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls or tool_calls[0].function.name != 'save_receipt_analysis':
+        raise ValueError("LLM did not call the required tool to save the analysis.")
+    analysis = json.loads(tool_calls[0].function.arguments)
+    return {key: analysis.get(key) for key in ('llm_extracted_description', 'llm_tax_analysis')}
@@ -0,0 +1,183 @@
+# utils/llm_scheduler.py
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from .metrics import metrics
+
+class LLMRateLimited(Exception):
+    """Raised when a provider keeps throttling us; the job should be retried later, not failed."""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """
+    A per-minute budget refilled continuously. The balance may go negative when a
+    call turns out to cost more than estimated; later calls then wait off the debt.
+    """
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.balance = self.capacity
+        self._rate = self.capacity / 60.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.balance = min(self.capacity, self.balance + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def delay_for(self, amount, now):
+        """Seconds until `amount` can be taken (never more than a full bucket is required)."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.balance
+        return max(0.0, missing / self._rate)
+
+    def take(self, amount):
+        self.balance -= amount
+
+    def cap(self, remaining):
+        """Aligns our view with the provider's own count of what is left."""
+        self.balance = min(self.balance, float(remaining))
+
+class ProviderLimiter:
+    """
+    Admission control for one LLM provider: request and token buckets, a pause
+    honouring Retry-After, and an AIMD concurrency limit. The limit grows by roughly
+    one slot per window of successful calls and halves on every 429.
+    """
+    def __init__(self, rpm, tpm, max_concurrency, initial_concurrency=None):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(min(self.max_concurrency, initial_concurrency or self.max_concurrency))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, estimated_tokens, deadline=None):
+        """
+        Waits for budget and a free slot. With a `deadline` (a time.monotonic() value),
+        raises LLMRateLimited once the wait would run past it, so the job is parked
+        instead of holding its claim while it queues.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                delay = max(
+                    self.blocked_until - now,
+                    self.requests.delay_for(1, now),
+                    self.tokens.delay_for(estimated_tokens, now)
+                )
+                if delay <= 0 and self.in_flight < int(self.limit):
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    self.in_flight += 1
+                    return
+                # Either wait out the budget, or until a running call frees a slot.
+                timeout = delay if delay > 0 else None
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0 or delay > remaining:
+                        metrics.incr('llm_scheduler.queue_timeouts')
+                        raise LLMRateLimited("Waited too long for the provider's rate limit", retry_after=delay or None)
+                    timeout = min(timeout, remaining) if timeout else remaining
+                self._cond.wait(timeout=timeout)
+
+    def release(self, estimated_tokens, outcome, used_tokens=None, retry_after=None, remaining=None):
+        """
+        Returns a slot. `outcome` is 'success', 'throttled' (HTTP 429) or 'error';
+        only successes grow the concurrency limit and only throttling shrinks it.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                # Settle the difference between the estimate and what the call really cost.
+                self.tokens.take(used_tokens - estimated_tokens)
+            if remaining:
+                if remaining.get('requests') is not None:
+                    self.requests.cap(remaining['requests'])
+                if remaining.get('tokens') is not None:
+                    self.tokens.cap(remaining['tokens'])
+            if outcome == 'throttled':
+                self.limit = max(1.0, self.limit / 2)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + (retry_after or 1.0))
+            elif outcome == 'success':
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'concurrency_limit': round(self.limit, 2), 'in_flight': self.in_flight,
+                'requests_available': round(self.requests.balance, 1), 'tokens_available': round(self.tokens.balance),
+                'paused_for_seconds': round(max(0.0, self.blocked_until - time.monotonic()), 1)
+            }
+
+class LLMScheduler:
+    """Holds one limiter per provider, created lazily from the configured limits."""
+    def __init__(self):
+        self._limits = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.max_wait_seconds = None
+
+    def configure(self, limits, max_wait_seconds=None):
+        """`max_wait_seconds` caps how long one call may queue for its provider (None: no cap)."""
+        with self._lock:
+            self._limits = dict(limits)
+            self._limiters = {}
+            self.max_wait_seconds = max_wait_seconds
+
+    def limiter(self, provider):
+        with self._lock:
+            if provider not in self._limiters:
+                limits = self._limits.get(provider) or self._limits.get('default', {})
+                self._limiters[provider] = ProviderLimiter(
+                    rpm=limits.get('rpm', 60), tpm=limits.get('tpm', 60000),
+                    max_concurrency=limits.get('max_concurrency', 4),
+                    initial_concurrency=limits.get('initial_concurrency')
+                )
+            return self._limiters[provider]
+
+    def snapshot(self):
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {provider: limiter.snapshot() for provider, limiter in limiters.items()}
+
+def parse_retry_after(headers):
+    """Reads Retry-After (seconds or HTTP date) or retry-after-ms from response headers."""
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def parse_remaining(headers):
+    """Reads the x-ratelimit-remaining-* headers that OpenAI and Groq send back."""
+    remaining = {}
+    for kind in ('requests', 'tokens'):
+        value = headers.get(f'x-ratelimit-remaining-{kind}') if headers else None
+        try:
+            remaining[kind] = float(value) if value is not None else None
+        except ValueError:
+            remaining[kind] = None
+    return remaining
+
+# Create a single global scheduler for the process
+llm_scheduler = LLMScheduler()
+metrics.register('llm_scheduler', llm_scheduler.snapshot)
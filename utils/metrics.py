@@ -0,0 +1,51 @@
+# utils/metrics.py
+import threading
+import time
+from collections import defaultdict
+
+class Metrics:
+    """
+    Process-local counters and timings, served as JSON by /admin/metrics.
+    Components with their own state (schedulers, caches) register a snapshot function.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timings = {}
+        self._sources = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def count(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def observe(self, name, seconds):
+        """Records one duration under `name` (count, total and max)."""
+        with self._lock:
+            timing = self._timings.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            timing['count'] += 1
+            timing['total_ms'] += seconds * 1000
+            timing['max_ms'] = max(timing['max_ms'], seconds * 1000)
+
+    def register(self, name, snapshot_fn):
+        self._sources[name] = snapshot_fn
+
+    def snapshot(self):
+        with self._lock:
+            data = {
+                'collected_at': time.time(),
+                'counters': dict(self._counters),
+                'timings': {
+                    name: {**timing, 'avg_ms': timing['total_ms'] / timing['count']}
+                    for name, timing in self._timings.items()
+                },
+            }
+        for name, snapshot_fn in self._sources.items():
+            data[name] = snapshot_fn()
+        return data
+
+# Create a single global instance for the process
+metrics = Metrics()
@@ -0,0 +1,232 @@
+# utils/outbox.py
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+import gevent
+from gevent.event import Event
+from sqlalchemy import and_, exists, update
+from sqlalchemy.orm import aliased
+from models.user import db, OutboxEvent
+from .job_queue import retry_delay_seconds
+from .metrics import metrics
+from .sqlite_engine import write_batcher
+
+class PermanentDeliveryError(Exception):
+    """Raised by a sink when retrying can't help (e.g. the receiver rejects the request); the batch is dead-lettered."""
+
+# A batch claimed longer than this is assumed to belong to a dead worker.
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+_settings = {
+    'max_attempts': 12, 'retry_base_seconds': 10, 'retry_max_seconds': 3600,
+    'retention': timedelta(days=7), 'sweep_interval': 60,
+}
+
+def configure_outbox(max_attempts, retry_base_seconds, retry_max_seconds, retention_days, sweep_interval):
+    _settings.update(
+        max_attempts=max_attempts, retry_base_seconds=retry_base_seconds, retry_max_seconds=retry_max_seconds,
+        retention=timedelta(days=retention_days), sweep_interval=sweep_interval
+    )
+
+def enqueue_event(destinations, event_type, payload):
+    """Appends one outbox row per destination and commits. Delivery happens in the background."""
+    if not destinations:
+        return
+    body = json.dumps(payload, default=str)
+    submission_id = payload.get('submission_id') or payload.get('id')
+    for destination in destinations:
+        db.session.add(OutboxEvent(destination=destination, event_type=event_type, submission_id=submission_id, payload=body))
+    db.session.commit()
+    outbox_worker.wake(destinations)
+
+def claim_outbox_batch(destination, limit):
+    """
+    Claims the oldest pending events for `destination`, in order, and returns them.
+    Events are delivered strictly in order per destination, so nothing is claimed
+    while another worker still holds a batch for it, or while the oldest event is
+    backing off after a failure. A batch that failed is retried exactly as it was
+    claimed, so sinks that name their output after the batch (S3 archives)
+    overwrite the earlier attempt.
+    """
+    now = datetime.utcnow()
+    head = db.session.query(OutboxEvent.id, OutboxEvent.next_attempt_at, OutboxEvent.attempts, OutboxEvent.claim_token).filter(
+        OutboxEvent.destination == destination, OutboxEvent.status == 'pending'
+    ).order_by(OutboxEvent.id.asc()).limit(limit).all()
+
+    ids = []
+    for event_id, next_attempt_at, _, _ in head:
+        if next_attempt_at and next_attempt_at > now:
+            break
+        ids.append(event_id)
+    if not ids:
+        return []
+    if head[0].attempts and head[0].claim_token:
+        # mark_failed keeps the failed batch's token: take back exactly those events
+        ids = [event_id for (event_id,) in db.session.query(OutboxEvent.id).filter(
+            OutboxEvent.destination == destination, OutboxEvent.status == 'pending',
+            OutboxEvent.claim_token == head[0].claim_token
+        )]
+
+    token = uuid.uuid4().hex
+    cutoff = now - CLAIM_TIMEOUT
+    held = aliased(OutboxEvent)
+    claimed = write_batcher.execute(update(OutboxEvent).where(
+        OutboxEvent.id.in_(ids),
+        OutboxEvent.status == 'pending',
+        ~exists().where(and_(
+            held.destination == destination, held.status == 'pending', held.claimed_at >= cutoff
+        ))
+    ).values(claimed_at=now, claim_token=token))
+    if not claimed:
+        return []
+    return OutboxEvent.query.filter_by(claim_token=token).order_by(OutboxEvent.id.asc()).all()
+
+def mark_delivered(events):
+    # One statement for the batch, committed alongside the other destinations' marks
+    write_batcher.execute(update(OutboxEvent).where(OutboxEvent.id.in_([event.id for event in events])).values(
+        status='delivered', delivered_at=datetime.utcnow(), attempts=OutboxEvent.attempts + 1,
+        claimed_at=None, last_error=None
+    ))
+
+def mark_failed(events, error):
+    """
+    Backs the batch off for a retry, or dead-letters the events that have used up
+    their attempts. Returns the number of seconds until the next attempt (0 if dead-lettered).
+    The whole batch backs off for the same time, as it is retried as one.
+    """
+    now = datetime.utcnow()
+    attempt = max(event.attempts for event in events) + 1
+    retry_delay = retry_delay_seconds(attempt, _settings['retry_base_seconds'], _settings['retry_max_seconds'])
+    delay = 0
+    for event in events:
+        event.attempts += 1
+        event.claimed_at = None
+        event.last_error = str(error)
+        if event.attempts >= _settings['max_attempts'] or isinstance(error, PermanentDeliveryError):
+            event.status = 'dead'
+            print(f"[Outbox] Dead-lettered {event.destination} event {event.id} ({event.event_type}) after {event.attempts} attempts: {error}")
+        else:
+            delay = retry_delay
+            event.next_attempt_at = now + timedelta(seconds=delay)
+    db.session.commit()
+    return delay
+
+def seconds_until_outbox_due(destination, default_seconds):
+    next_due = db.session.query(db.func.min(OutboxEvent.next_attempt_at)).filter(
+        OutboxEvent.destination == destination, OutboxEvent.status == 'pending'
+    ).scalar()
+    if next_due is None:
+        return default_seconds
+    return min(default_seconds, max(1.0, (next_due - datetime.utcnow()).total_seconds()))
+
+def purge_delivered_events():
+    """Drops delivered events past the retention period. Runs at most once per sweep interval."""
+    now = time.monotonic()
+    if now - _settings.get('last_purge', 0) < _settings['sweep_interval']:
+        return
+    _settings['last_purge'] = now
+    cutoff = datetime.utcnow() - _settings['retention']
+    OutboxEvent.query.filter(OutboxEvent.status == 'delivered', OutboxEvent.delivered_at < cutoff) \
+                     .delete(synchronize_session=False)
+    db.session.commit()
+
+def retry_dead_events():
+    """Puts every dead-lettered event back in line, e.g. after a destination was fixed. Returns how many."""
+    revived = OutboxEvent.query.filter_by(status='dead').update({
+        'status': 'pending', 'attempts': 0, 'next_attempt_at': None, 'claimed_at': None
+    }, synchronize_session=False)
+    db.session.commit()
+    if revived:
+        outbox_worker.wake()
+    return revived
+
+def outbox_counts():
+    """Pending and dead-lettered events per destination, for the queue page."""
+    rows = db.session.query(OutboxEvent.destination, OutboxEvent.status, db.func.count(OutboxEvent.id)) \
+                     .filter(OutboxEvent.status != 'delivered') \
+                     .group_by(OutboxEvent.destination, OutboxEvent.status).all()
+    counts = {}
+    for destination, status, count in rows:
+        counts.setdefault(destination, {'pending': 0, 'dead': 0})[status] = count
+    return counts
+
+class OutboxWorker:
+    """
+    One delivery greenlet per export destination, so a slow or failing destination
+    never holds up the others (or intake). Each sink receives a list of events and
+    raises on failure; the whole batch is then retried with backoff.
+    """
+    def __init__(self):
+        self._wakeups = {}
+        self._greenlets = {}
+
+    def start(self, app, sinks, get_config, enabled_destinations):
+        """
+        `sinks` maps a destination name to (deliver_fn, max_batch_size, linger_seconds);
+        `enabled_destinations(config)` says which destinations are currently configured.
+        """
+        for destination, (deliver, batch_size, linger) in sinks.items():
+            if destination in self._greenlets:
+                continue
+            self._wakeups[destination] = Event()
+            self._greenlets[destination] = gevent.spawn(
+                self._run, app, destination, deliver, batch_size, linger, get_config, enabled_destinations
+            )
+        print(f"[Outbox] Delivery workers started for: {', '.join(sinks)}.")
+
+    def wake(self, destinations=None):
+        for destination in destinations or list(self._wakeups):
+            if destination in self._wakeups:
+                self._wakeups[destination].set()
+
+    def _run(self, app, destination, deliver, batch_size, linger, get_config, enabled_destinations):
+        wakeup = self._wakeups[destination]
+        while True:
+            # Batching sinks give a burst a moment to accumulate before flushing it in one go.
+            if linger:
+                gevent.sleep(linger)
+            wakeup.clear()
+            try:
+                with app.app_context():
+                    timeout = self._drain(destination, deliver, batch_size, get_config, enabled_destinations)
+            except Exception as e:
+                print(f"[Outbox Error] {destination} delivery pass failed: {e}")
+                timeout = _settings['sweep_interval']
+            wakeup.wait(timeout=timeout)
+
+    def _drain(self, destination, deliver, batch_size, get_config, enabled_destinations):
+        while True:
+            config = get_config()
+            if not config or destination not in enabled_destinations(config):
+                # Paused, not failing: its events stay pending, attempts untouched,
+                # until the destination is configured again (saving the settings wakes us).
+                purge_delivered_events()
+                return _settings['sweep_interval']
+
+            events = claim_outbox_batch(destination, batch_size)
+            if not events:
+                purge_delivered_events()
+                return seconds_until_outbox_due(destination, _settings['sweep_interval'])
+
+            started = time.monotonic()
+            try:
+                deliver([{
+                    'id': event.id, 'event_type': event.event_type, 'submission_id': event.submission_id,
+                    'payload': json.loads(event.payload), 'created_at': event.created_at
+                } for event in events], config)
+            except Exception as e:
+                metrics.incr(f'outbox.{destination}.failed', len(events))
+                print(f"[Outbox] Delivery of {len(events)} event(s) to {destination} failed: {e}")
+                delay = mark_failed(events, e)
+                if delay:
+                    # Keep the order: nothing else for this destination goes out before the retry.
+                    return delay
+                continue
+
+            metrics.observe(f'outbox.{destination}.deliver', time.monotonic() - started)
+            metrics.incr(f'outbox.{destination}.delivered', len(events))
+            mark_delivered(events)
+
+# A single set of delivery workers per app process
+outbox_worker = OutboxWorker()
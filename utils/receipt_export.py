@@ -0,0 +1,205 @@
+# utils/receipt_export.py
+import csv
+import io
+import json
+import re
+import zipfile
+import zlib
+from datetime import datetime, date
+from xml.sax.saxutils import escape
+from sqlalchemy import select, func, case, tuple_, literal
+from models.user import Submission, Receipt
+from .search_index import search_matches, search_condition
+from .sqlite_engine import read_session
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+EXPORT_BATCH_SIZE = 1000
+
+# (header, field) in export order
+EXPORT_COLUMNS = [
+    ('ID', 'id'), ('Status', 'status'), ('Received At', 'received_at'), ('Processed At', 'processed_at'),
+    ('Vendor', 'vendor_name'), ('Vendor TIN', 'vendor_tin'), ('VRN', 'vrn'), ('Receipt No', 'receipt_number'),
+    ('Verification Code', 'receipt_verification_code'), ('Receipt Date', 'receipt_date'),
+    ('Total Amount', 'total_amount'), ('VAT Amount', 'vat_amount'), ('LLM Description', 'description'),
+    ('Tax Analysis', 'llm_tax_analysis'), ('Customer Name', 'customer_name'), ('Customer ID', 'customer_id'),
+]
+
+def _export_query(search, start_date, end_date):
+    """
+    Completed receipts matching the filters, and the order to read them in as
+    (extra condition, sort columns, ascending) segments. Each segment's columns end
+    with a unique id, so it can be read in keyset batches. Best search matches come
+    first; otherwise the newest receipt dates, then the undated receipts.
+    """
+    matches = search_matches(search) if search else None
+    query = select(
+        Receipt.submission_id.label('id'), literal('completed').label('status'), Submission.received_at, Receipt.processed_at,
+        Receipt.vendor_name, Receipt.vendor_tin, Receipt.vrn, Receipt.receipt_number, Receipt.receipt_verification_code,
+        Receipt.receipt_date, Receipt.total_amount, Receipt.vat_amount, Submission.description,
+        case((func.json_valid(Receipt.raw_llm_response), func.json_extract(Receipt.raw_llm_response, '$.llm_tax_analysis')),
+             else_=None).label('llm_tax_analysis'),
+        Receipt.customer_name, Receipt.customer_id
+    ).select_from(Receipt).join(Submission, Submission.id == Receipt.submission_id) \
+     .where(func.likely(Submission.status == 'completed'))  # Nearly every receipt is; walk the sort index instead
+
+    if start_date:
+        query = query.where(Receipt.receipt_date >= start_date)
+    if end_date:
+        query = query.where(Receipt.receipt_date <= end_date)
+    if matches is not None:
+        query = query.join(matches, matches.c.submission_id == Receipt.submission_id)
+        return query, [(None, [matches.c.rank, Receipt.id], True)]
+    if search:
+        query = query.where(search_condition(search))
+    return query, [
+        (Receipt.receipt_date.is_not(None), [Receipt.receipt_date, Receipt.id], False),
+        (Receipt.receipt_date.is_(None), [Receipt.id], False),
+    ]
+
+def export_rows(search='', start_date=None, end_date=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields lists of export rows, one database batch at a time. Each batch is a short
+    keyset query whose rows are streamed with yield_per, so memory stays bounded and
+    no read transaction is held open while a slow client downloads the previous batch.
+    """
+    query, segments = _export_query(search, start_date, end_date)
+    for condition, columns, ascending in segments:
+        segment_query = query.add_columns(*[column.label(f'sort_{n}') for n, column in enumerate(columns)])
+        if condition is not None:
+            segment_query = segment_query.where(condition)
+        segment_query = segment_query.order_by(*[column.asc() if ascending else column.desc() for column in columns])
+        position = tuple_(*columns)
+        after = None
+        while True:
+            batch_query = segment_query
+            if after is not None:
+                bound = tuple_(*[literal(value, column.type) for value, column in zip(after, columns)])
+                batch_query = batch_query.where(position > bound if ascending else position < bound)
+            batch = list(read_session.execute(batch_query.limit(batch_size).execution_options(yield_per=batch_size)))
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                break
+            after = [getattr(batch[-1], f'sort_{n}') for n in range(len(columns))]
+
+def _cell(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+# --- Formats: each turns batches of rows into chunks of bytes ---
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _ in EXPORT_COLUMNS])
+    yield buffer.getvalue().encode('utf-8')
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate(0)
+        for row in batch:
+            writer.writerow([_cell(getattr(row, field)) for _, field in EXPORT_COLUMNS])
+        yield buffer.getvalue().encode('utf-8')
+
+def ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(
+            json.dumps({field: _cell(getattr(row, field)) for _, field in EXPORT_COLUMNS}) + '\n' for row in batch
+        ).encode('utf-8')
+
+# Characters XML 1.0 does not allow, even escaped
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _xlsx_cell(value):
+    value = _cell(value)
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c t="n"><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_XML_ILLEGAL.sub("", str(value)))}</t></is></c>'
+
+def _xlsx_row(values):
+    return '<row>' + ''.join(_xlsx_cell(value) for value in values) + '</row>'
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Receipts" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+class _ChunkBuffer:
+    """A write-only, unseekable file for ZipFile; the bytes written so far are taken with drain()."""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+def xlsx_chunks(batches):
+    """
+    A one-sheet workbook written as a streamed zip: the worksheet XML is compressed
+    batch by batch, and zipfile uses data descriptors since the output can't seek.
+    """
+    output = _ChunkBuffer()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_PARTS.items():
+            workbook.writestr(name, content)
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_row([header for header, _ in EXPORT_COLUMNS])
+            ).encode('utf-8'))
+            yield output.drain()
+            for batch in batches:
+                sheet.write(''.join(_xlsx_row([getattr(row, field) for _, field in EXPORT_COLUMNS]) for row in batch).encode('utf-8'))
+                yield output.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield output.drain()
+
+FORMAT_WRITERS = {'csv': csv_chunks, 'ndjson': ndjson_chunks, 'xlsx': xlsx_chunks}
+
+def gzip_chunks(chunks):
+    """Gzips a chunk stream, flushing after every chunk so the client keeps receiving data."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
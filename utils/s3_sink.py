@@ -0,0 +1,149 @@
+# utils/s3_sink.py
+import gzip
+import hashlib
+import io
+import json
+import threading
+import boto3
+from boto3.s3.transfer import TransferConfig
+from .metrics import metrics
+
+ARCHIVE_PREFIX = 'archive'
+
+# Batches above this size are uploaded in parts by upload_fileobj.
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+
+class S3Sink:
+    """
+    Writes export events to S3. The boto3 client is cached per credentials and endpoint.
+    In 'object' mode every event is its own JSON object (the original layout); in
+    'archive' mode each outbox batch becomes one gzip NDJSON object per hourly
+    partition, next to a small manifest listing the submissions it contains.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._client_key = None
+        self.mode = 'object'
+        self.endpoint_url = None
+
+    def configure(self, mode, endpoint_url=None):
+        self.mode = mode
+        self.endpoint_url = endpoint_url or None
+        self._client = None
+
+    def client(self, config):
+        key = hashlib.sha256('\0'.join([
+            config.s3_access_key_id, config.s3_secret_access_key, config.s3_region, self.endpoint_url or ''
+        ]).encode('utf-8')).hexdigest()
+        with self._lock:
+            if self._client is None or self._client_key != key:
+                session = boto3.Session(
+                    aws_access_key_id=config.s3_access_key_id,
+                    aws_secret_access_key=config.s3_secret_access_key,
+                    region_name=config.s3_region
+                )
+                self._client = session.client('s3', endpoint_url=self.endpoint_url)
+                self._client_key = key
+                metrics.incr('s3.clients.created')
+            return self._client
+
+    def deliver(self, events, config):
+        if self.mode == 'archive':
+            self.archive(events, config)
+        else:
+            for event in events:
+                self.put_event(event['event_type'], event['payload'], config)
+
+    def put_event(self, event_type, payload, config):
+        timestamp = payload.get('received_at') or payload.get('processed_at')
+        submission_id = payload.get('submission_id') or payload.get('id')
+        object_key = f"{event_type}/{str(timestamp).split('T')[0]}/{submission_id}.json"
+
+        try:
+            self.client(config).put_object(
+                Bucket=config.s3_bucket_name,
+                Key=object_key,
+                Body=json.dumps(payload, default=str, indent=2),
+                ContentType='application/json'
+            )
+            metrics.incr('s3.puts')
+            print(f"Successfully logged event to S3 bucket {config.s3_bucket_name} at {object_key}")
+        except Exception as e:
+            print(f"Error logging to S3: {e}")
+            raise
+
+    def archive(self, events, config):
+        """
+        Uploads a batch as gzip NDJSON, split by the hour the events were created in.
+        Each object is named after its first outbox id. The outbox retries a failed
+        batch with exactly the same events, so a retry overwrites whatever the earlier
+        attempt managed to upload instead of creating a duplicate.
+        """
+        partitions = {}
+        for event in events:
+            partitions.setdefault(event['created_at'].strftime('%Y/%m/%d/%H'), []).append(event)
+
+        s3 = self.client(config)
+        for partition, partition_events in partitions.items():
+            name = f"{ARCHIVE_PREFIX}/{partition}/events-{partition_events[0]['id']:010d}"
+            body = io.BytesIO()
+            submissions = {}
+            with gzip.GzipFile(fileobj=body, mode='wb') as archive:
+                for line_number, event in enumerate(partition_events):
+                    record = {
+                        'event_id': event['id'], 'event_type': event['event_type'],
+                        'created_at': event['created_at'], 'payload': event['payload']
+                    }
+                    archive.write((json.dumps(record, default=str) + '\n').encode('utf-8'))
+                    if event['submission_id'] is not None:
+                        submissions.setdefault(str(event['submission_id']), []).append(line_number)
+            size = body.tell()
+            body.seek(0)
+
+            try:
+                s3.upload_fileobj(
+                    body, config.s3_bucket_name, f"{name}.ndjson.gz",
+                    ExtraArgs={'ContentType': 'application/x-ndjson', 'ContentEncoding': 'gzip'},
+                    Config=TRANSFER_CONFIG
+                )
+                manifest = {
+                    'object_key': f"{name}.ndjson.gz", 'event_count': len(partition_events),
+                    'first_event_at': partition_events[0]['created_at'], 'last_event_at': partition_events[-1]['created_at'],
+                    'submissions': submissions  # submission id -> line numbers in the archive
+                }
+                s3.put_object(
+                    Bucket=config.s3_bucket_name, Key=f"{name}.manifest.json",
+                    Body=json.dumps(manifest, default=str), ContentType='application/json'
+                )
+            except Exception as e:
+                print(f"Error archiving to S3: {e}")
+                raise
+            metrics.incr('s3.archive.objects')
+            metrics.incr('s3.archive.bytes', size)
+            print(f"[S3] Archived {len(partition_events)} event(s) to {name}.ndjson.gz ({size} bytes).")
+
+    def find_archived_events(self, config, submission_id, day):
+        """
+        Returns the archived events of one submission from a given day (a date), using
+        the manifests to open only the archives that contain it.
+        """
+        s3 = self.client(config)
+        found = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=config.s3_bucket_name, Prefix=f"{ARCHIVE_PREFIX}/{day.strftime('%Y/%m/%d')}/"):
+            for item in page.get('Contents', []):
+                if not item['Key'].endswith('.manifest.json'):
+                    continue
+                manifest = json.loads(s3.get_object(Bucket=config.s3_bucket_name, Key=item['Key'])['Body'].read())
+                lines = set(manifest['submissions'].get(str(submission_id), []))
+                if not lines:
+                    continue
+                archive = s3.get_object(Bucket=config.s3_bucket_name, Key=manifest['object_key'])['Body'].read()
+                for line_number, line in enumerate(gzip.decompress(archive).splitlines()):
+                    if line_number in lines:
+                        found.append(json.loads(line))
+        return found
+
+# Create a single global sink for the process
+s3_sink = S3Sink()
@@ -0,0 +1,61 @@
+# utils/search_index.py
+import re
+from sqlalchemy import select, func, or_, table, column, literal_column, text
+from models.user import db, Submission, Receipt
+from models.schema import SEARCH_TABLE
+
+# Column weights for ranking, in models.schema.SEARCH_COLUMNS order: a vendor
+# name or tax number hit ranks above a word in the LLM's tax analysis.
+RANK_WEIGHTS = (10.0, 8.0, 8.0, 3.0, 2.0, 1.0)
+
+search_table = table(SEARCH_TABLE, column('rowid'))
+_state = {'available': None}
+
+def search_available():
+    """Whether the FTS5 index exists in this database (see models.schema.install_search_index)."""
+    if _state['available'] is None:
+        _state['available'] = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': SEARCH_TABLE}
+        ).first() is not None
+    return _state['available']
+
+def fts_query(search):
+    """
+    Turns what the user typed into an FTS5 query: every word must match, as a
+    prefix, so "alph 1234" finds "Alpha Stores" with TIN 123456789. A word with
+    punctuation inside ("123-456-789") matches as a phrase. Returns None when
+    there is nothing searchable (e.g. only symbols).
+    """
+    terms = []
+    for word in search.split():
+        tokens = re.findall(r'\w+', word)
+        if tokens:
+            terms.append('"' + ' '.join(tokens) + '"*')
+    return ' '.join(terms) or None
+
+def search_matches(search):
+    """
+    A subquery of (submission_id, rank) for submissions matching `search`, best
+    match first (lower rank is better). None if the index can't answer it.
+    """
+    query = fts_query(search)
+    if not query or not search_available():
+        return None
+    return select(
+        search_table.c.rowid.label('submission_id'),
+        func.bm25(literal_column(SEARCH_TABLE), *RANK_WEIGHTS).label('rank')
+    ).where(literal_column(SEARCH_TABLE).op('MATCH')(query)).subquery('search_matches')
+
+def search_condition(search):
+    """
+    A WHERE condition on Submission matching `search`. Uses the FTS index, or a LIKE
+    over vendor name and description when the index is unavailable; the LIKE form
+    needs Receipt joined to the query.
+    """
+    matches = search_matches(search)
+    if matches is not None:
+        return Submission.id.in_(select(matches.c.submission_id))
+    return or_(
+        Receipt.vendor_name.icontains(search, autoescape=True),
+        Submission.description.icontains(search, autoescape=True)
+    )
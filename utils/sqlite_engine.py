@@ -0,0 +1,269 @@
+# utils/sqlite_engine.py
+import sqlite3
+import time
+from collections import deque
+import gevent
+from gevent.event import Event, AsyncResult
+from gevent.lock import Semaphore
+from gevent.threadpool import ThreadPool
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from flask_sqlalchemy.session import _app_ctx_id
+from models.user import db
+from .metrics import metrics
+
+_settings = {'busy_timeout_ms': 5000, 'synchronous': 'NORMAL', 'cache_size_mb': 32, 'mmap_size_mb': 256}
+
+# Heavy read-only work (dashboard pages, stats, exports, the change feed) goes through
+# this session. It is bound to its own pool of query_only connections, so a long
+# export never holds a connection the writers need. One session per app context.
+# With offloading on, those connections run their queries on native threads.
+read_session = scoped_session(sessionmaker(), scopefunc=_app_ctx_id)
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(_settings['busy_timeout_ms'])}")
+    cursor.execute(f"PRAGMA synchronous = {_settings['synchronous']}")  # NORMAL is durable enough in WAL mode
+    cursor.execute(f"PRAGMA cache_size = -{int(_settings['cache_size_mb'] * 1024)}")  # Negative: in KiB
+    cursor.execute(f"PRAGMA mmap_size = {int(_settings['mmap_size_mb'] * 1024 * 1024)}")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.close()
+
+def _apply_read_only(dbapi_connection, connection_record):
+    dbapi_connection.execute("PRAGMA query_only = ON")
+
+def _offloaded(threads, fn, *args):
+    """
+    Runs a driver call on `threads` and returns its result, or raises its error here.
+    Errors are handed back as values: the threadpool would otherwise print a traceback
+    for each one, though most (constraint violations, a busy database) are expected.
+    """
+    def call():
+        try:
+            return fn(*args), None
+        except Exception as e:
+            return None, e
+    result, error = threads.apply(call)
+    if error is not None:
+        raise error
+    return result
+
+class _OffloadedCursor:
+    """A sqlite3 cursor whose statement execution and row fetching run on a native thread."""
+    def __init__(self, cursor, threads):
+        self._cursor = cursor
+        self._threads = threads
+
+    def execute(self, *args):
+        _offloaded(self._threads, self._cursor.execute, *args)
+        return self
+
+    def executemany(self, *args):
+        _offloaded(self._threads, self._cursor.executemany, *args)
+        return self
+
+    def fetchone(self):
+        return _offloaded(self._threads, self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return _offloaded(self._threads, self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return _offloaded(self._threads, self._cursor.fetchall)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class _OffloadedConnection:
+    """
+    A sqlite3 connection handing its queries, commits and rollbacks to a threadpool.
+    The sqlite3 driver never yields to gevent, so a long aggregate, a commit's
+    fsync or a wait in SQLite's busy handler run in the hub stalls every other
+    greenlet (SSE streams, intake, LLM callbacks). Here only the driver calls move
+    to a native thread. SQLAlchemy still builds statements and turns rows into
+    results in the greenlet, and the pool hands each connection to one greenlet
+    at a time.
+    """
+    def __init__(self, connection, threads):
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_threads', threads)
+
+    def cursor(self, *args):
+        return _OffloadedCursor(self._connection.cursor(*args), self._threads)
+
+    def commit(self):
+        _offloaded(self._threads, self._connection.commit)
+
+    def rollback(self):
+        _offloaded(self._threads, self._connection.rollback)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+class WriterLock:
+    """
+    One write transaction at a time in this process, waited for cooperatively.
+    SQLite allows a single writer per database; without this, a greenlet whose
+    write meets another greenlet's open transaction spins in SQLite's busy handler,
+    which blocks the gevent hub, so the holder can never finish and both end in
+    'database is locked'. Taken at a connection's first write statement and
+    released when that transaction commits or rolls back.
+    """
+    def __init__(self):
+        self._semaphore = Semaphore(1)
+        self.owner = None
+
+    def acquire(self, timeout):
+        started = time.monotonic()
+        if not self._semaphore.acquire(timeout=timeout):
+            metrics.incr('sqlite.writer_timeouts')
+            return False
+        self.owner = gevent.getcurrent()
+        metrics.observe('sqlite.writer_wait', time.monotonic() - started)
+        return True
+
+    def release(self):
+        self.owner = None
+        self._semaphore.release()
+
+    def held_by_current(self):
+        return self.owner is gevent.getcurrent()
+
+writer_lock = WriterLock()
+
+_WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+
+def _take_writer_lock(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get('holds_writer') or not statement.lstrip()[:7].upper().startswith(_WRITE_STATEMENTS):
+        return
+    if not writer_lock.acquire(timeout=_settings['busy_timeout_ms'] / 1000):
+        raise sqlite3.OperationalError("database is locked (another write in this process took too long)")
+    conn.info['holds_writer'] = True
+
+def _release_writer_lock(conn):
+    # Fires just before the DBAPI commit/rollback. On an offloaded connection that commit
+    # may still be running when the next writer starts; its first statement then waits
+    # in SQLite's busy handler on its own thread, without holding up the hub.
+    if conn.info.pop('holds_writer', False):
+        writer_lock.release()
+
+def _release_on_reset(dbapi_connection, connection_record, reset_state):
+    # A connection returned to the pool without an explicit commit or rollback.
+    if connection_record.info.pop('holds_writer', False):
+        writer_lock.release()
+
+def _offload_connections(engine, threads):
+    """Makes every new connection of `engine` an _OffloadedConnection running on `threads`."""
+    path = engine.url.database
+    def connect(dialect, connection_record, cargs, cparams):
+        connection = sqlite3.connect(path, timeout=_settings['busy_timeout_ms'] / 1000, check_same_thread=False)
+        return _OffloadedConnection(connection, threads)
+    event.listen(engine, 'do_connect', connect)
+
+def configure_sqlite(app, busy_timeout_ms, synchronous, cache_size_mb, mmap_size_mb, read_pool_size,
+                     offload_reads=False, offload_writes=False):
+    """
+    Puts the database in WAL mode (readers and the writer no longer block each other),
+    tunes every connection, serializes this process's writers and binds read_session to
+    a separate read-only engine. With `offload_reads` / `offload_writes`, the read
+    engine's / the main engine's queries and commits run on `read_pool_size` native
+    threads each. Call once, before the first query. Returns the read engine.
+    """
+    _settings.update(busy_timeout_ms=busy_timeout_ms, synchronous=synchronous.upper(),
+                     cache_size_mb=cache_size_mb, mmap_size_mb=mmap_size_mb)
+    engine = db.engine
+    engine.pool.dispose()  # Connections made so far predate the pragmas
+    if offload_writes:
+        _offload_connections(engine, ThreadPool(read_pool_size))
+    event.listen(engine, 'connect', _apply_pragmas)
+    event.listen(engine, 'before_cursor_execute', _take_writer_lock)
+    event.listen(engine, 'commit', _release_writer_lock)
+    event.listen(engine, 'rollback', _release_writer_lock)
+    event.listen(engine, 'reset', _release_on_reset)
+
+    with engine.connect() as conn:
+        mode = conn.exec_driver_sql("PRAGMA journal_mode = WAL").scalar()
+        # Keep the WAL file from growing without bound between checkpoints
+        conn.exec_driver_sql("PRAGMA journal_size_limit = 67108864")
+    if mode != 'wal':
+        print(f"[SQLite] Could not switch to WAL mode (journal_mode={mode}); readers may wait for writers.")
+
+    read_engine = create_engine(engine.url, pool_size=read_pool_size, max_overflow=read_pool_size)
+    if offload_reads:
+        _offload_connections(read_engine, ThreadPool(read_pool_size))
+    event.listen(read_engine, 'connect', _apply_pragmas)
+    event.listen(read_engine, 'connect', _apply_read_only)
+    read_session.configure(bind=read_engine)
+    app.teardown_appcontext(lambda exc: read_session.remove())
+    offloaded = [name for name, enabled in (('reads', offload_reads), ('writes', offload_writes)) if enabled]
+    print(f"[SQLite] journal_mode={mode}, synchronous={_settings['synchronous']}, read pool={read_pool_size}"
+          f"{', ' + ' and '.join(offloaded) + ' on native threads' if offloaded else ''}.")
+    return read_engine
+
+class WriteBatcher:
+    """
+    Group commit for small, independent writes (job claims, delivery marks, cache hit
+    counters). Callers hand in a statement and get its rowcount back; one greenlet runs
+    whatever has queued up meanwhile in a single transaction, so a burst of N status
+    flips costs one commit instead of N.
+    """
+    def __init__(self):
+        self._queue = deque()
+        self._wakeup = Event()
+        self._greenlet = None
+        self._engine = None
+        self._max_batch = 100
+        self._window = 0.0
+
+    def start(self, engine, max_batch, window_seconds):
+        if self._greenlet is not None:
+            return
+        self._engine, self._max_batch, self._window = engine, max_batch, window_seconds
+        self._greenlet = gevent.spawn(self._run)
+
+    def execute(self, statement):
+        """Runs `statement` in the next batch and returns its rowcount once that batch has committed."""
+        if self._greenlet is None:
+            result = db.session.execute(statement)
+            db.session.commit()
+            return result.rowcount
+        if writer_lock.held_by_current():
+            # Waiting for the batch would mean waiting for ourselves: join our own open transaction instead.
+            return db.session.execute(statement).rowcount
+        result = AsyncResult()
+        self._queue.append((statement, result))
+        self._wakeup.set()
+        return result.get()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Let other greenlets that are about to write join this batch.
+            gevent.sleep(self._window)
+            while self._queue:
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self._max_batch))]
+                self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with self._engine.begin() as conn:
+                rowcounts = [conn.execute(statement).rowcount for statement, _ in batch]
+        except Exception as e:
+            if len(batch) > 1:
+                # Don't fail the whole batch for one bad statement: retry them one by one.
+                for item in batch:
+                    self._commit([item])
+            else:
+                batch[0][1].set_exception(e)
+            return
+        metrics.incr('write_batcher.commits')
+        metrics.incr('write_batcher.statements', len(batch))
+        for (_, result), rowcount in zip(batch, rowcounts):
+            result.set(rowcount)
+
+# A single writer per app process
+write_batcher = WriteBatcher()
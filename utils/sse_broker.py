@@ -1,47 +1,238 @@
 # utils/sse_broker.py
-import queue
+import json
+import sqlite3
+import time
+from collections import OrderedDict, deque
+import gevent
+from gevent.event import Event
+from .metrics import metrics
+
+class EventLog:
+    """
+    An append-only SQLite table of SSE messages, shared by every worker process on
+    the host (its own database file, so tailing it never contends with the app's
+    database). Each announce is one insert; each process reads new rows once.
+    """
+    def __init__(self, path, retention_seconds=3600):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")  # Tailers read while another process appends
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sse_event (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, data TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_sse_event_created_at ON sse_event (created_at)")
+            self._conn = conn
+        return self._conn
+
+    def append(self, msg):
+        return self._connection().execute(
+            "INSERT INTO sse_event (created_at, data) VALUES (?, ?)", (time.time(), msg)
+        ).lastrowid
+
+    def last_id(self):
+        return self._connection().execute("SELECT coalesce(max(id), 0) FROM sse_event").fetchone()[0]
+
+    def read_after(self, event_id, limit=500):
+        return self._connection().execute(
+            "SELECT id, data FROM sse_event WHERE id > ? ORDER BY id LIMIT ?", (event_id, limit)
+        ).fetchall()
+
+    def read_latest(self, limit):
+        rows = self._connection().execute("SELECT id, data FROM sse_event ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return rows[::-1]
+
+    def prune(self):
+        self._connection().execute("DELETE FROM sse_event WHERE created_at < ?", (time.time() - self.retention_seconds,))
+
+def _coalesce_key(event_id, msg):
+    """Events about the same submission share a key; a newer one replaces an older one still waiting to be sent."""
+    try:
+        data = json.loads(msg).get('data') or {}
+        submission_id = data.get('submission_id') or data.get('id')
+    except (ValueError, AttributeError):
+        submission_id = None
+    return f"submission-{submission_id}" if submission_id else f"event-{event_id}"
+
+def _id_line(event_id):
+    return f"id: {event_id}\n" if event_id is not None else ""
+
+class SSEClient:
+    """
+    One connected dashboard. Events waiting to be sent are kept per submission, so a
+    client that falls behind gets each submission's latest state instead of every
+    step. If even that backlog grows past max_pending, it is dropped and the client
+    is told to reset (reload its view) rather than being disconnected.
+    """
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()  # key -> (event id, message), oldest first
+        self.reset_pending = False
+        self.reset_id = None  # The id the reset event carries, if any
+        self.seen_through = 0  # Events up to here reached the client through another worker
+        self.wakeup = Event()
+
+    def push(self, event_id, key, msg):
+        """Queues a message; `event_id` is None for messages that never reached the event log."""
+        if event_id is not None and event_id <= self.seen_through:
+            return
+        if key in self.pending:
+            del self.pending[key]  # Re-added at the end, so event ids still go out in order
+            metrics.incr('sse.coalesced')
+        self.pending[key] = (event_id, msg)
+        if len(self.pending) > self.max_pending:
+            self.request_reset(event_id)
+        self.wakeup.set()
+
+    def request_reset(self, event_id):
+        self.pending.clear()
+        self.reset_pending = True
+        self.reset_id = event_id
+        metrics.incr('sse.resets')
+        self.wakeup.set()
 
 class MessageAnnouncer:
     """
     A simple in-memory broker for Server-Sent Events (SSE).
-    This manages multiple listeners in a single-process environment.
+    On its own it serves a single process. With an event log configured, announces
+    are appended to the log and one tailer greenlet per process hands new events
+    to that process's listeners, so every gunicorn worker sees every event.
+
+    Every event has an id (the log's row id, or a local counter without a log) and
+    the most recent ones are kept in a replay ring, so a client reconnecting with
+    Last-Event-ID gets what it missed.
     """
-    def __init__(self):
+    def __init__(self, replay_size=1000, client_max_pending=200):
         self.listeners = []
+        self.event_log = None
+        self.client_max_pending = client_max_pending
+        self.ring = deque(maxlen=replay_size)  # (event id, key, message)
+        self.ring_floor = 0  # Every event after this id is in the ring
+        self.last_id = 0
+        self._unlogged = 0  # Messages delivered without an id, see announce
+        self._wakeup = Event()
+        self._tailer = None
+
+    def configure(self, replay_size, client_max_pending):
+        self.ring = deque(self.ring, maxlen=replay_size)
+        self.client_max_pending = client_max_pending
 
-    def listen(self):
+    def use_event_log(self, event_log, poll_interval=0.5):
+        self.event_log = event_log
+        if self._tailer is None:
+            # Pre-fill the replay ring, so clients reconnecting after a restart can still catch up.
+            self.last_id = self.ring_floor = event_log.last_id()
+            recent = event_log.read_latest(self.ring.maxlen)
+            if recent:
+                self.ring_floor = recent[0][0] - 1
+                self.ring.extend((event_id, _coalesce_key(event_id, msg), msg) for event_id, msg in recent)
+            self._tailer = gevent.spawn(self._tail, self.last_id, poll_interval)
+        print(f"[SSE] Sharing events across workers through {event_log.path}.")
+
+    def listen(self, last_event_id=None):
         """
-        Creates a new queue for a client and returns it.
-        The generator yields messages as they are announced.
+        Registers a client and yields its SSE messages as they are announced, starting
+        with anything it missed since `last_event_id`. If that can't be replayed (too
+        old, or from before a reset of the log), the client gets a reset event instead.
+        A client coming from another worker may be ahead of this worker's tailer; it
+        is caught up and gets only the events after its own as the tailer reads them.
         """
-        q = queue.Queue(maxsize=10) # Use a queue to handle messages
-        self.listeners.append(q)
-        while True:
-            try:
-                # Block until a message is available, with a timeout to prevent hanging
-                msg = q.get(timeout=30)
-                yield msg
-            except queue.Empty:
-                # Send a comment to keep the connection alive if no message for 30s
-                yield ": keep-alive\n\n"
-            except GeneratorExit:
-                # The client has disconnected.
-                self.listeners.remove(q)
-                return
+        client = SSEClient(self.client_max_pending)
+        if last_event_id is not None and last_event_id != self.last_id:
+            if last_event_id > self.last_id and self.event_log is not None and self._in_log(last_event_id):
+                client.seen_through = last_event_id
+            elif self.ring_floor <= last_event_id < self.last_id:
+                for event_id, key, msg in self.ring:
+                    if event_id > last_event_id:
+                        client.push(event_id, key, msg)
+                metrics.incr('sse.replays')
+            else:
+                client.request_reset(self.last_id)
+        self.listeners.append(client)
+        try:
+            while True:
+                if client.reset_pending:
+                    client.reset_pending = False
+                    yield f"{_id_line(client.reset_id)}event: reset\ndata: {{}}\n\n"
+                elif client.pending:
+                    _, (event_id, msg) = client.pending.popitem(last=False)
+                    yield f"{_id_line(event_id)}data: {msg}\n\n"
+                else:
+                    client.wakeup.clear()
+                    if not client.wakeup.wait(timeout=30):
+                        # Send a comment to keep the connection alive if no message for 30s
+                        yield ": keep-alive\n\n"
+        finally:
+            # The client has disconnected.
+            self.listeners.remove(client)
+
+    def _in_log(self, event_id):
+        try:
+            return event_id <= self.event_log.last_id()
+        except sqlite3.Error:
+            return False
 
     def announce(self, msg):
         """
-        Pushes a new message to all connected listeners.
+        Pushes a new message to all connected listeners (in every worker, with an event log).
+        """
+        if self.event_log is None:
+            self._deliver(self.last_id + 1, msg)
+            return
+        try:
+            self.event_log.append(msg)
+            metrics.incr('sse.appended')
+        except sqlite3.Error as e:
+            # Better to reach this worker's clients than nobody.
+            print(f"[SSE Error] Could not append to the event log: {e}")
+            self._deliver_unlogged(msg)
+            return
+        self._wakeup.set()  # Local clients get it now rather than at the next poll
+
+    def _deliver(self, event_id, msg):
+        key = _coalesce_key(event_id, msg)
+        if event_id > self.last_id:
+            if len(self.ring) == self.ring.maxlen:
+                self.ring_floor = self.ring[0][0]
+            self.ring.append((event_id, key, msg))
+            self.last_id = event_id
+        for client in self.listeners:
+            client.push(event_id, key, msg)
+
+    def _deliver_unlogged(self, msg):
         """
-        # We are formatting the SSE message here
-        formatted_msg = f"data: {msg}\n\n"
-        for i in reversed(range(len(self.listeners))):
+        Sends a message that has no log id to this worker's clients. It goes out without
+        an id field, so it can't be mistaken for a logged event or shift a client's
+        Last-Event-ID; it is not in the replay ring either.
+        """
+        self._unlogged += 1
+        key = _coalesce_key(f"unlogged-{self._unlogged}", msg)
+        for client in self.listeners:
+            client.push(None, key, msg)
+
+    def _tail(self, last_id, poll_interval):
+        """Reads events appended by any worker since the last pass and delivers them locally."""
+        last_prune = 0.0
+        while True:
             try:
-                self.listeners[i].put_nowait(formatted_msg)
-            except queue.Full:
-                # If a client's queue is full, they are likely disconnected.
-                # Remove them to prevent blocking.
-                del self.listeners[i]
+                while True:
+                    rows = self.event_log.read_after(last_id, limit=500)
+                    for event_id, msg in rows:
+                        last_id = event_id
+                        self._deliver(event_id, msg)
+                    metrics.incr('sse.delivered', len(rows))
+                    if len(rows) < 500:
+                        break
+                if time.monotonic() - last_prune > 60:
+                    last_prune = time.monotonic()
+                    self.event_log.prune()
+            except sqlite3.Error as e:
+                print(f"[SSE Error] Event log read failed: {e}")
+            self._wakeup.wait(timeout=poll_interval)
+            self._wakeup.clear()
 
 # Create a single global instance of our announcer
-announcer = MessageAnnouncer()
\ No newline at end of file
+announcer = MessageAnnouncer()
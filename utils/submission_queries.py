@@ -0,0 +1,182 @@
+# utils/submission_queries.py
+import base64
+import json
+from datetime import datetime, date
+from sqlalchemy import select, func, case, and_, tuple_, literal
+from models.user import Submission, Receipt, Device
+from .search_index import search_matches, search_condition
+from .sqlite_engine import read_session
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Dashboard tabs -> the submissions they show
+TAB_FILTERS = {
+    'processed': lambda: Submission.status == 'completed',
+    'with_vat': lambda: and_(Submission.status == 'completed', Receipt.vat_amount > 0),
+    'queued': lambda: Submission.status.in_(('queued', 'processing')),
+    'failed': lambda: Submission.status == 'failed',
+    'duplicates': lambda: Submission.status == 'duplicate',
+    'all': lambda: None,
+}
+
+# Sortable columns -> (SQL sort key, how to read a cursor value back). Missing values get a
+# stand-in so the keyset comparison never meets a NULL: no vendor sorts after every name,
+# no amount before every amount, and no receipt date falls back to the day it was received.
+# 'relevance' (best search match first) is built per query in submissions_page_query.
+SORT_KEYS = {
+    'relevance': (None, float),
+    'received_at': (lambda: Submission.received_at, datetime.fromisoformat),
+    'status': (lambda: Submission.status, str),
+    'vendor_name': (lambda: func.coalesce(func.lower(Receipt.vendor_name), '~'), str),
+    'total_amount': (lambda: func.coalesce(Receipt.total_amount, -1.0), float),
+    'receipt_date': (lambda: func.coalesce(Receipt.receipt_date, func.date(Submission.received_at)), date.fromisoformat),
+}
+
+def encode_cursor(sort_value, submission_id):
+    value = sort_value.isoformat() if isinstance(sort_value, (datetime, date)) else sort_value
+    return base64.urlsafe_b64encode(json.dumps([value, submission_id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, sort):
+    """Returns (sort value, submission id) from a cursor, or raises ValueError if it is malformed."""
+    try:
+        value, submission_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return SORT_KEYS[sort][1](value), int(submission_id)
+    except (TypeError, KeyError, json.JSONDecodeError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def parse_submission_filters(args):
+    """Reads the dashboard's filter, sort and paging parameters from a request's query string."""
+    def parse_date(value):
+        try:
+            return date.fromisoformat(value) if value else None
+        except ValueError:
+            raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD.")
+
+    tab = args.get('tab', 'all')
+    sort = args.get('sort', 'received_at')
+    if tab not in TAB_FILTERS:
+        raise ValueError(f"Unknown tab '{tab}'.")
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Cannot sort by '{sort}'.")
+    try:
+        limit = min(MAX_PAGE_SIZE, max(1, int(args.get('limit', DEFAULT_PAGE_SIZE))))
+    except ValueError:
+        raise ValueError("limit must be a number.")
+    return {
+        'tab': tab, 'sort': sort,
+        'direction': 'asc' if args.get('direction') == 'asc' else 'desc',
+        'search': (args.get('search') or '').strip(),
+        'start_date': parse_date(args.get('start_date')),
+        'end_date': parse_date(args.get('end_date')),
+        'cursor': args.get('cursor') or None,
+        'limit': limit,
+    }
+
+def _filter_conditions(filters, include_search=True):
+    conditions = []
+    tab_condition = TAB_FILTERS[filters['tab']]()
+    if tab_condition is not None:
+        conditions.append(tab_condition)
+    if filters['search'] and include_search:
+        conditions.append(search_condition(filters['search']))
+    if filters['start_date']:
+        conditions.append(Receipt.receipt_date >= filters['start_date'])
+    if filters['end_date']:
+        conditions.append(Receipt.receipt_date <= filters['end_date'])
+    return conditions
+
+def submission_columns():
+    """The columns submission_row_to_dict needs; select them from Submission joined with join_receipt_and_device."""
+    tax_analysis = case(
+        (func.json_valid(Receipt.raw_llm_response), func.json_extract(Receipt.raw_llm_response, '$.llm_tax_analysis')),
+        else_=None
+    )
+    return [
+        Submission.id, Submission.status, Submission.received_at, Submission.input_type, Submission.input_data,
+        Submission.description, Submission.location, Submission.error_message,
+        Device.name.label('device_name'),
+        Receipt.id.label('receipt_id'), Receipt.vendor_name, Receipt.total_amount, Receipt.vat_amount, Receipt.receipt_date,
+        tax_analysis.label('llm_tax_analysis')
+    ]
+
+def join_receipt_and_device(query):
+    return query.outerjoin(Receipt, Receipt.submission_id == Submission.id).outerjoin(Device, Device.id == Submission.device_id)
+
+def submissions_page_query(filters):
+    """
+    One Core SELECT joining submissions with their receipt and device, filtered,
+    sorted and cut at the cursor (keyset pagination, so deep pages cost the same
+    as the first). Fetches one row more than the page size to tell if there is a next page.
+    Sorting by relevance joins the full-text matches and orders by their rank; without
+    a usable search it falls back to newest first.
+    """
+    sort = filters['sort']
+    matches = search_matches(filters['search']) if sort == 'relevance' and filters['search'] else None
+    if sort == 'relevance' and matches is None:
+        sort = 'received_at'
+    sort_key = (-matches.c.rank if matches is not None else SORT_KEYS[sort][0]()).label('sort_key')
+    query = select(*submission_columns(), sort_key).select_from(Submission)
+    if matches is not None:
+        query = query.join(matches, matches.c.submission_id == Submission.id)
+    query = join_receipt_and_device(query).where(*_filter_conditions(filters, include_search=matches is None))
+
+    descending = filters['direction'] == 'desc'
+    if filters['cursor']:
+        after_value, after_id = decode_cursor(filters['cursor'], sort)
+        position = tuple_(sort_key.element, Submission.id)
+        after = tuple_(literal(after_value, sort_key.type), literal(after_id))
+        query = query.where(position < after if descending else position > after)
+
+    if descending:
+        query = query.order_by(sort_key.element.desc(), Submission.id.desc())
+    else:
+        query = query.order_by(sort_key.element.asc(), Submission.id.asc())
+    return query.limit(filters['limit'] + 1)
+
+def submissions_insights_query(filters):
+    """Totals and top vendors over every completed submission matching the filters."""
+    conditions = _filter_conditions(filters) + [Submission.status == 'completed']
+    totals = select(
+        func.coalesce(func.sum(Receipt.total_amount), 0.0), func.coalesce(func.sum(Receipt.vat_amount), 0.0)
+    ).select_from(Submission).join(Receipt, Receipt.submission_id == Submission.id).where(*conditions)
+    top_vendors = select(Receipt.vendor_name, func.count(Receipt.id).label('count')) \
+        .select_from(Submission).join(Receipt, Receipt.submission_id == Submission.id) \
+        .where(*conditions, Receipt.vendor_name.is_not(None)) \
+        .group_by(Receipt.vendor_name).order_by(func.count(Receipt.id).desc()).limit(3)
+    return totals, top_vendors
+
+def submission_row_to_dict(row, upload_url):
+    """Shapes a page row like the dashboard expects. `upload_url(path)` turns stored photo paths into public URLs."""
+    input_data = row.input_data
+    if row.input_type == 'photo':
+        input_data = upload_url(input_data)
+    return {
+        "id": row.id, "status": row.status, "received_at": row.received_at.isoformat(),
+        "input_type": row.input_type, "input_data": input_data,
+        "description": row.description, "location": row.location,
+        "error_message": row.error_message, "is_duplicate": row.status == 'duplicate',
+        "device_name": row.device_name or 'Unknown Device',
+        "receipt": {
+            "vendor_name": row.vendor_name, "total_amount": row.total_amount, "vat_amount": row.vat_amount,
+            "receipt_date": row.receipt_date.isoformat() if row.receipt_date else None,
+            "llm_tax_analysis": row.llm_tax_analysis
+        } if row.receipt_id is not None else {}
+    }
+
+def fetch_submissions_page(filters, upload_url):
+    rows = read_session.execute(submissions_page_query(filters)).all()
+    has_more = len(rows) > filters['limit']
+    rows = rows[:filters['limit']]
+    page = {
+        "items": [submission_row_to_dict(row, upload_url) for row in rows],
+        "next_cursor": encode_cursor(rows[-1].sort_key, rows[-1].id) if has_more else None,
+    }
+    if not filters['cursor']:
+        totals_query, vendors_query = submissions_insights_query(filters)
+        total_amount, total_vat = read_session.execute(totals_query).one()
+        page["insights"] = {
+            "totalAmount": total_amount, "totalVat": total_vat,
+            "topVendors": [{"name": name, "count": count} for name, count in read_session.execute(vendors_query).all()]
+        }
+    return page
@@ -0,0 +1,62 @@
+# utils/tra_client.py
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from .metrics import metrics
+
+USER_AGENT = 'Mozilla/5.0 TaxConsultAI/1.0'
+
+class TRAClient:
+    """
+    HTTP access to the TRA verification portal. All submissions share one pooled
+    adapter, so keep-alive connections are reused across jobs, while each submission
+    gets its own Session and therefore its own cookies (the Secret step depends on
+    the cookie set by the first request). A per-host semaphore caps how many
+    requests we have in flight against the portal at once.
+    """
+    def __init__(self, max_connections=10, max_concurrency_per_host=4, timeout=15):
+        self._lock = threading.Lock()
+        self._host_slots = {}
+        self.configure(max_connections, max_concurrency_per_host, timeout)
+
+    def configure(self, max_connections, max_concurrency_per_host, timeout):
+        with self._lock:
+            self.max_concurrency_per_host = max(1, max_concurrency_per_host)
+            self.timeout = timeout
+            self._host_slots = {}
+            # Retries are handled by parking the submission, not inside the adapter.
+            self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections, max_retries=0)
+
+    def new_session(self):
+        """A Session with fresh cookies on top of the shared connection pool. Don't close it; just drop it."""
+        session = requests.Session()
+        session.headers.update({'User-Agent': USER_AGENT})
+        session.mount('https://', self._adapter)
+        session.mount('http://', self._adapter)
+        return session
+
+    def _slots_for(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_concurrency_per_host)
+            return self._host_slots[host]
+
+    def get(self, session, url):
+        """GETs `url` within the host's concurrency cap and records how long it took."""
+        host = urlsplit(url).hostname or ''
+        with self._slots_for(host):
+            started = time.monotonic()
+            try:
+                response = session.get(url, timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                metrics.incr('tra.requests.failed')
+                raise
+            finally:
+                metrics.observe('tra.request', time.monotonic() - started)
+        metrics.incr(f'tra.responses.{response.status_code}')
+        return response
+
+# Create a single global client for the process
+tra_client = TRAClient()
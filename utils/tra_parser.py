@@ -0,0 +1,126 @@
+# utils/tra_parser.py
+import re
+from datetime import datetime
+
+# Bump when the parsing rules change, so cached extractions made with older rules stop matching.
+PARSER_VERSION = '1'
+
+# Labels printed on TRA verification pages, mapped to the receipt fields they fill.
+FIELD_LABELS = {
+    'MOBILE': 'vendor_phone',
+    'TIN': 'vendor_tin',
+    'VRN': 'vrn',
+    'UIN': 'uin',
+    'CUSTOMER NAME': 'customer_name',
+    'CUSTOMER ID TYPE': 'customer_id_type',
+    'CUSTOMER ID': 'customer_id',
+    'RECEIPT NO': 'receipt_number',
+    'Z NUMBER': 'z_number',
+    'RECEIPT DATE': 'receipt_date',
+    'RECEIPT TIME': 'receipt_time',
+    'TOTAL EXCL OF TAX': 'total_excl_tax',
+    'TOTAL TAX': 'vat_amount',
+    'TOTAL INCL OF TAX': 'total_amount',
+}
+# Printed labels we recognise but don't store; they still mark where a value ends.
+OTHER_LABELS = ('SERIAL NO', 'TAX OFFICE', 'CUSTOMER MOBILE', 'RECEIPT VERIFICATION CODE', 'TAX RATE')
+
+# Longest first, so 'CUSTOMER ID TYPE' wins over 'CUSTOMER ID' and 'TOTAL TAX' over 'TAX RATE'.
+_ALL_LABELS = sorted(list(FIELD_LABELS) + list(OTHER_LABELS), key=len, reverse=True)
+_LABEL_RE = re.compile(r'^(' + '|'.join(re.escape(label) for label in _ALL_LABELS) + r')\b[^:]*:?\s*(.*)$', re.IGNORECASE)
+
+START_MARKER = 'START OF LEGAL RECEIPT'
+END_MARKER = 'END OF LEGAL RECEIPT'
+VERIFICATION_LABEL = 'RECEIPT VERIFICATION CODE'
+ITEMS_HEADER = ('DESCRIPTION', 'QTY', 'AMOUNT')
+
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y/%m/%d')
+AMOUNT_FIELDS = ('total_amount', 'vat_amount', 'total_excl_tax')
+
+# The fields a fast-path result must have; without them we fall back to the LLM.
+REQUIRED_FIELDS = ('vendor_name', 'receipt_date', 'total_amount', 'receipt_verification_code')
+
+def _match_label(line):
+    match = _LABEL_RE.match(line)
+    if not match:
+        return None, None
+    label = next(label for label in _ALL_LABELS if match.group(1).upper() == label)
+    return label, match.group(2).strip()
+
+def _parse_amount(value):
+    try:
+        return float(value.replace(',', '').replace('TZS', '').strip())
+    except (ValueError, AttributeError):
+        return None
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date().isoformat()
+        except (ValueError, AttributeError):
+            continue
+    return None
+
+def verification_code_from_url(url):
+    """The QR code URL embeds the verification code: https://verify.tra.go.tz/<CODE>_<HHMMSS>."""
+    match = re.search(r'/([A-Za-z0-9]+)_\d{6}$', url or '')
+    return match.group(1) if match else None
+
+def parse_tra_receipt(text, receipt_url=None):
+    """
+    Parses the cleaned text of a TRA verification page (see clean_html_for_llm).
+    Returns {"fields": {...}, "items": [...]} with the same field names as the LLM
+    tool schema, or None if the page doesn't look like a complete TRA receipt.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not any(START_MARKER in line.upper() for line in lines):
+        return None
+
+    fields, items = {}, []
+    in_items = False
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        upper = line.upper()
+
+        if START_MARKER in upper:
+            # The business name is the first line after the start marker.
+            if i + 1 < len(lines) and _match_label(lines[i + 1])[0] is None:
+                fields['vendor_name'] = lines[i + 1]
+                i += 1
+        elif END_MARKER in upper:
+            break
+        elif upper == VERIFICATION_LABEL:
+            if i + 1 < len(lines):
+                fields['receipt_verification_code'] = lines[i + 1]
+                i += 1
+        elif upper in ITEMS_HEADER:
+            in_items = True
+        else:
+            label, value = _match_label(line)
+            if label is None:
+                if in_items:
+                    items.append(line)
+            else:
+                in_items = False
+                # Values are either on the label's line or on the next one.
+                if not value and i + 1 < len(lines) and _match_label(lines[i + 1])[0] is None \
+                        and lines[i + 1].upper() != VERIFICATION_LABEL and END_MARKER not in lines[i + 1].upper():
+                    value = lines[i + 1]
+                    i += 1
+                field = FIELD_LABELS.get(label)
+                if field and value and field not in fields:
+                    fields[field] = value
+        i += 1
+
+    for field in AMOUNT_FIELDS:
+        if field in fields:
+            fields[field] = _parse_amount(fields[field])
+    if 'receipt_date' in fields:
+        fields['receipt_date'] = _parse_date(fields['receipt_date'])
+    if not fields.get('receipt_verification_code'):
+        fields['receipt_verification_code'] = verification_code_from_url(receipt_url)
+
+    if any(fields.get(field) in (None, '') for field in REQUIRED_FIELDS):
+        return None
+    return {'fields': fields, 'items': items}
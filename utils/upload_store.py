@@ -0,0 +1,104 @@
+# utils/upload_store.py
+import hashlib
+import os
+import tempfile
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+from .metrics import metrics
+
+INCOMING_DIR = '.incoming'
+
+_settings = {'root': None, 'max_bytes': 15 * 1024 * 1024}
+
+def configure_uploads(root, max_bytes):
+    """Stores photos under `root`, refusing any single file larger than `max_bytes`."""
+    _settings.update(root=root, max_bytes=max_bytes)
+    os.makedirs(os.path.join(root, INCOMING_DIR), exist_ok=True)
+
+class HashingUpload:
+    """
+    The file Werkzeug streams an uploaded file into: a temp file in the upload
+    folder (so the final move is a rename), hashed chunk by chunk as it arrives
+    and cut off as soon as it grows past the size limit, instead of being
+    buffered whole first. Deleted on close unless it was moved into the store.
+    """
+    def __init__(self, root, max_bytes):
+        fd, self.path = tempfile.mkstemp(dir=os.path.join(root, INCOMING_DIR))
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha256 = hashlib.sha256()
+        self._max_bytes = max_bytes
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self._max_bytes:
+            self.close()
+            metrics.incr('uploads.rejected_too_large')
+            raise RequestEntityTooLarge(f"Photos may be at most {self._max_bytes / (1024 * 1024):g} MB.")
+        self._sha256.update(chunk)
+        return self._file.write(chunk)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def close(self):
+        self._file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class UploadRequest(Request):
+    """Streams file parts of multipart requests into HashingUpload files."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if _settings['root'] is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return HashingUpload(_settings['root'], _settings['max_bytes'])
+
+def content_hash(file_storage):
+    """The SHA-256 of an uploaded file, computed while it was received."""
+    stream = file_storage.stream
+    if isinstance(stream, HashingUpload):
+        return stream.hexdigest()
+    # Uploads that bypassed UploadRequest: hash them here instead.
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        sha256.update(chunk)
+    stream.seek(0)
+    return sha256.hexdigest()
+
+def stored_path(digest, filename):
+    """Content-addressed location: uploads/ab/cd/abcd...<ext>, so no directory grows too large."""
+    extension = os.path.splitext(secure_filename(filename or ''))[1].lower()
+    return os.path.join(_settings['root'], digest[:2], digest[2:4], f"{digest}{extension}")
+
+def store_upload(file_storage, digest):
+    """
+    Moves an uploaded file to its content-addressed path and returns that path.
+    A file with the same content is already there: keep it and drop the new copy.
+    """
+    path = stored_path(digest, file_storage.filename)
+    if os.path.exists(path):
+        metrics.incr('uploads.already_stored')
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    stream = file_storage.stream
+    if isinstance(stream, HashingUpload):
+        stream.flush()
+        os.replace(stream.path, path)
+        stream.path = None
+    else:
+        file_storage.save(path)
+    metrics.incr('uploads.stored')
+    return path
+
+def upload_filename(path):
+    """A stored photo's path relative to the upload folder, as /uploads/<filename> serves it."""
+    path = path.replace('\\', '/')
+    root = (_settings['root'] or '').replace('\\', '/').rstrip('/') + '/'
+    if _settings['root'] and path.startswith(root):
+        return path[len(root):]
+    # Stored elsewhere (e.g. the data folder moved): files used to sit at the top level
+    return path.rsplit('/', 1)[-1]
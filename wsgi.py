@@ -6,8 +6,10 @@ from gevent import monkey
 monkey.patch_all()
 
 # Now that everything is patched, we can import our main Flask app
-from main import app
+from main import app, start_services
 
-# This allows Gunicorn to find the app object
+# This allows Gunicorn to find the app object. Gunicorn starts the background
+# services in each worker through the post_worker_init hook in gunicorn.conf.py.
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    start_services()
+    app.run()